@@ -1,14 +1,18 @@
 """FastAPI application for mind map generation"""
 
 import os
+import json
 import base64
+import asyncio
 import logging
-from typing import Dict, List
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
 
 from fastapi import FastAPI
 import secrets
 from fastapi import Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 from dotenv import load_dotenv
 
@@ -23,7 +27,6 @@ logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 import numpy as np
 
 from backend.models import PopupPayload, MarkdownMindmapResponse
@@ -31,33 +34,53 @@ from backend.canonical import (
     canonical_from_text,
     canonical_from_page_blocks,
     canonical_from_pdf_bytes,
-    canonical_from_docx_bytes
+    canonical_from_docx_bytes,
+    shutdown_pdf_pool
 )
 from backend.embeddings import (
     embed_blocks,
     embed_blocks_async,
-    embed_chunks,
+    embed_chunks_async,
     chunk_text,
-    build_block_catalog,
-    cosine_top_k
+    StreamingChunker,
+    BlockCatalog,
+    BlockIndex
 )
-from backend.clustering import choose_k, cluster_chunks, label_clusters
-from backend.mindmap_builder import build_mindmap, attach_evidence
+from backend.clustering import (
+    choose_k,
+    cluster_chunks_async,
+    label_clusters_async
+)
+from backend.mindmap_builder import build_mindmap_async, attach_evidence
 from backend.markdown_generator import (
     generate_tree_markdown,
     generate_tree_markdown_sequential,
-    extract_leaves,
     select_most_important_leaves,
     generate_leaf_text,
     generate_leaves_parallel,
+    EventCallback,
     ensure_block_refs,
-    linkify_block_refs,
-    apply_leaf_expansions,
-    apply_leaf_expansions_with_remapping,
-    remove_unprocessed_leaves,
-    remove_empty_subsections
+    linkify_block_refs
 )
 from backend.canonical import normalize_ws
+from backend.embedding_cache import EmbeddingCache
+from backend.completion_cache import CompletionCache
+from backend.leaf_cache import SemanticLeafCache
+from backend.page_snapshot import SnapshotStore, block_hashes
+from backend.dedup import dedup_blocks
+from backend.catalog_budget import fit_catalog_to_budget
+from backend.mindmap_tree import MindmapTree
+from backend.clients import AppClients, ClientSettings, create_clients
+from backend.result_cache import ResultCache, payload_digest
+from backend.jobs import JobManager, QueueFullError
+from backend.metrics import (
+    CONTENT_TYPE_LATEST,
+    PAYLOAD_BLOCKS,
+    PAYLOAD_BYTES,
+    REQUESTS_IN_FLIGHT,
+    render_metrics,
+)
+from backend.tracing import stage, trace_pipeline
 
 load_dotenv()
 
@@ -67,8 +90,28 @@ load_dotenv()
 
 ENV = os.getenv("ENV", "dev")
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Общие клиенты с пулом соединений: один TLS пул на все запросы и стадии
+    clients = create_clients(ClientSettings.from_env(), embedding_cache, completion_cache)
+    app.state.clients = clients
+    await clients.warm_up()
+    await job_manager.start()
+    try:
+        yield
+    finally:
+        await job_manager.stop()
+        await clients.aclose()
+        embedding_cache.flush()
+        if completion_cache is not None:
+            completion_cache.close()
+        shutdown_pdf_pool()
+
+
 app = FastAPI(
     title="Mindmap Backend",
+    lifespan=lifespan,
     docs_url=None if ENV == "prod" else "/docs",
     redoc_url=None if ENV == "prod" else "/redoc",
     openapi_url=None if ENV == "prod" else "/openapi.json",
@@ -76,10 +119,43 @@ app = FastAPI(
 
 API_TOKEN = os.getenv("API_TOKEN", "")
 
+# Общий кэш эмбеддингов для всех запросов (повторные страницы не ходят в API)
+embedding_cache = EmbeddingCache.from_env()
+# Кэш ответов LLM в SQLite (повторные промпты не ходят в API); None — выключен
+completion_cache = CompletionCache.from_env()
+# Семантический кэш текстов листьев (те же блоки + близкий запрос); None — выключен
+leaf_cache = SemanticLeafCache.from_env()
+# Снимки прошлых запусков по URL: повторное открытие страницы пересчитывает только изменения
+snapshot_store = SnapshotStore.from_env()
+# Кэш готовых ответов /mindmap_markdown (stale-while-revalidate)
+result_cache = ResultCache.from_env()
+# Сколько тем верхнего уровня обрабатывается параллельно
+TOPIC_CONCURRENCY = int(os.getenv("TOPIC_CONCURRENCY", "4"))
+# Сколько под-батчей эмбеддингов чанков /mindmap отправляется параллельно
+CHUNK_EMBED_CONCURRENCY = int(os.getenv("CHUNK_EMBED_CONCURRENCY", "4"))
+# Бюджет извлечения PDF (0 — без ограничения) и число процессов для страниц
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "1000"))
+PDF_MAX_TEXT_BYTES = int(float(os.getenv("PDF_MAX_TEXT_MB", "20")) * 1024 * 1024)
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "0")) or None
+# Схлопывание повторяющихся блоков до эмбеддингов; порог Жаккара для почти-дублей ("" — только точные)
+DEDUP_BLOCKS = os.getenv("DEDUP_BLOCKS", "1") not in ("0", "false", "no")
+DEDUP_NEAR_THRESHOLD = float(os.getenv("DEDUP_NEAR_THRESHOLD", "0.9") or 0) or None
+# Хранение векторов блоков в индексе документа: float32 | float16 | int8
+EMBEDDING_PRECISION = os.getenv("EMBEDDING_PRECISION", "float32")
+# Приближенный поиск (IVF) для документов от ANN_MIN_BLOCKS блоков (0 — всегда точный).
+# По умолчанию выключен: построение дороже ~40 запросов одного прогона пайплайна
+ANN_MIN_BLOCKS = int(os.getenv("ANN_MIN_BLOCKS", "0"))
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0"))
+# Бюджет токенов каталога в промптах тем и fallback-дерева (0 — без ограничения)
+CATALOG_MAX_TOKENS = int(os.getenv("CATALOG_MAX_TOKENS", "12000"))
+# Интервал keepalive-комментариев в SSE-потоке
+SSE_KEEPALIVE_S = float(os.getenv("SSE_KEEPALIVE_S", "15"))
+
 class AuthMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        # healthcheck — без токена
-        if request.url.path == "/health":
+        # healthcheck и метрики — без токена
+        if request.url.path in ("/health", "/metrics"):
             return await call_next(request)
 
         auth = request.headers.get("Authorization", "")
@@ -96,6 +172,50 @@ class AuthMiddleware(BaseHTTPMiddleware):
 
         return await call_next(request)
 
+class MetricsMiddleware:
+    """ASGI middleware: запросы в обработке и размер тела для эндпоинтов генерации
+
+    Чистый ASGI (не BaseHTTPMiddleware), чтобы запрос считался в обработке
+    до конца стриминга ответа.
+    """
+
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        endpoint = scope["path"]
+        size = 0
+
+        async def counting_receive():
+            nonlocal size
+            message = await receive()
+            if message["type"] == "http.request":
+                size += len(message.get("body", b""))
+            return message
+
+        REQUESTS_IN_FLIGHT.labels(endpoint).inc()
+        try:
+            await self.app(scope, counting_receive, send)
+        finally:
+            REQUESTS_IN_FLIGHT.labels(endpoint).dec()
+            PAYLOAD_BYTES.labels(endpoint).observe(size)
+
+
+def observe_payload(endpoint: str, payload: PopupPayload) -> None:
+    """Размер payload в блоках (для page_blocks)"""
+    if payload.input_type == "page_blocks":
+        PAYLOAD_BLOCKS.labels(endpoint).observe(len(payload.blocks or []))
+
+
+app.add_middleware(
+    MetricsMiddleware,
+    paths=("/mindmap", "/mindmap_markdown", "/mindmap_markdown/stream", "/jobs/mindmap_markdown"),
+)
 app.add_middleware(AuthMiddleware)
 
 EXT_ID = os.getenv("EXT_ID", "")
@@ -115,54 +235,91 @@ def health():
     return {"ok": True}
 
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics"""
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/mindmap")
-def mindmap(payload: PopupPayload):
-    """Generates mind map in JSON format"""
-    try:
-        # 1) Canonicalize
-        if payload.input_type == "text":
-            canon = canonical_from_text(payload.value or "")
-            title = payload.title or "pasted_text"
+async def mindmap(payload: PopupPayload, timings: bool = False):
+    """Generates mind map in JSON format (non-blocking: CPU work runs in threads)
 
-        elif payload.input_type == "page_blocks":
-            blocks = payload.blocks or []
-            canon = canonical_from_page_blocks(payload.page, blocks)
-            title = payload.title or canon.meta.get("title") or canon.meta.get("url") or "page"
+    timings=true adds per-stage wall times (seconds) to meta.
+    """
+    observe_payload("/mindmap", payload)
+    with trace_pipeline("mindmap") as trace:
+        result = await build_json_mindmap(payload)
+    if timings and result.get("ok"):
+        result["meta"]["timings"] = trace.to_dict()
+    return result
 
-        elif payload.input_type == "file":
-            if not payload.file:
-                return {"ok": False, "error": "file field is missing"}
-            raw = base64.b64decode(payload.file.content_base64)
-            filename = payload.file.name
-
-            ext = os.path.splitext(filename.lower())[1]
-            if ext == ".pdf":
-                canon = canonical_from_pdf_bytes(filename, raw)
-            elif ext == ".docx":
-                canon = canonical_from_docx_bytes(filename, raw)
-            else:
-                return {"ok": False, "error": "unsupported file type (need .pdf or .docx)"}
 
-            title = payload.title or filename
+async def build_json_mindmap(payload: PopupPayload) -> Dict:
+    """Runs the clustering (JSON) mind map pipeline for a payload"""
+    try:
+        chunker: Optional[StreamingChunker] = None
+        # 1) Canonicalize
+        with stage("canonicalize"):
+            if payload.input_type == "text":
+                canon = canonical_from_text(payload.value or "")
+                title = payload.title or "pasted_text"
+
+            elif payload.input_type == "page_blocks":
+                blocks = payload.blocks or []
+                canon = canonical_from_page_blocks(payload.page, blocks)
+                title = payload.title or canon.meta.get("title") or canon.meta.get("url") or "page"
+
+            elif payload.input_type == "file":
+                if not payload.file:
+                    return {"ok": False, "error": "file field is missing"}
+                raw = base64.b64decode(payload.file.content_base64)
+                filename = payload.file.name
+
+                ext = os.path.splitext(filename.lower())[1]
+                if ext == ".pdf":
+                    # Страницы чанкуются по мере извлечения, пока пул разбирает следующие
+                    chunker = StreamingChunker()
+                    canon = await asyncio.to_thread(
+                        canonical_from_pdf_bytes, filename, raw,
+                        max_pages=PDF_MAX_PAGES, max_bytes=PDF_MAX_TEXT_BYTES, workers=PDF_WORKERS,
+                        on_text=chunker.feed
+                    )
+                elif ext == ".docx":
+                    canon = await asyncio.to_thread(canonical_from_docx_bytes, filename, raw)
+                else:
+                    return {"ok": False, "error": "unsupported file type (need .pdf or .docx)"}
+
+                title = payload.title or filename
 
-        else:
-            return {"ok": False, "error": "unsupported input_type"}
+            else:
+                return {"ok": False, "error": "unsupported input_type"}
 
         if not canon.original_text.strip():
             return {"ok": False, "error": "empty text after extraction"}
 
         # 2) Build mindmap
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.01)
-        emb = OpenAIEmbeddings(model="text-embedding-3-small")
+        clients: AppClients = app.state.clients
+        llm = clients.llm_cluster
+        emb = clients.emb
 
-        chunks = chunk_text(canon.original_text)
-        vectors = embed_chunks(chunks, emb)
+        with stage("chunk"):
+            if chunker is not None:
+                chunks = chunker.finish()
+            else:
+                chunks = await asyncio.to_thread(chunk_text, canon.original_text)
+        with stage("embed_chunks"):
+            vectors = await embed_chunks_async(chunks, emb, max_concurrency=CHUNK_EMBED_CONCURRENCY)
         k = choose_k(len(chunks))
-        assignments = cluster_chunks(vectors, k)
-        cluster_topics = label_clusters(llm, chunks, assignments, k)
+        with stage("cluster"):
+            assignments = await cluster_chunks_async(vectors, k)
+        with stage("label_clusters"):
+            cluster_topics = await label_clusters_async(llm, chunks, assignments, k)
 
-        mm = build_mindmap(llm, title, cluster_topics, chunks, assignments)
-        mm = attach_evidence(mm, canon)
+        with stage("build_mindmap"):
+            mm = await build_mindmap_async(llm, title, cluster_topics, chunks, assignments)
+        with stage("evidence"):
+            mm = attach_evidence(mm, canon)
 
         return {
             "ok": True,
@@ -183,9 +340,26 @@ def mindmap(payload: PopupPayload):
         }
 
 
-@app.post("/mindmap_markdown", response_model=MarkdownMindmapResponse)
-async def mindmap_markdown(payload: PopupPayload):
-    """Generates mind map in Markdown format with parallel processing"""
+async def build_markdown_mindmap(
+    payload: PopupPayload,
+    on_event: Optional[EventCallback] = None
+) -> MarkdownMindmapResponse:
+    """Runs the full Markdown mind map pipeline for a payload
+
+    on_event receives progress events (topics, subtree, tree, leaves, leaf) as stages finish.
+    Per-stage wall times are stored in meta["timings"].
+    """
+    with trace_pipeline("mindmap_markdown") as trace:
+        resp = await run_markdown_pipeline(payload, on_event)
+    if resp.ok:
+        resp.meta["timings"] = trace.to_dict()
+    return resp
+
+
+async def run_markdown_pipeline(
+    payload: PopupPayload,
+    on_event: Optional[EventCallback] = None
+) -> MarkdownMindmapResponse:
     try:
         # Canonicalize + blocks (for page_blocks we need original blocks)
         blocks: List = []
@@ -193,7 +367,8 @@ async def mindmap_markdown(payload: PopupPayload):
         if payload.input_type == "page_blocks":
             blocks = payload.blocks or []
             
-            canon = canonical_from_page_blocks(payload.page, blocks)
+            with stage("canonicalize"):
+                canon = canonical_from_page_blocks(payload.page, blocks)
             title = payload.title or canon.meta.get("title") or canon.meta.get("url") or "page"
             page_url = canon.meta.get("url") or "current_page"
 
@@ -218,61 +393,121 @@ async def mindmap_markdown(payload: PopupPayload):
                 if b.block is not None and b.xpath:
                     block_to_xpath[int(b.block)] = b.xpath
 
-            # LLM + embeddings
-            llm_tree = ChatOpenAI(model="gpt-4o-mini", temperature=0.02)
-            llm_leaf_async = ChatOpenAI(model="gpt-4o-mini", temperature=0.02, max_tokens=200)
-            emb = OpenAIEmbeddings(model="text-embedding-3-small")
+            # Повторы ("Read more", подписи, колонтитулы PDF) схлопываются до эмбеддингов и каталога.
+            # Дальше пайплайн видит только представителей — это исходные блоки, поэтому
+            # их ссылки по-прежнему резолвятся через block_to_xpath
+            dedup = None
+            doc_blocks = blocks
+            if DEDUP_BLOCKS:
+                with stage("dedup"):
+                    dedup = await asyncio.to_thread(dedup_blocks, blocks, near_threshold=DEDUP_NEAR_THRESHOLD)
+                doc_blocks = dedup.blocks
+
+            # LLM + embeddings (общие клиенты приложения)
+            clients: AppClients = app.state.clients
+            llm_tree = clients.llm_tree
+            llm_leaf_async = clients.llm_leaf
+            emb = clients.emb
+
+            # Параметр детализации: "low" (кратко), "medium" (средне), "high" (подробно)
+            detail_level = "medium"  # Можно сделать настраиваемым через параметр запроса
+
+            # Прошлый запуск той же страницы с теми же параметрами: блоки сравниваются по хэшам содержимого
+            run = None
+            snapshot_ns = "|".join([
+                "pdf" if is_pdf else "web",
+                title,
+                detail_level,
+                str(getattr(emb, "namespace", "")),
+                str(getattr(llm_tree, "model", "")),
+                str(getattr(llm_leaf_async, "model", "")),
+                f"dedup={DEDUP_BLOCKS}:{DEDUP_NEAR_THRESHOLD}",
+                f"catalog={CATALOG_MAX_TOKENS}",
+                EMBEDDING_PRECISION,
+                f"ann={ANN_MIN_BLOCKS}:{ANN_NPROBE}:{ANN_NLIST}",
+            ])
+            if snapshot_store is not None and canon.meta.get("url"):
+                run = snapshot_store.begin(page_url, snapshot_ns, block_hashes(doc_blocks), doc_blocks)
 
             # Embeddings per block (async для ускорения)
-            block_vecs, block_ids = await embed_blocks_async(blocks, emb)
+            with stage("embed_blocks"):
+                block_vecs, block_ids = await embed_blocks_async(
+                    doc_blocks, emb, known=run.known_vectors() if run is not None else None
+                )
             
             if len(block_ids) == 0:
                 return MarkdownMindmapResponse(ok=False, markdown="", meta={"error": "no blocks to embed"})
 
-            # Catalog (snippets) -> tree markdown (последовательно: темы -> подтемы)
-            catalog = build_block_catalog(blocks, max_snippet_chars=220, is_pdf=is_pdf)
-            # Параметр детализации: "low" (кратко), "medium" (средне), "high" (подробно)
-            detail_level = "medium"  # Можно сделать настраиваемым через параметр запроса
+            with stage("index_catalog"):
+                # Индекс строится один раз на документ (нормализованная матрица + тексты блоков)
+                index = await asyncio.to_thread(
+                    BlockIndex.from_blocks, block_vecs, block_ids, doc_blocks, precision=EMBEDDING_PRECISION,
+                    ann_min_blocks=ANN_MIN_BLOCKS, nprobe=ANN_NPROBE, nlist=ANN_NLIST,
+                )
+                if index.uses_ann:
+                    await asyncio.to_thread(index.build_ann)
+                # Дальше векторы нужны только в сжатом виде индекса
+                del block_vecs
+
+                # Catalog (snippets) -> tree markdown (последовательно: темы -> подтемы)
+                catalog = BlockCatalog.from_blocks(doc_blocks, max_snippet_chars=220, is_pdf=is_pdf)
+                # Для промптов по всему документу каталог ужимается до бюджета токенов
+                prompt_catalog, catalog_stats = fit_catalog_to_budget(
+                    catalog, index, CATALOG_MAX_TOKENS, model=getattr(llm_tree, "model", None)
+                )
             tree_md, topic_volumes, topic_importance = await generate_tree_markdown_sequential(
-                llm_tree, title, catalog, block_vecs, block_ids, blocks, emb, 
-                is_pdf=is_pdf, detail_level=detail_level
-            )
-
-            # Parse leaves
-            all_leaves = extract_leaves(tree_md)
-            
-            # Отбираем самые важные листья для генерации текста
-            MAX_LEAVES_TO_EXPAND = 30  # Ограничиваем количество для ускорения
-            important_leaves, processed_branches = select_most_important_leaves(
-                all_leaves, 
-                MAX_LEAVES_TO_EXPAND,
-                topic_volumes,
-                topic_importance
+                llm_tree, title, catalog, index, emb, 
+                is_pdf=is_pdf, detail_level=detail_level,
+                max_concurrency=TOPIC_CONCURRENCY,
+                on_event=on_event,
+                prompt_catalog=prompt_catalog,
+                reuse=run
             )
+            if on_event:
+                on_event("tree", {"markdown": tree_md})
+
+            with stage("leaf_selection"):
+                # Markdown разбирается в дерево один раз; дальше работаем с деревом
+                tree = MindmapTree.parse(tree_md)
+                all_leaves = tree.leaves()
+                
+                # Отбираем самые важные листья для генерации текста
+                MAX_LEAVES_TO_EXPAND = 30  # Ограничиваем количество для ускорения
+                important_leaves, processed_branches = select_most_important_leaves(
+                    all_leaves, 
+                    MAX_LEAVES_TO_EXPAND,
+                    topic_volumes,
+                    topic_importance
+                )
+            if on_event:
+                on_event("leaves", {"total": len(important_leaves)})
 
             # Параллельная обработка отобранных листьев
-            expansions = await generate_leaves_parallel(
-                llm_leaf_async,
-                important_leaves,
-                block_vecs,
-                block_ids,
-                blocks,
-                emb,
-                is_pdf,
-                page_url,
-                block_to_xpath,
-                max_leaves=None  # Уже отобрали нужное количество
-            )
-
-            # Удаляем необработанные листья ДО применения расширений (чтобы индексы совпадали)
-            processed_leaf_indices = set(expansions.keys())
-            tree_md_cleaned = remove_unprocessed_leaves(tree_md, processed_leaf_indices)
-            
-            # Удаляем пустые подразделы (узлы без листьев)
-            tree_md_cleaned = remove_empty_subsections(tree_md_cleaned)
-            
-            # Применяем расширения листьев к очищенному markdown
-            final_md = apply_leaf_expansions_with_remapping(tree_md_cleaned, tree_md, expansions)
+            with stage("leaves"):
+                expansions = await generate_leaves_parallel(
+                    llm_leaf_async,
+                    important_leaves,
+                    index,
+                    emb,
+                    is_pdf,
+                    page_url,
+                    block_to_xpath,
+                    max_leaves=None,  # Уже отобрали нужное количество
+                    on_event=on_event,
+                    leaf_cache=leaf_cache,
+                    reuse=run
+                )
+
+            with stage("postprocess"):
+                # Удаляем необработанные листья и пустые подразделы (узлы без листьев),
+                # подставляем расширения по индексам строк исходного markdown
+                tree.prune_leaves(set(expansions.keys()))
+                tree.remove_empty_sections()
+                tree.apply_expansions(expansions)
+                final_md = tree.render()
+
+            if run is not None:
+                snapshot_store.put(run.snapshot(page_url, snapshot_ns, index))
 
             return MarkdownMindmapResponse(
                 ok=True,
@@ -281,9 +516,15 @@ async def mindmap_markdown(payload: PopupPayload):
                     "source": canon.meta,
                     "blocks_count": len(blocks),
                     "embedded_blocks": len(block_ids),
+                    "dedup": dedup.stats() if dedup is not None else None,
                     "leaves_total": len(all_leaves),
                     "leaves_expanded": len(expansions),
                     "is_pdf": is_pdf,
+                    "catalog": catalog_stats,
+                    "embedding_cache": embedding_cache.stats(),
+                    "completion_cache": completion_cache.stats() if completion_cache is not None else None,
+                    "leaf_cache": leaf_cache.stats() if leaf_cache is not None else None,
+                    "incremental": run.stats() if run is not None else None,
                 }
             )
 
@@ -302,3 +543,113 @@ async def mindmap_markdown(payload: PopupPayload):
             meta={"error": f"Internal error: {str(e)}"}
         )
 
+
+async def mindmap_markdown_with_events(
+    payload: PopupPayload,
+    on_event: Optional[EventCallback] = None,
+    include_timings: bool = False
+) -> MarkdownMindmapResponse:
+    """Cached entry point of the Markdown pipeline (cache hits emit no progress events)
+
+    Stage timings stay in meta only with include_timings (for a cache hit they
+    describe the run that produced the cached result).
+    """
+    if payload.input_type != "page_blocks":
+        resp, meta = await build_markdown_mindmap(payload, on_event), {}
+    else:
+        resp, cache_info = await result_cache.get_or_compute(
+            payload_digest(payload),
+            lambda: build_markdown_mindmap(payload, on_event),
+            should_store=lambda r: r.ok,
+            # Фоновое обновление идет после ответа: события слать уже некому
+            revalidate=lambda: build_markdown_mindmap(payload),
+        )
+        meta = {"cache": cache_info}
+    # Копия, чтобы не менять закэшированный объект
+    meta = {**resp.meta, **meta}
+    if not include_timings:
+        meta.pop("timings", None)
+    return resp.model_copy(update={"meta": meta})
+
+
+@app.post("/mindmap_markdown", response_model=MarkdownMindmapResponse)
+async def mindmap_markdown(payload: PopupPayload, timings: bool = False):
+    """Generates mind map in Markdown format with parallel processing
+
+    timings=true adds per-stage wall times (seconds) to meta.
+    """
+    observe_payload("/mindmap_markdown", payload)
+    return await mindmap_markdown_with_events(payload, include_timings=timings)
+
+
+def sse_event(event: str, data: Dict) -> str:
+    """Formats one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/mindmap_markdown/stream")
+async def mindmap_markdown_stream(payload: PopupPayload, timings: bool = False):
+    """Streaming variant of /mindmap_markdown (text/event-stream)
+
+    Emits topics, subtree, tree and leaf events as stages finish and a final
+    done event with the same body as /mindmap_markdown.
+    """
+    observe_payload("/mindmap_markdown/stream", payload)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def emit(event: str, data: Dict) -> None:
+        queue.put_nowait((event, data))
+
+    async def run():
+        try:
+            resp = await mindmap_markdown_with_events(payload, emit, include_timings=timings)
+            emit("done", resp.model_dump())
+        except Exception as e:
+            logger.error(f"[MM] Error in stream: {str(e)}")
+            emit("error", {"error": f"Internal error: {str(e)}"})
+        finally:
+            queue.put_nowait(None)
+
+    async def events():
+        # Задача не отменяется при обрыве соединения: результат попадет в кэш
+        task = asyncio.create_task(run())
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_S)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if item is None:
+                break
+            yield sse_event(*item)
+        await task
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Очередь фоновых задач для длинных документов
+job_manager = JobManager.from_env(mindmap_markdown_with_events)
+
+
+@app.post("/jobs/mindmap_markdown", status_code=202)
+async def submit_mindmap_markdown_job(payload: PopupPayload):
+    """Queues a /mindmap_markdown run and returns a job id for polling"""
+    observe_payload("/jobs/mindmap_markdown", payload)
+    try:
+        job = job_manager.submit(payload)
+    except QueueFullError as e:
+        return JSONResponse(status_code=503, content={"ok": False, "error": str(e)})
+    return {"ok": True, "job_id": job.id, "status": job.status}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Returns job status, per-stage progress and the result once done"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"ok": False, "error": "job not found"})
+    return {"ok": True, "job": job.to_dict()}
@@ -0,0 +1,84 @@
+"""Приближенный поиск соседей для больших документов: IVF (инвертированные списки по KMeans)"""
+
+from typing import Callable, Tuple
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+# rows(positions) -> нормализованные float32 векторы
+RowsFn = Callable[[np.ndarray], np.ndarray]
+# scores(queries, start, end) -> (n_queries, end - start) сходства со строками [start, end)
+ScoresFn = Callable[[np.ndarray, int, int], np.ndarray]
+
+
+class IVFIndex:
+    """Векторы разбиты на nlist списков по ближайшему центроиду
+
+    Строки хранилища должны быть упорядочены по спискам (перестановку
+    возвращает build), тогда список c — непрерывный диапазон
+    [offsets[c], offsets[c + 1]). Запрос сравнивается с центроидами, затем
+    точно пересчитываются только nprobe ближайших списков; запросы,
+    попавшие в один список, считаются одним матричным произведением.
+    """
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.offsets = offsets
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, n: int, rows: RowsFn, nlist: int = 0, sample_per_list: int = 32,
+              chunk_rows: int = 4096, seed: int = 0) -> Tuple["IVFIndex", np.ndarray]:
+        """Обучает центроиды на выборке и раскладывает все n векторов по спискам
+
+        nlist=0 — около sqrt(n) списков. Возвращает индекс и перестановку
+        строк (позиции, сгруппированные по спискам), в которой их нужно хранить.
+        """
+        nlist = max(1, min(n, nlist or int(np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n, size=min(n, nlist * sample_per_list), replace=False))
+        # init="random": k-means++ на сотнях центроидов обходится дороже самого обучения
+        km = MiniBatchKMeans(n_clusters=nlist, init="random", batch_size=4096, n_init=1, max_iter=10,
+                             random_state=seed)
+        km.fit(rows(sample))
+        centroids = km.cluster_centers_.astype(np.float32)
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-9
+
+        assign = np.empty(n, dtype=np.int64)
+        for start in range(0, n, chunk_rows):
+            end = min(n, start + chunk_rows)
+            assign[start:end] = np.argmax(rows(np.arange(start, end)) @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=offsets[1:])
+        return cls(centroids, offsets), order
+
+    def probe(self, Q: np.ndarray, nprobe: int) -> np.ndarray:
+        """(n_queries, nprobe) ближайших к запросам списков"""
+        nprobe = max(1, min(nprobe, self.nlist))
+        sims = Q @ self.centroids.T
+        if nprobe == self.nlist:
+            return np.broadcast_to(np.arange(self.nlist), sims.shape)
+        return np.argpartition(-sims, nprobe - 1, axis=1)[:, :nprobe]
+
+    def search(self, Q: np.ndarray, k: int, nprobe: int, scores: ScoresFn) -> np.ndarray:
+        """(n_queries, k) строк хранилища по убыванию сходства; -1 — если в пробах меньше k строк"""
+        probes = self.probe(Q, nprobe)
+        best_val = np.full((Q.shape[0], k), -np.inf, dtype=np.float32)
+        best_idx = np.full((Q.shape[0], k), -1, dtype=np.int64)
+        for c in np.unique(probes):
+            start, end = int(self.offsets[c]), int(self.offsets[c + 1])
+            if start == end:
+                continue
+            qi = np.nonzero((probes == c).any(axis=1))[0]
+            sims = scores(Q[qi], start, end)
+            vals = np.concatenate([best_val[qi], sims], axis=1)
+            idx = np.concatenate([best_idx[qi], np.broadcast_to(np.arange(start, end), sims.shape)], axis=1)
+            top = np.argpartition(-vals, k - 1, axis=1)[:, :k]
+            best_val[qi] = np.take_along_axis(vals, top, axis=1)
+            best_idx[qi] = np.take_along_axis(idx, top, axis=1)
+        order = np.argsort(-best_val, axis=1, kind="stable")
+        return np.take_along_axis(best_idx, order, axis=1)
@@ -1,13 +1,22 @@
 """Работа с canonical text и anchors"""
 
+import io
 import os
 import re
-import tempfile
 import bisect
+import zipfile
+import tempfile
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
 
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
+import xxhash
+from lxml import etree
+from pypdf import PdfReader
 
 from backend.models import PopupPage, PopupBlock
 
@@ -43,6 +52,11 @@ def normalize_ws(s: str) -> str:
     return " ".join(s.split())
 
 
+def content_hash(text: str) -> int:
+    """Стабильный хэш содержимого блока (xxh3-64 от нормализованного текста)"""
+    return xxhash.xxh3_64_intdigest(normalize_ws(text).encode("utf-8"))
+
+
 def canonical_from_text(text: str) -> Canonical:
     """Создает canonical из текста"""
     t = text or ""
@@ -93,77 +107,247 @@ def canonical_from_page_blocks(page: Optional[PopupPage], blocks: List[PopupBloc
     )
 
 
-def canonical_from_pdf_bytes(filename: str, data: bytes) -> Canonical:
-    """Создает canonical из PDF файла"""
+def _extract_pdf_page_range(path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    """Извлекает текст страниц [start, stop) — выполняется в процессе пула"""
+    reader = PdfReader(path)
+    return [(i + 1, reader.pages[i].extract_text() or "") for i in range(start, stop)]
+
+
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _get_pdf_pool(workers: int) -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn: пул создается из потоков сервера, fork здесь небезопасен
+            _pdf_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+
+def shutdown_pdf_pool() -> None:
+    """Останавливает пул процессов извлечения PDF (при остановке приложения)"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(wait=False, cancel_futures=True)
+            _pdf_pool = None
+
+
+class PdfPageStream:
+    """Постраничное извлечение текста PDF из памяти с бюджетом
+
+    Диапазоны страниц извлекаются параллельно в пуле процессов (PDF один раз
+    пишется во временный файл на диске, воркеры читают его сами — без копии
+    на задачу и без /dev/shm, который в Docker по умолчанию 64 MB),
+    страницы отдаются по порядку по мере готовности.
+    Извлечение останавливается после max_pages страниц или max_bytes текста.
+    """
+
+    def __init__(self, data: bytes, max_pages: Optional[int] = None, max_bytes: Optional[int] = None,
+                 workers: Optional[int] = None, pages_per_task: int = 8):
+        self.data = data
+        self.page_count = len(PdfReader(io.BytesIO(data)).pages)
+        self.pages_to_read = min(self.page_count, max_pages) if max_pages else self.page_count
+        self.max_bytes = max_bytes
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.pages_per_task = max(1, pages_per_task)
+        self.pages_read = 0
+        self.truncated = self.pages_to_read < self.page_count
+
+    def _ranges(self) -> List[Tuple[int, int]]:
+        # Не меньше pages_per_task страниц на задачу, но так, чтобы загрузить все ядра
+        size = max(self.pages_per_task, -(-self.pages_to_read // (self.workers * 4)))
+        return [(s, min(s + size, self.pages_to_read)) for s in range(0, self.pages_to_read, size)]
+
+    def _iter_inline(self) -> Iterator[Tuple[int, str]]:
+        reader = PdfReader(io.BytesIO(self.data))
+        for i in range(self.pages_to_read):
+            yield i + 1, reader.pages[i].extract_text() or ""
+
+    def _iter_parallel(self) -> Iterator[Tuple[int, str]]:
+        spool = tempfile.NamedTemporaryFile(prefix="pdf-", suffix=".pdf", delete=False)
+        pending: Deque[Future] = deque()
+        try:
+            with spool:
+                spool.write(self.data)
+            pool = _get_pdf_pool(self.workers)
+            ranges = iter(self._ranges())
+            # Ограниченное окно задач: при досрочной остановке лишнее не извлекается
+            for start, stop in itertools.islice(ranges, self.workers * 2):
+                pending.append(pool.submit(_extract_pdf_page_range, spool.name, start, stop))
+            while pending:
+                pages = pending.popleft().result()
+                nxt = next(ranges, None)
+                if nxt is not None:
+                    pending.append(pool.submit(_extract_pdf_page_range, spool.name, *nxt))
+                yield from pages
+        finally:
+            for fut in pending:
+                fut.cancel()
+            for fut in pending:
+                if not fut.cancelled():
+                    try:
+                        fut.result()  # дожидаемся, пока воркер дочитает файл
+                    except Exception:
+                        pass
+            os.unlink(spool.name)
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        small = self.pages_to_read <= self.pages_per_task or self.workers == 1
+        pages = self._iter_inline() if small else self._iter_parallel()
+        text_bytes = 0
+        try:
+            for page, text in pages:
+                self.pages_read += 1
+                text_bytes += len(text.encode("utf-8"))
+                yield page, text
+                if self.max_bytes and text_bytes >= self.max_bytes and self.pages_read < self.pages_to_read:
+                    self.truncated = True
+                    return
+        finally:
+            pages.close()
+
+
+def canonical_from_pdf_bytes(filename: str, data: bytes, max_pages: Optional[int] = None,
+                             max_bytes: Optional[int] = None, workers: Optional[int] = None,
+                             on_text: Optional[Callable[[str], Any]] = None) -> Canonical:
+    """Создает canonical из PDF файла (в памяти, страницы извлекаются параллельно)
+
+    on_text получает каждый добавленный к original_text фрагмент по мере
+    извлечения страниц (например, StreamingChunker.feed).
+    """
     anchors: List[Anchor] = []
     parts: List[str] = []
     cursor = 0
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
-        f.write(data)
-        tmp_path = f.name
-
-    try:
-        docs = PyPDFLoader(tmp_path).load()  # 1 doc per page
-        for d in docs:
-            page = int(d.metadata.get("page", 0)) + 1
-            txt = (d.page_content or "").strip()
-            chunk = txt if not parts else ("\n\n" + txt)
-            start = cursor
-            parts.append(chunk)
-            cursor += len(chunk)
-            end = cursor
-            anchors.append(Anchor(
-                source_type="pdf",
-                source_id=filename,
-                locator={"page": page},
-                start=start,
-                end=end
-            ))
-    finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+    stream = PdfPageStream(data, max_pages=max_pages, max_bytes=max_bytes, workers=workers)
+    for page, text in stream:
+        txt = text.strip()
+        chunk = txt if not parts else ("\n\n" + txt)
+        start = cursor
+        parts.append(chunk)
+        cursor += len(chunk)
+        end = cursor
+        if on_text is not None:
+            on_text(chunk)
+        anchors.append(Anchor(
+            source_type="pdf",
+            source_id=filename,
+            locator={"page": page},
+            start=start,
+            end=end
+        ))
 
     return Canonical(
         original_text="".join(parts),
         anchors=anchors,
-        meta={"source_type": "pdf", "filename": filename}
+        meta={
+            "source_type": "pdf",
+            "filename": filename,
+            "pages_total": stream.page_count,
+            "pages_extracted": stream.pages_read,
+            "truncated": stream.truncated,
+        }
     )
 
 
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_W = f"{{{W_NS}}}"
+
+
+def _docx_heading_styles(zf: zipfile.ZipFile) -> Dict[str, int]:
+    """styleId -> уровень заголовка (по outlineLvl или имени "heading N"/"Title")"""
+    levels: Dict[str, int] = {}
+    try:
+        with zf.open("word/styles.xml") as f:
+            root = etree.parse(f).getroot()
+    except KeyError:
+        return levels
+    for style in root.iter(f"{_W}style"):
+        style_id = style.get(f"{_W}styleId")
+        if not style_id:
+            continue
+        outline = style.find(f"{_W}pPr/{_W}outlineLvl")
+        name_el = style.find(f"{_W}name")
+        name = (name_el.get(f"{_W}val") if name_el is not None else "") or ""
+        m = re.match(r"^heading\s*(\d)$", name.strip().lower())
+        if outline is not None and (outline.get(f"{_W}val") or "").isdigit():
+            level = int(outline.get(f"{_W}val")) + 1
+            if level <= 9:  # 9 = "body text"
+                levels[style_id] = level
+        elif m:
+            levels[style_id] = int(m.group(1))
+        elif name.strip().lower() == "title":
+            levels[style_id] = 1
+    return levels
+
+
+def iter_docx_paragraphs(data: bytes) -> Iterator[Tuple[str, Optional[int]]]:
+    """Потоково читает параграфы DOCX из памяти: (текст, уровень заголовка или None)
+
+    word/document.xml разбирается через iterparse, обработанные элементы
+    сразу удаляются из дерева — память не растет с размером документа.
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        heading_styles = _docx_heading_styles(zf)
+        with zf.open("word/document.xml") as f:
+            for _, p in etree.iterparse(f, events=("end",), tag=f"{_W}p", huge_tree=True):
+                parts: List[str] = []
+                for el in p.iter(f"{_W}t", f"{_W}tab", f"{_W}br", f"{_W}cr"):
+                    if el.tag == f"{_W}t":
+                        parts.append(el.text or "")
+                    elif el.tag == f"{_W}tab":
+                        parts.append("\t")
+                    else:
+                        parts.append("\n")
+
+                level: Optional[int] = None
+                ppr = p.find(f"{_W}pPr")
+                if ppr is not None:
+                    outline = ppr.find(f"{_W}outlineLvl")
+                    style = ppr.find(f"{_W}pStyle")
+                    if outline is not None and (outline.get(f"{_W}val") or "").isdigit():
+                        level = int(outline.get(f"{_W}val")) + 1
+                        level = level if level <= 9 else None
+                    elif style is not None:
+                        level = heading_styles.get(style.get(f"{_W}val") or "")
+
+                # Освобождаем разобранный параграф и уже обработанных соседей
+                p.clear()
+                parent = p.getparent()
+                if parent is not None:
+                    while p.getprevious() is not None:
+                        del parent[0]
+
+                text = "".join(parts).strip()
+                if text:
+                    yield text, level
+
+
 def canonical_from_docx_bytes(filename: str, data: bytes) -> Canonical:
-    """Создает canonical из DOCX файла"""
+    """Создает canonical из DOCX файла (в памяти, без временных файлов)"""
     anchors: List[Anchor] = []
     parts: List[str] = []
     cursor = 0
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".docx") as f:
-        f.write(data)
-        tmp_path = f.name
-
-    try:
-        text = Docx2txtLoader(tmp_path).load()[0].page_content or ""
-        paras = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
-        for i, p in enumerate(paras, start=1):
-            chunk = p if not parts else ("\n\n" + p)
-            start = cursor
-            parts.append(chunk)
-            cursor += len(chunk)
-            end = cursor
-            anchors.append(Anchor(
-                source_type="docx",
-                source_id=filename,
-                locator={"para": i},
-                start=start,
-                end=end
-            ))
-    finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+    for i, (p, level) in enumerate(iter_docx_paragraphs(data), start=1):
+        chunk = p if not parts else ("\n\n" + p)
+        start = cursor
+        parts.append(chunk)
+        cursor += len(chunk)
+        end = cursor
+        locator: Dict[str, Any] = {"para": i}
+        if level is not None:
+            locator["heading"] = level
+        anchors.append(Anchor(
+            source_type="docx",
+            source_id=filename,
+            locator=locator,
+            start=start,
+            end=end
+        ))
 
     return Canonical(
         original_text="".join(parts),
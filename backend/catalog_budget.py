@@ -0,0 +1,125 @@
+"""Сжатие каталога блоков под бюджет токенов промпта"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from backend.embeddings import BlockCatalog, BlockIndex
+from backend.tokens import count_tokens, count_tokens_batch
+
+# Блок считается крупным, если занимает >= 1% текста (как "size:" в каталоге)
+LARGE_BLOCK_SHARE = 0.01
+
+
+def fit_catalog_to_budget(
+    catalog: BlockCatalog,
+    index: BlockIndex,
+    max_tokens: int,
+    model: Optional[str] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """Рендерит каталог, ужатый до max_tokens токенов (tiktoken)
+
+    Заголовки и крупные блоки сохраняются всегда (пока хватает бюджета),
+    остаток бюджета делится между группами (groupId, для PDF — раздел под
+    заголовком) пропорционально их объему; внутри группы берутся абзацы,
+    ближайшие к центроиду эмбеддингов группы. Порядок строк не меняется.
+
+    Returns:
+        Tuple[catalog, stats]: текст каталога для промпта и статистика сжатия
+    """
+    block_ids = list(catalog.entries)
+    header = catalog.header_lines()
+    block_tokens = dict(zip(block_ids, count_tokens_batch(catalog.lines(block_ids), model)))
+    header_tokens = sum(t + 1 for t in count_tokens_batch(header, model))
+    # +1 токен на перевод строки; разделители групп не учитываем
+    total_tokens = header_tokens + sum(t + 1 for t in block_tokens.values())
+
+    stats: Dict[str, Any] = {
+        "tokens": total_tokens,
+        "budget_tokens": max_tokens,
+        "compressed_tokens": total_tokens,
+        "ratio": 1.0,
+        "blocks_total": len(block_ids),
+        "blocks_kept": len(block_ids),
+    }
+    if max_tokens <= 0 or total_tokens <= max_tokens:
+        return catalog.render(), stats
+
+    keep = set()
+    # Служебные строки (пропорции групп) + запас под строку-пояснение о сжатии
+    used = header_tokens + 40
+
+    def take(bid: int, limit: int) -> int:
+        """Добавляет блок, если его строка влезает в limit; возвращает ее стоимость"""
+        nonlocal used
+        cost = block_tokens[bid] + 1
+        if bid in keep or used + cost > limit:
+            return 0
+        keep.add(bid)
+        used += cost
+        return cost
+
+    # Разбираем блоки: заголовки, крупные блоки и остальные по группам
+    pos_of = {bid: p for p, bid in enumerate(index.block_ids)}
+    large_threshold = LARGE_BLOCK_SHARE * index.total_length
+    headers: List[int] = []
+    large: List[Tuple[int, int]] = []
+    groups: Dict[Any, List[int]] = {}
+    section = None
+    for bid, entry in catalog.entries.items():
+        if entry.is_header:
+            headers.append(bid)
+            section = bid
+            continue
+        p = pos_of.get(bid)
+        if p is None:
+            continue
+        if entry.length >= large_threshold:
+            large.append((entry.length, bid))
+            continue
+        key = entry.group_id if entry.group_id is not None else ("section", section)
+        groups.setdefault(key, []).append(p)
+
+    for bid in headers:
+        take(bid, max_tokens)
+    for _, bid in sorted(large, reverse=True):
+        take(bid, max_tokens)
+
+    # Остаток бюджета — представительные абзацы групп
+    remaining = max(0, max_tokens - used)
+    group_lengths = {key: int(index.lengths[ps].sum()) for key, ps in groups.items()}
+    total_group_length = sum(group_lengths.values()) or 1
+    leftovers: List[Tuple[int, int, int]] = []  # (ранг в группе, -объем группы, id блока)
+    for key, positions in sorted(groups.items(), key=lambda kv: -group_lengths[kv[0]]):
+        vecs = index.rows(positions)
+        centroid = vecs.mean(axis=0)
+        order = np.argsort(-(vecs @ centroid), kind="stable")
+        group_budget = remaining * group_lengths[key] / total_group_length
+        spent = 0
+        for rank, j in enumerate(order):
+            bid = index.block_ids[positions[j]]
+            cost = block_tokens[bid] + 1
+            # Хотя бы один абзац от каждой группы, если влезает в общий бюджет
+            if spent + cost <= group_budget or spent == 0:
+                spent += take(bid, max_tokens)
+            else:
+                leftovers.append((rank, -group_lengths[key], bid))
+    # Неизрасходованный бюджет добираем следующими по рангу абзацами
+    for _, _, bid in sorted(leftovers):
+        if used >= max_tokens:
+            break
+        take(bid, max_tokens)
+
+    compressed = "\n".join([
+        f"NOTE: catalog is sampled to fit the prompt: {len(keep)} of {len(block_ids)} blocks shown "
+        f"(all headers and large blocks, representative paragraphs of each group).",
+        catalog.render(keep),
+    ])
+
+    compressed_tokens = count_tokens(compressed, model)
+    stats.update({
+        "compressed_tokens": compressed_tokens,
+        "ratio": round(compressed_tokens / max(1, total_tokens), 3),
+        "blocks_kept": len(keep),
+    })
+    return compressed, stats
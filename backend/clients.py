@@ -0,0 +1,142 @@
+"""Общие для приложения LLM и embedding клиенты с пулом соединений"""
+
+import os
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import httpx
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from backend.completion_cache import CachedChatModel, CompletionCache
+from backend.embedding_cache import EmbeddingCache, CachedEmbeddings
+from backend.scheduler import RateLimitScheduler, ScheduledChatModel, ScheduledEmbeddings
+
+logger = logging.getLogger(__name__)
+
+ChatClient = Union[CachedChatModel, ScheduledChatModel]
+
+
+@dataclass
+class ClientSettings:
+    """Модели по стадиям пайплайна и параметры пула HTTP соединений"""
+    tree_model: str = "gpt-4o-mini"
+    tree_temperature: float = 0.02
+    leaf_model: str = "gpt-4o-mini"
+    leaf_temperature: float = 0.02
+    leaf_max_tokens: int = 200
+    cluster_model: str = "gpt-4o-mini"
+    cluster_temperature: float = 0.01
+    embedding_model: str = "text-embedding-3-small"
+    # Укороченные (Matryoshka) эмбеддинги text-embedding-3-*; None — полная размерность модели
+    embedding_dimensions: Optional[int] = None
+    max_connections: int = 100
+    max_keepalive: int = 20
+    keepalive_expiry_s: float = 30.0
+    timeout_s: float = 120.0
+    warmup: bool = True
+    warmup_connections: int = 4
+
+    @classmethod
+    def from_env(cls) -> "ClientSettings":
+        return cls(
+            tree_model=os.getenv("LLM_TREE_MODEL", cls.tree_model),
+            tree_temperature=float(os.getenv("LLM_TREE_TEMPERATURE", cls.tree_temperature)),
+            leaf_model=os.getenv("LLM_LEAF_MODEL", cls.leaf_model),
+            leaf_temperature=float(os.getenv("LLM_LEAF_TEMPERATURE", cls.leaf_temperature)),
+            leaf_max_tokens=int(os.getenv("LLM_LEAF_MAX_TOKENS", cls.leaf_max_tokens)),
+            cluster_model=os.getenv("LLM_CLUSTER_MODEL", cls.cluster_model),
+            cluster_temperature=float(os.getenv("LLM_CLUSTER_TEMPERATURE", cls.cluster_temperature)),
+            embedding_model=os.getenv("EMBEDDING_MODEL", cls.embedding_model),
+            embedding_dimensions=int(os.getenv("EMBEDDING_DIMENSIONS", "0")) or None,
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", cls.max_connections)),
+            max_keepalive=int(os.getenv("OPENAI_MAX_KEEPALIVE", cls.max_keepalive)),
+            keepalive_expiry_s=float(os.getenv("OPENAI_KEEPALIVE_EXPIRY_S", cls.keepalive_expiry_s)),
+            timeout_s=float(os.getenv("OPENAI_TIMEOUT_S", cls.timeout_s)),
+            warmup=os.getenv("OPENAI_WARMUP", "1") not in ("0", "false", "no"),
+            warmup_connections=int(os.getenv("OPENAI_WARMUP_CONNECTIONS", cls.warmup_connections)),
+        )
+
+
+@dataclass
+class AppClients:
+    """Клиенты, переиспользуемые всеми запросами (создаются в lifespan)"""
+    llm_tree: ChatClient
+    llm_leaf: ChatClient
+    llm_cluster: ChatClient
+    emb: CachedEmbeddings
+    chat_scheduler: Optional[RateLimitScheduler] = None
+    embedding_scheduler: Optional[RateLimitScheduler] = None
+    http_client: Optional[httpx.Client] = None
+    http_async_client: Optional[httpx.AsyncClient] = None
+    warmup_connections: int = 0
+
+    async def warm_up(self) -> None:
+        """Заранее открывает TLS соединения к API, чтобы первые запросы их не ждали"""
+        if self.http_async_client is None or self.warmup_connections <= 0:
+            return
+        base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+        headers = {"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY', '')}"}
+        results = await asyncio.gather(
+            *(self.http_async_client.get(f"{base_url}/models", headers=headers)
+              for _ in range(self.warmup_connections)),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            logger.warning(f"[CLIENTS] Warm-up failed for {len(errors)} connection(s): {errors[0]}")
+
+    async def aclose(self) -> None:
+        if self.http_async_client is not None:
+            await self.http_async_client.aclose()
+        if self.http_client is not None:
+            self.http_client.close()
+
+
+def create_clients(settings: ClientSettings, embedding_cache: EmbeddingCache,
+                   completion_cache: Optional[CompletionCache] = None) -> AppClients:
+    """Создает клиентов поверх общих httpx пулов (sync и async)
+
+    Все вызовы идут через общие для процесса планировщики (chat и embeddings);
+    повторы при 429 делает планировщик, поэтому встроенные ретраи SDK отключены.
+    Кэш ответов LLM стоит перед планировщиком: попадания не ждут лимитов.
+    """
+    limits = httpx.Limits(
+        max_connections=settings.max_connections,
+        max_keepalive_connections=settings.max_keepalive,
+        keepalive_expiry=settings.keepalive_expiry_s,
+    )
+    timeout = httpx.Timeout(settings.timeout_s, connect=10.0)
+    http_client = httpx.Client(limits=limits, timeout=timeout)
+    http_async_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+    pools = {"http_client": http_client, "http_async_client": http_async_client, "max_retries": 0}
+
+    chat_scheduler = RateLimitScheduler.from_env("chat", rpm=5000, tpm=4_000_000)
+    embedding_scheduler = RateLimitScheduler.from_env("embedding", rpm=5000, tpm=5_000_000)
+
+    def chat(**kwargs) -> ChatClient:
+        llm = ScheduledChatModel(ChatOpenAI(**kwargs, **pools), chat_scheduler)
+        return CachedChatModel(llm, completion_cache) if completion_cache is not None else llm
+
+    return AppClients(
+        llm_tree=chat(model=settings.tree_model, temperature=settings.tree_temperature),
+        llm_leaf=chat(
+            model=settings.leaf_model,
+            temperature=settings.leaf_temperature,
+            max_tokens=settings.leaf_max_tokens,
+        ),
+        llm_cluster=chat(model=settings.cluster_model, temperature=settings.cluster_temperature),
+        emb=CachedEmbeddings(
+            ScheduledEmbeddings(
+                OpenAIEmbeddings(model=settings.embedding_model, dimensions=settings.embedding_dimensions, **pools),
+                embedding_scheduler,
+            ),
+            embedding_cache,
+        ),
+        chat_scheduler=chat_scheduler,
+        embedding_scheduler=embedding_scheduler,
+        http_client=http_client,
+        http_async_client=http_async_client,
+        warmup_connections=settings.warmup_connections if settings.warmup else 0,
+    )
@@ -1,6 +1,7 @@
 """Кластеризация текстовых чанков"""
 
 import math
+import asyncio
 import numpy as np
 from typing import Dict, List
 
@@ -34,8 +35,13 @@ def cluster_chunks(vectors: np.ndarray, k: int) -> np.ndarray:
     return km.fit_predict(vectors)
 
 
-def label_clusters(llm: ChatOpenAI, chunks: List[Document], assignments: np.ndarray, k: int) -> Dict[int, str]:
-    """Генерирует метки для кластеров с помощью LLM"""
+async def cluster_chunks_async(vectors: np.ndarray, k: int) -> np.ndarray:
+    """Кластеризация в отдельном потоке, чтобы не блокировать event loop"""
+    return await asyncio.to_thread(cluster_chunks, vectors, k)
+
+
+def build_cluster_labels_prompt(chunks: List[Document], assignments: np.ndarray, k: int) -> str:
+    """Строит промпт для генерации меток кластеров"""
     reps = []
     for cid in range(k):
         idxs = np.where(assignments == cid)[0][:3]
@@ -45,13 +51,24 @@ def label_clusters(llm: ChatOpenAI, chunks: List[Document], assignments: np.ndar
         )
         reps.append(f"CLUSTER {cid} SAMPLES:\n{sample}")
 
-    prompt = (
+    return (
         "Give a short topic (2-6 words) for each cluster in ENGLISH ONLY. "
         "CRITICAL: Write ONLY in English, regardless of the source text language. "
         "Translate all topics to English. This is mandatory.\n\n"
         + "\n\n".join(reps)
     )
 
+
+def label_clusters(llm: ChatOpenAI, chunks: List[Document], assignments: np.ndarray, k: int) -> Dict[int, str]:
+    """Генерирует метки для кластеров с помощью LLM"""
+    prompt = build_cluster_labels_prompt(chunks, assignments, k)
     res: ClusterLabels = llm.with_structured_output(ClusterLabels).invoke(prompt)
     return {x.cluster_id: x.topic for x in res.labels}
 
+
+async def label_clusters_async(llm: ChatOpenAI, chunks: List[Document], assignments: np.ndarray, k: int) -> Dict[int, str]:
+    """Асинхронная версия генерации меток для кластеров"""
+    prompt = build_cluster_labels_prompt(chunks, assignments, k)
+    res: ClusterLabels = await llm.with_structured_output(ClusterLabels).ainvoke(prompt)
+    return {x.cluster_id: x.topic for x in res.labels}
+
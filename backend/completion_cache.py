@@ -0,0 +1,255 @@
+"""Кэш ответов LLM в SQLite (SQLAlchemy): ключ — модель, параметры и сообщения"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+import xxhash
+from langchain_core.messages import AIMessage
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import (
+    Column, Float, Integer, MetaData, String, Table, Text, create_engine, delete, event, func, insert,
+    select, update,
+)
+from sqlalchemy.exc import SQLAlchemyError
+
+from backend.metrics import COMPLETION_CACHE_REQUESTS
+from backend.tracing import current_stage
+
+logger = logging.getLogger(__name__)
+
+_metadata = MetaData()
+completions = Table(
+    "completions",
+    _metadata,
+    Column("key", String(32), primary_key=True),
+    Column("model", String(128), nullable=False),
+    Column("value", Text, nullable=False),
+    Column("created_at", Float, nullable=False, index=True),
+    Column("used_at", Float, nullable=False, index=True),
+    Column("hits", Integer, nullable=False, default=0),
+)
+
+
+def _message_dict(m: Any) -> Dict[str, Any]:
+    if isinstance(m, dict):
+        return {"role": m.get("role"), "content": m.get("content")}
+    if isinstance(m, (tuple, list)) and len(m) == 2:
+        return {"role": m[0], "content": m[1]}
+    return {"role": getattr(m, "type", type(m).__name__), "content": getattr(m, "content", str(m))}
+
+
+def completion_key(model: str, params: Dict[str, Any], messages: Any, schema: Optional[str] = None) -> str:
+    """xxh3-128 от модели, параметров генерации, схемы structured output и сообщений"""
+    if isinstance(messages, str):
+        msgs = [{"role": "human", "content": messages}]
+    else:
+        msgs = [_message_dict(m) for m in messages]
+    body = {"model": model, "params": params, "schema": schema, "messages": msgs}
+    raw = json.dumps(body, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return xxhash.xxh3_128_hexdigest(raw.encode("utf-8"))
+
+
+class CompletionCache:
+    """Персистентный кэш ответов: TTL + вытеснение давно не используемых записей
+
+    Число записей проверяется раз в evict_every вставок, лишние (по used_at)
+    удаляются одним запросом. Ошибки SQLite не ломают пайплайн — вызов
+    просто уходит в API.
+    """
+
+    def __init__(self, path: str, ttl_s: float = 7 * 86400, max_items: int = 100_000,
+                 evict_every: int = 100):
+        self.path = path
+        self.ttl_s = ttl_s
+        self.max_items = max(1, max_items)
+        self.evict_every = max(1, evict_every)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+        @event.listens_for(self.engine, "connect")
+        def _pragmas(dbapi_conn, _):
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.close()
+
+        _metadata.create_all(self.engine)
+
+    @classmethod
+    def from_env(cls) -> Optional["CompletionCache"]:
+        """LLM_CACHE_PATH="" отключает кэш"""
+        path = os.getenv("LLM_CACHE_PATH", ".cache/completions.sqlite")
+        if not path:
+            return None
+        try:
+            return cls(
+                path=path,
+                ttl_s=float(os.getenv("LLM_CACHE_TTL_S", str(7 * 86400))),
+                max_items=int(os.getenv("LLM_CACHE_MAX_ITEMS", "100000")),
+            )
+        except (OSError, SQLAlchemyError) as e:
+            logger.warning(f"[LLM_CACHE] Disabled, cannot open {path}: {e}")
+            return None
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        try:
+            with self.engine.begin() as conn:
+                row = conn.execute(
+                    select(completions.c.value, completions.c.created_at).where(completions.c.key == key)
+                ).first()
+                if row is None:
+                    return None
+                if self.ttl_s > 0 and now - row.created_at > self.ttl_s:
+                    conn.execute(delete(completions).where(completions.c.key == key))
+                    return None
+                conn.execute(
+                    update(completions).where(completions.c.key == key)
+                    .values(used_at=now, hits=completions.c.hits + 1)
+                )
+                return row.value
+        except SQLAlchemyError as e:
+            logger.warning(f"[LLM_CACHE] Read failed: {e}")
+            return None
+
+    def put(self, key: str, model: str, value: str) -> None:
+        now = time.time()
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    insert(completions).prefix_with("OR REPLACE")
+                    .values(key=key, model=model, value=value, created_at=now, used_at=now, hits=0)
+                )
+            with self._lock:
+                self._puts += 1
+                evict = self._puts % self.evict_every == 0
+            if evict:
+                self.evict()
+        except SQLAlchemyError as e:
+            logger.warning(f"[LLM_CACHE] Write failed: {e}")
+
+    def evict(self) -> int:
+        """Удаляет просроченные записи и самые старые по used_at сверх max_items"""
+        removed = 0
+        with self.engine.begin() as conn:
+            if self.ttl_s > 0:
+                removed += conn.execute(
+                    delete(completions).where(completions.c.created_at < time.time() - self.ttl_s)
+                ).rowcount
+            count = conn.execute(select(func.count()).select_from(completions)).scalar_one()
+            excess = count - self.max_items
+            if excess > 0:
+                oldest = select(completions.c.key).order_by(completions.c.used_at).limit(excess)
+                removed += conn.execute(delete(completions).where(completions.c.key.in_(oldest))).rowcount
+        self.evictions += removed
+        return removed
+
+    def record(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        COMPLETION_CACHE_REQUESTS.labels(current_stage(), "hit" if hit else "miss").inc()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        self.engine.dispose()
+
+
+class CachedChatModel:
+    """Обертка над ScheduledChatModel: попадание в кэш не занимает ни слот планировщика, ни сеть
+
+    Обычные ответы хранятся как текст AIMessage, structured output —
+    как JSON модели pydantic (model_dump) и восстанавливаются по схеме.
+    """
+
+    def __init__(self, llm, cache: CompletionCache, schema: Optional[type] = None,
+                 model: Optional[str] = None, params: Optional[Dict[str, Any]] = None):
+        self.llm = llm
+        self.cache = cache
+        self.schema = schema
+        self.model = model or getattr(llm, "model_name", None) or getattr(llm, "model", None) or ""
+        self.params = params if params is not None else {
+            "temperature": getattr(llm, "temperature", None),
+            "max_tokens": getattr(llm, "max_tokens", None),
+        }
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def with_structured_output(self, schema, **kwargs) -> "CachedChatModel":
+        params = {**self.params, **{k: v for k, v in kwargs.items() if isinstance(v, (str, int, float, bool))}}
+        return CachedChatModel(self.llm.with_structured_output(schema, **kwargs), self.cache, schema,
+                               model=self.model, params=params)
+
+    def _key(self, messages: Any, kwargs: Dict[str, Any]) -> str:
+        params = {**self.params, **kwargs} if kwargs else self.params
+        schema = f"{self.schema.__module__}.{self.schema.__qualname__}" if self.schema else None
+        return completion_key(self.model, params, messages, schema)
+
+    def _encode(self, result: Any) -> Optional[str]:
+        if self.schema is None:
+            content = getattr(result, "content", None)
+            return json.dumps({"content": content}, ensure_ascii=False) if isinstance(content, str) else None
+        if isinstance(result, BaseModel):
+            return result.model_dump_json()
+        try:
+            return json.dumps(result, ensure_ascii=False)
+        except TypeError:
+            return None
+
+    def _decode(self, value: str) -> Any:
+        try:
+            if self.schema is None:
+                return AIMessage(content=json.loads(value)["content"])
+            if isinstance(self.schema, type) and issubclass(self.schema, BaseModel):
+                return self.schema.model_validate_json(value)
+            return json.loads(value)
+        except (ValueError, KeyError, TypeError, ValidationError):
+            # Схема поменялась или запись битая — считаем промахом
+            return None
+
+    async def ainvoke(self, input: Any, config: Any = None, **kwargs) -> Any:
+        key = self._key(input, kwargs)
+        value = await asyncio.to_thread(self.cache.get, key)
+        result = self._decode(value) if value is not None else None
+        self.cache.record(result is not None)
+        if result is not None:
+            return result
+        result = await self.llm.ainvoke(input, config, **kwargs)
+        encoded = self._encode(result)
+        if encoded is not None:
+            await asyncio.to_thread(self.cache.put, key, self.model, encoded)
+        return result
+
+    def invoke(self, input: Any, config: Any = None, **kwargs) -> Any:
+        key = self._key(input, kwargs)
+        value = self.cache.get(key)
+        result = self._decode(value) if value is not None else None
+        self.cache.record(result is not None)
+        if result is not None:
+            return result
+        result = self.llm.invoke(input, config, **kwargs)
+        encoded = self._encode(result)
+        if encoded is not None:
+            self.cache.put(key, self.model, encoded)
+        return result
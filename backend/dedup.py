@@ -0,0 +1,107 @@
+"""Схлопывание повторяющихся блоков перед эмбеддингами: точные дубли (xxhash) и почти-дубли (MinHash)"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+from backend.canonical import content_hash, normalize_ws
+from backend.models import PopupBlock
+
+
+@dataclass
+class DedupResult:
+    """Блоки-представители (в исходном порядке) и число схлопнутых дублей"""
+    blocks: List[PopupBlock]
+    total: int = 0
+    exact: int = 0
+    near: int = 0
+
+    def stats(self) -> Dict[str, float]:
+        removed = self.exact + self.near
+        return {
+            "blocks_total": self.total,
+            "blocks_kept": len(self.blocks),
+            "exact_duplicates": self.exact,
+            "near_duplicates": self.near,
+            "ratio": round(removed / self.total, 4) if self.total else 0.0,
+        }
+
+
+def _is_header(b: PopupBlock) -> bool:
+    # Одинаковые заголовки ("Examples", "Summary") в разных разделах несут структуру
+    tag = (b.tag or "").lower()
+    return b.blockType == "header" or tag in ("h1", "h2", "h3", "h4", "h5", "h6") or tag.startswith("pdf_h")
+
+
+class MinHasher:
+    """MinHash сигнатуры по символьным шинглам (полиномиальный хэш окна, numpy)"""
+
+    def __init__(self, num_perm: int = 64, shingle: int = 5, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.shingle = shingle
+        self.a = rng.integers(1, 1 << 61, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 61, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, text: str) -> np.ndarray:
+        data = np.frombuffer(text.lower().encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+        k = self.shingle
+        if len(data) < k:
+            return np.unique(data.sum(keepdims=True))
+        h = np.zeros(len(data) - k + 1, dtype=np.uint64)
+        for j in range(k):
+            # Переполнение uint64 — часть хэша
+            h = h * np.uint64(1099511628211) + data[j:len(data) - k + 1 + j]
+        return np.unique(h)
+
+    def signature(self, text: str) -> np.ndarray:
+        sh = self.shingles(text)
+        # Универсальное хэширование a*x+b, старшие 32 бита
+        return ((self.a[:, None] * sh[None, :] + self.b[:, None]) >> np.uint64(32)).min(axis=1)
+
+
+def dedup_blocks(blocks: List[PopupBlock], near_threshold: Optional[float] = 0.9,
+                 min_near_chars: int = 40, num_perm: int = 64, bands: int = 8) -> DedupResult:
+    """Оставляет первый блок из каждой группы дублей
+
+    Точные дубли — одинаковый content_hash. Почти-дубли — оценка Жаккара по
+    MinHash не ниже near_threshold (кандидаты ищутся LSH по bands полосам);
+    проверяются только тексты не короче min_near_chars. Заголовки не
+    схлопываются. near_threshold=None — только точные дубли.
+    """
+    result = DedupResult(blocks=[], total=len(blocks))
+    seen: Set[int] = set()  # хэши представителей и уже схлопнутых почти-дублей
+    hasher = MinHasher(num_perm=num_perm) if near_threshold is not None else None
+    rows = max(1, num_perm // bands)
+    buckets: Dict[tuple, List[int]] = {}
+    signatures: List[np.ndarray] = []  # сигнатуры представителей
+
+    for b in blocks:
+        text = normalize_ws(b.text or "")
+        if b.block is None or not text or _is_header(b):
+            result.blocks.append(b)
+            continue
+
+        h = content_hash(text)
+        if h in seen:
+            result.exact += 1
+            continue
+
+        if hasher is not None and len(text) >= min_near_chars:
+            sig = hasher.signature(text)
+            keys = [(i, sig[i * rows:(i + 1) * rows].tobytes()) for i in range(bands)]
+            candidates = sorted({c for key in keys for c in buckets.get(key, ())})
+            if candidates:
+                sims = (np.stack([signatures[c] for c in candidates]) == sig).mean(axis=1)
+                if np.max(sims) >= near_threshold:
+                    seen.add(h)
+                    result.near += 1
+                    continue
+            for key in keys:
+                buckets.setdefault(key, []).append(len(signatures))
+            signatures.append(sig)
+
+        seen.add(h)
+        result.blocks.append(b)
+
+    return result
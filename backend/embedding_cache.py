@@ -0,0 +1,278 @@
+"""Кэш эмбеддингов: LRU в памяти + memory-mapped хранилище на диске"""
+
+import os
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import xxhash
+
+from backend.canonical import normalize_ws
+
+logger = logging.getLogger(__name__)
+
+
+def embedding_key(namespace: str, text: str) -> int:
+    """Ключ кэша: xxh3-64 от имени модели и нормализованного текста"""
+    key = xxhash.xxh3_64_intdigest(f"{namespace}\x00{normalize_ws(text)}".encode("utf-8"))
+    return key or 1  # 0 зарезервирован под пустой слот на диске
+
+
+class DiskVectorStore:
+    """Хранилище векторов фиксированной размерности в memory-mapped .npy файлах
+
+    keys.npy (uint64) — ключ в слоте (0 = пусто), ticks.npy (uint64) — время
+    последнего обращения для вытеснения, vectors.npy (float32, capacity x dim).
+    Каталог принадлежит одному процессу.
+    """
+
+    def __init__(self, path: str, dim: int, capacity: int):
+        os.makedirs(path, exist_ok=True)
+        self.dim = dim
+        self.capacity = max(1, capacity)
+        self.evictions = 0
+
+        keys_path = os.path.join(path, "keys.npy")
+        ticks_path = os.path.join(path, "ticks.npy")
+        vecs_path = os.path.join(path, "vectors.npy")
+
+        reuse = all(os.path.exists(p) for p in (keys_path, ticks_path, vecs_path))
+        if reuse:
+            keys = np.load(keys_path, mmap_mode="r+")
+            vecs = np.load(vecs_path, mmap_mode="r+")
+            reuse = keys.shape == (self.capacity,) and vecs.shape == (self.capacity, dim)
+        if reuse:
+            self.keys = keys
+            self.ticks = np.load(ticks_path, mmap_mode="r+")
+            self.vectors = vecs
+        else:
+            # Размер изменился (или файлов нет) — начинаем с чистого хранилища
+            open_memmap = np.lib.format.open_memmap
+            self.keys = open_memmap(keys_path, mode="w+", dtype=np.uint64, shape=(self.capacity,))
+            self.ticks = open_memmap(ticks_path, mode="w+", dtype=np.uint64, shape=(self.capacity,))
+            self.vectors = open_memmap(vecs_path, mode="w+", dtype=np.float32, shape=(self.capacity, dim))
+
+        used = np.nonzero(self.keys)[0]
+        self.slots: Dict[int, int] = {int(self.keys[i]): int(i) for i in used}
+        self.free: List[int] = sorted(set(range(self.capacity)) - set(self.slots.values()), reverse=True)
+        self.tick = int(self.ticks.max()) if len(used) else 0
+
+    def get(self, key: int) -> Optional[np.ndarray]:
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        self.tick += 1
+        self.ticks[slot] = self.tick
+        return np.array(self.vectors[slot], dtype=np.float32)
+
+    def put(self, key: int, vec: np.ndarray) -> None:
+        self.put_many([key], np.asarray(vec, dtype=np.float32)[None, :])
+
+    def put_many(self, keys: Sequence[int], vecs: np.ndarray) -> None:
+        """Записывает пачку векторов; жертвы вытеснения выбираются одним проходом по ticks"""
+        # Повторный ключ — последний вектор; пачка больше хранилища — последние векторы
+        rows = list({int(key): i for i, key in enumerate(keys)}.items())[-self.capacity:]
+        if not rows:
+            return
+        slots = np.empty(len(rows), dtype=np.int64)
+        new: List[int] = []
+        for j, (key, _) in enumerate(rows):
+            slot = self.slots.get(key)
+            if slot is None and self.free:
+                slot = self.slots[key] = self.free.pop()
+            if slot is None:
+                new.append(j)
+            else:
+                slots[j] = slot
+        if new:
+            # Вытесняем давно не использованные слоты, кроме уже занятых этой пачкой
+            ticks = np.array(self.ticks)
+            taken = np.ones(len(rows), dtype=bool)
+            taken[new] = False
+            ticks[slots[taken]] = np.iinfo(np.uint64).max
+            victims = np.argpartition(ticks, len(new) - 1)[:len(new)]
+            for j, slot in zip(new, victims):
+                del self.slots[int(self.keys[slot])]
+                self.slots[rows[j][0]] = int(slot)
+                slots[j] = slot
+            self.evictions += len(new)
+
+        order = np.fromiter((i for _, i in rows), dtype=np.int64, count=len(rows))
+        self.vectors[slots] = vecs[order]
+        self.ticks[slots] = np.arange(self.tick + 1, self.tick + 1 + len(rows), dtype=np.uint64)
+        self.tick += len(rows)
+        # Сначала векторы, потом ключи: при падении слоты останутся пустыми
+        self.keys[slots] = np.fromiter((key for key, _ in rows), dtype=np.uint64, count=len(rows))
+
+    def flush(self) -> None:
+        for arr in (self.vectors, self.ticks, self.keys):
+            arr.flush()
+
+
+class EmbeddingCache:
+    """Двухуровневый кэш векторов: LRU в памяти процесса и диск (mmap float32)"""
+
+    def __init__(self, memory_items: int = 10000, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 512 * 1024 * 1024):
+        self.memory_items = max(0, memory_items)
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self._memory: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._disk: Dict[int, DiskVectorStore] = {}  # dim -> хранилище
+        self._lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions_memory = 0
+        self.open_disk()
+
+    @classmethod
+    def from_env(cls) -> "EmbeddingCache":
+        return cls(
+            memory_items=int(os.getenv("EMB_CACHE_MEMORY_ITEMS", "10000")),
+            disk_dir=os.getenv("EMB_CACHE_DIR", ".cache/embeddings"),
+            disk_max_bytes=int(os.getenv("EMB_CACHE_MAX_MB", "512")) * 1024 * 1024,
+        )
+
+    def _disk_store(self, dim: int) -> Optional[DiskVectorStore]:
+        if not self.disk_dir:
+            return None
+        store = self._disk.get(dim)
+        if store is None:
+            capacity = self.disk_max_bytes // (dim * 4 + 16)
+            try:
+                store = DiskVectorStore(os.path.join(self.disk_dir, f"d{dim}"), dim, capacity)
+            except OSError as e:
+                logger.warning(f"[EMB] Disk cache disabled: {e}")
+                self.disk_dir = None
+                return None
+            self._disk[dim] = store
+        return store
+
+    def _remember(self, key: int, vec: np.ndarray) -> None:
+        if self.memory_items == 0:
+            return
+        self._memory[key] = vec
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+            self.evictions_memory += 1
+
+    def get_many(self, keys: Sequence[int]) -> List[Optional[np.ndarray]]:
+        """Возвращает векторы по ключам (None для промахов)"""
+        out: List[Optional[np.ndarray]] = []
+        with self._lock:
+            for key in keys:
+                vec = self._memory.get(key)
+                if vec is not None:
+                    self._memory.move_to_end(key)
+                    self.hits_memory += 1
+                    out.append(vec)
+                    continue
+                for store in self._disk.values():
+                    vec = store.get(key)
+                    if vec is not None:
+                        break
+                if vec is not None:
+                    self._remember(key, vec)
+                    self.hits_disk += 1
+                else:
+                    self.misses += 1
+                out.append(vec)
+        return out
+
+    def put_many(self, keys: Sequence[int], vecs: np.ndarray) -> None:
+        """Сохраняет векторы в оба уровня кэша"""
+        if len(keys) == 0:
+            return
+        with self._lock:
+            store = self._disk_store(int(vecs.shape[1]))
+            for key, vec in zip(keys, vecs):
+                self._remember(key, vec)
+            if store is not None:
+                store.put_many(keys, vecs)
+
+    def open_disk(self) -> None:
+        """Подключает уже существующие на диске хранилища (после рестарта)"""
+        if not self.disk_dir or not os.path.isdir(self.disk_dir):
+            return
+        for name in os.listdir(self.disk_dir):
+            if name.startswith("d") and name[1:].isdigit():
+                self._disk_store(int(name[1:]))
+
+    def flush(self) -> None:
+        with self._lock:
+            for store in self._disk.values():
+                store.flush()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "memory_items": len(self._memory),
+                "disk_items": sum(len(s.slots) for s in self._disk.values()),
+                "evictions_memory": self.evictions_memory,
+                "evictions_disk": sum(s.evictions for s in self._disk.values()),
+            }
+
+
+class CachedEmbeddings:
+    """Обертка над OpenAIEmbeddings: в API уходят только промахи кэша
+
+    Возвращает строки float32 массивов вместо списков float — все вызывающие
+    функции все равно собирают их в np.ndarray.
+    """
+
+    def __init__(self, emb, cache: EmbeddingCache):
+        self.emb = emb
+        self.cache = cache
+        dims = getattr(emb, "dimensions", None)
+        self.namespace = f"{getattr(emb, 'model', '')}:{dims or ''}"
+
+    def __getattr__(self, name):
+        return getattr(self.emb, name)
+
+    def _lookup(self, texts: List[str]) -> Tuple[List[int], List[Optional[np.ndarray]], List[str], List[int]]:
+        keys = [embedding_key(self.namespace, t) for t in texts]
+        found = self.cache.get_many(keys)
+        # Уникальные промахи в порядке появления
+        miss_texts: List[str] = []
+        miss_keys: List[int] = []
+        seen = set()
+        for key, text, vec in zip(keys, texts, found):
+            if vec is None and key not in seen:
+                seen.add(key)
+                miss_keys.append(key)
+                miss_texts.append(text)
+        return keys, found, miss_texts, miss_keys
+
+    def _merge(self, keys: List[int], found: List[Optional[np.ndarray]],
+               miss_keys: List[int], miss_vecs) -> List[np.ndarray]:
+        if miss_keys:
+            fresh = np.asarray(miss_vecs, dtype=np.float32)
+            self.cache.put_many(miss_keys, fresh)
+            by_key = dict(zip(miss_keys, fresh))
+            found = [vec if vec is not None else by_key[key] for key, vec in zip(keys, found)]
+        return found
+
+    def embed_documents(self, texts: List[str]) -> List[np.ndarray]:
+        keys, found, miss_texts, miss_keys = self._lookup(texts)
+        miss_vecs = self.emb.embed_documents(miss_texts) if miss_texts else []
+        return self._merge(keys, found, miss_keys, miss_vecs)
+
+    async def aembed_documents(self, texts: List[str]) -> List[np.ndarray]:
+        # Хэши и чтение/запись mmap на больших документах — вне event loop
+        keys, found, miss_texts, miss_keys = await asyncio.to_thread(self._lookup, texts)
+        miss_vecs = await self.emb.aembed_documents(miss_texts) if miss_texts else []
+        return await asyncio.to_thread(self._merge, keys, found, miss_keys, miss_vecs)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text: str) -> np.ndarray:
+        return (await self.aembed_documents([text]))[0]
@@ -1,204 +1,423 @@
 """Эмбеддинги и работа с блоками"""
 
+import asyncio
 import numpy as np
-from typing import List, Tuple
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from backend.ann import IVFIndex
 from backend.models import PopupBlock
-from backend.canonical import normalize_ws
-
-
-def cosine_top_k(query_vec: np.ndarray, mat: np.ndarray, k: int) -> List[int]:
-    """Находит top-k наиболее похожих векторов по cosine similarity"""
-    # query_vec: (d,), mat: (n,d)
-    # cosine similarity assuming embeddings already roughly normalized, но нормализуем на всякий
-    q = query_vec / (np.linalg.norm(query_vec) + 1e-9)
-    M = mat / (np.linalg.norm(mat, axis=1, keepdims=True) + 1e-9)
-    sims = M @ q
-    k = max(1, min(k, len(sims)))
-    top = np.argpartition(-sims, k-1)[:k]
-    top = top[np.argsort(-sims[top])]
-    return top.tolist()
-
-
-def build_block_catalog(blocks: List[PopupBlock], max_snippet_chars: int = 240, is_pdf: bool = False) -> str:
-    """Строит каталог блоков для передачи в LLM с учетом пропорций объемов"""
-    lines = []
-    current_group = None
-    
-    # Вычисляем длину каждого блока и общую длину
-    block_lengths = {}
-    total_length = 0
-    for b in blocks:
-        if b.block is None:
-            continue
-        txt = normalize_ws(b.text or "")
-        if not txt:
-            continue
-        length = len(txt)
-        block_lengths[b.block] = length
-        total_length += length
-    
-    # Группируем блоки по группам и вычисляем пропорции
-    group_lengths = {}
-    for b in blocks:
-        if b.block is None:
-            continue
-        txt = normalize_ws(b.text or "")
-        if not txt:
-            continue
-        group_id = b.groupId if b.groupId is not None else 0
-        if group_id not in group_lengths:
-            group_lengths[group_id] = 0
-        group_lengths[group_id] += block_lengths.get(b.block, 0)
-    
-    # Вычисляем пропорции для каждой группы (в процентах)
-    group_proportions = {}
-    if total_length > 0:
-        for group_id, length in group_lengths.items():
-            proportion = (length / total_length) * 100
-            group_proportions[group_id] = proportion
-    
-    # Добавляем информацию о пропорциях в начало каталога
-    if group_proportions and len(group_proportions) > 1:
-        proportion_info = []
-        sorted_groups = sorted(group_proportions.items(), key=lambda x: x[1], reverse=True)
-        for group_id, prop in sorted_groups[:5]:  # Топ-5 групп по объему
-            proportion_info.append(f"Group {group_id}: {prop:.1f}%")
-        if proportion_info:
-            lines.append(f"DOCUMENT STRUCTURE PROPORTIONS: {' | '.join(proportion_info)}")
-            lines.append("IMPORTANT: The number of leaves and detail level for each section should reflect these proportions.")
-            lines.append("")
-    
-    for b in blocks:
-        bid = b.block
-        if bid is None:
-            continue
-        txt = normalize_ws(b.text or "")
-        if not txt:
-            continue
-        
-        # Для PDF используем структурированный формат с метаданными
-        if is_pdf:
-            tag = b.tag or 'pdf_paragraph'
-            block_type = b.blockType
-            level = b.level or 0
-            section_number = b.sectionNumber
-            style = b.style
-            font_size = b.fontSize
-            
-            # Определяем префикс на основе типа блока
-            prefix = ""
-            if tag and tag.startswith("pdf_h"):
-                header_level = tag.replace("pdf_h", "")
-                prefix = f"[HEADER L{header_level}]"
-            elif tag == "pdf_list":
-                prefix = "[LIST]"
-            elif block_type == "header":
-                prefix = f"[HEADER L{level}]" if level > 0 else "[HEADER]"
-            elif block_type == "list":
-                prefix = "[LIST]"
+from backend.canonical import content_hash, normalize_ws
+from backend.tokens import get_encoding
+
+
+VECTOR_PRECISIONS = ("float32", "float16", "int8")
+
+
+class BlockIndex:
+    """Индекс блоков документа для поиска по cosine similarity
+
+    Строится один раз на документ: L2-нормализованная матрица, id блоков и
+    их нормализованные тексты/длины. top_k отвечает сразу на пачку запросов
+    одним матричным произведением.
+
+    precision задает хранение матрицы: float32 (как есть), float16 или int8
+    со своим масштабом на каждый вектор (в 2 и 4 раза меньше памяти). Поиск
+    идет по сжатой матрице кусками по chunk_rows строк, полная float32 копия
+    не создается.
+
+    Начиная с ann_min_blocks блоков (0 — никогда) top_k идет через IVF
+    индекс (строится при первом запросе) и пересчитывает только nprobe
+    ближайших списков; на маленьких документах поиск точный. При построении
+    IVF строки матрицы переставляются по спискам; снаружи позиции остаются
+    прежними (порядок block_ids).
+    """
+
+    def __init__(self, vectors: np.ndarray, block_ids: List[int], texts: List[str],
+                 precision: str = "float32", chunk_rows: int = 4096,
+                 ann_min_blocks: int = 0, nprobe: int = 8, nlist: int = 0):
+        if precision not in VECTOR_PRECISIONS:
+            raise ValueError(f"unknown vector precision: {precision}")
+        mat = np.ascontiguousarray(vectors, dtype=np.float32)
+        if mat.ndim != 2:
+            mat = mat.reshape(len(block_ids), -1)
+        # Нормализуем на месте, без временной копии всей матрицы
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        norms += 1e-9
+        mat /= norms
+        self.precision = precision
+        self.chunk_rows = max(1, chunk_rows)
+        self.scales: Optional[np.ndarray] = None
+        if precision == "float16":
+            mat = mat.astype(np.float16)
+        elif precision == "int8":
+            scales = np.abs(mat).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            mat /= scales[:, None]
+            mat = np.rint(mat, out=mat).astype(np.int8)
+            self.scales = scales.astype(np.float32)
+        self.matrix = mat
+        self.block_ids = list(block_ids)
+        self.texts = texts
+        self.lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+        self.total_length = int(self.lengths.sum())
+        self.ann_min_blocks = ann_min_blocks
+        self.nprobe = nprobe
+        self.nlist = nlist
+        self._ann: Optional[IVFIndex] = None
+        # Строка хранилища -> позиция и обратно; None — строки в порядке block_ids
+        self._order: Optional[np.ndarray] = None
+        self._where: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_blocks(cls, vectors: np.ndarray, block_ids: List[int], blocks: List[PopupBlock],
+                    precision: str = "float32", **kwargs) -> "BlockIndex":
+        """Собирает индекс из результата embed_blocks(_async) и исходных блоков"""
+        texts = []
+        for b in blocks:
+            if b.block is None:
+                continue
+            t = normalize_ws(b.text or "")
+            if t:
+                texts.append(t)
+        assert len(texts) == len(block_ids), "vectors and blocks are not aligned"
+        return cls(vectors, block_ids, texts, precision=precision, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.block_ids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    @property
+    def storage_positions(self) -> np.ndarray:
+        """Позиция индекса для каждой строки matrix (и scales)"""
+        return self._order if self._order is not None else np.arange(len(self.block_ids))
+
+    def _stored_rows(self, rows) -> np.ndarray:
+        out = self.matrix[rows].astype(np.float32)
+        if self.scales is not None:
+            out *= self.scales[rows][..., None]
+        return out
+
+    def rows(self, positions) -> np.ndarray:
+        """Нормализованные векторы float32 для позиций (или среза) индекса"""
+        if self._where is not None:
+            positions = self._where[positions]
+        return self._stored_rows(positions)
+
+    @property
+    def uses_ann(self) -> bool:
+        """Нужен ли документу IVF (строится явно через build_ann)"""
+        return 0 < self.ann_min_blocks <= len(self.block_ids)
+
+    def build_ann(self) -> IVFIndex:
+        """Обучает IVF и переставляет строки хранилища по спискам
+
+        Дорого (порядка тысячи точных запросов на 50k блоков): вызывать вне
+        event loop и только когда запросов ожидается много.
+        """
+        if self._ann is None:
+            n = len(self.block_ids)
+            ivf, perm = IVFIndex.build(n, self._stored_rows, nlist=self.nlist, chunk_rows=self.chunk_rows)
+            self.matrix = self.matrix[perm]
+            if self.scales is not None:
+                self.scales = self.scales[perm]
+            self._order = self.storage_positions[perm]
+            self._where = np.empty(n, dtype=np.int64)
+            self._where[self._order] = np.arange(n)
+            self._ann = ivf
+        return self._ann
+
+    def _scores(self, q: np.ndarray, start: int, end: int) -> np.ndarray:
+        block = self.matrix[start:end]
+        if block.dtype != np.float32:
+            block = block.astype(np.float32)
+        sims = q @ block.T
+        if self.scales is not None:
+            sims *= self.scales[start:end]
+        return sims
+
+    def top_k(self, queries: np.ndarray, k: int, batch_size: int = 256, exact: bool = False) -> np.ndarray:
+        """Top-k блоков для каждого запроса
+
+        Args:
+            queries: (d,) или (n_queries, d) — векторы запросов (нормализовать не нужно)
+            k: сколько блоков вернуть на запрос
+            exact: точный поиск, даже если IVF построен
+
+        Returns:
+            Массив (n_queries, k) позиций в индексе, по убыванию сходства
+        """
+        Q = np.asarray(queries, dtype=np.float32)
+        if Q.ndim == 1:
+            Q = Q[None, :]
+        n = len(self.block_ids)
+        k = max(1, min(k, n))
+        ann = self._ann
+        if exact or ann is None:
+            return self._exact_top_k(Q, k, batch_size)
+
+        out = np.empty((Q.shape[0], k), dtype=np.int64)
+        for s in range(0, Q.shape[0], batch_size):
+            q = Q[s:s + batch_size]
+            q = q / (np.linalg.norm(q, axis=1, keepdims=True) + 1e-9)
+            found = ann.search(q, k, self.nprobe, self._scores)
+            # В пробах оказалось меньше k блоков — для этих запросов точный поиск
+            short = np.nonzero((found < 0).any(axis=1))[0]
+            found = self._order[found]
+            if len(short):
+                found[short] = self._exact_top_k(q[short], k, batch_size)
+            out[s:s + batch_size] = found
+        return out
+
+    def _exact_top_k(self, Q: np.ndarray, k: int, batch_size: int) -> np.ndarray:
+        n = len(self.block_ids)
+        out = np.empty((Q.shape[0], k), dtype=np.int64)
+        # Пачками, чтобы матрица сходства (batch x chunk_rows) оставалась небольшой
+        for s in range(0, Q.shape[0], batch_size):
+            q = Q[s:s + batch_size]
+            q = q / (np.linalg.norm(q, axis=1, keepdims=True) + 1e-9)
+            best_idx = np.empty((q.shape[0], 0), dtype=np.int64)
+            best_val = np.empty((q.shape[0], 0), dtype=np.float32)
+            for start in range(0, n, self.chunk_rows):
+                end = min(n, start + self.chunk_rows)
+                sims = self._scores(q, start, end)
+                idx = np.broadcast_to(np.arange(start, end), sims.shape)
+                # Кандидаты куска + лучшие из прошлых кусков, оставляем k
+                vals = np.concatenate([best_val, sims], axis=1)
+                idx = np.concatenate([best_idx, idx], axis=1)
+                if vals.shape[1] > k:
+                    top = np.argpartition(-vals, k - 1, axis=1)[:, :k]
+                    vals = np.take_along_axis(vals, top, axis=1)
+                    idx = np.take_along_axis(idx, top, axis=1)
+                best_val, best_idx = vals, idx
+            order = np.argsort(-best_val, axis=1, kind="stable")
+            out[s:s + batch_size] = np.take_along_axis(best_idx, order, axis=1)
+        return self._order[out] if self._order is not None else out
+
+
+def _pdf_prefix(b: PopupBlock) -> str:
+    """Префикс строки каталога для PDF блока (тип + метаданные структуры)"""
+    tag = b.tag or 'pdf_paragraph'
+    block_type = b.blockType
+    level = b.level or 0
+
+    # Определяем префикс на основе типа блока
+    if tag and tag.startswith("pdf_h"):
+        header_level = tag.replace("pdf_h", "")
+        prefix = f"[HEADER L{header_level}]"
+    elif tag == "pdf_list":
+        prefix = "[LIST]"
+    elif block_type == "header":
+        prefix = f"[HEADER L{level}]" if level > 0 else "[HEADER]"
+    elif block_type == "list":
+        prefix = "[LIST]"
+    else:
+        prefix = "[PARAGRAPH]"
+
+    # Добавляем метаданные к префиксу
+    meta_parts = []
+    if b.sectionNumber:
+        meta_parts.append(f"§{b.sectionNumber}")
+    if b.style and b.style != "normal":
+        meta_parts.append(b.style)
+    if b.fontSize:
+        meta_parts.append(f"font:{b.fontSize:.1f}")
+
+    if meta_parts:
+        prefix += " " + " ".join(meta_parts)
+    return prefix + " "
+
+
+def _web_prefix(b: PopupBlock) -> str:
+    """Префикс строки каталога для блока веб-страницы"""
+    block_type = b.blockType or "paragraph"
+    level = b.level
+
+    # Определяем префикс на основе типа блока
+    if block_type == "header" and level:
+        prefix = f"[HEADER L{level}]"
+    elif block_type == "list":
+        prefix = "[LIST]"
+    elif block_type == "table":
+        prefix = "[TABLE]"
+        # Для таблиц добавляем информацию о структуре
+        if b.tableHeaders:
+            prefix += f" cols:{len(b.tableHeaders)}"
+    elif block_type == "code":
+        prefix = "[CODE]"
+    elif block_type == "definition":
+        prefix = "[DEFINITION]"
+    else:
+        prefix = "[PARAGRAPH]"
+
+    # Добавляем метаданные
+    meta_parts = []
+    if b.parentTag and b.parentTag not in ["body", "html", "div"]:
+        meta_parts.append(f"parent:{b.parentTag}")
+    if b.sectionLevel:
+        meta_parts.append(f"section:{b.sectionLevel}")
+    if b.visualWeight and b.visualWeight > 16:  # только если заметно больше базового
+        meta_parts.append(f"weight:{b.visualWeight:.1f}")
+
+    if meta_parts:
+        prefix += " " + " ".join(meta_parts)
+    return prefix + " "
+
+
+@dataclass
+class CatalogEntry:
+    """Блок в каталоге: префикс строки без пропорций, сниппет и объем"""
+    block_id: int
+    prefix: str
+    snippet: str
+    length: int
+    group_id: Optional[int]
+    is_header: bool = False
+    plain: bool = False         # заголовок группы: без group_size/size
+
+
+class BlockCatalog:
+    """Каталог блоков для передачи в LLM
+
+    Строится за один проход по блокам; строки рендерятся лениво (пропорции
+    групп известны только после прохода) и кэшируются. Позволяет получить
+    строку, длину и долю группы по id блока и отрендерить любое подмножество.
+    """
+
+    def __init__(self, is_pdf: bool = False):
+        self.is_pdf = is_pdf
+        self.entries: Dict[int, CatalogEntry] = {}
+        self.total_length = 0
+        self.group_lengths: Dict[int, int] = {}
+        self._group_proportions: Optional[Dict[int, float]] = None
+        self._lines: Dict[int, str] = {}
+
+    @classmethod
+    def from_blocks(cls, blocks: List[PopupBlock], max_snippet_chars: int = 240,
+                    is_pdf: bool = False) -> "BlockCatalog":
+        catalog = cls(is_pdf)
+        current_group = None
+        for b in blocks:
+            bid = b.block
+            if bid is None:
+                continue
+            txt = normalize_ws(b.text or "")
+            if not txt:
+                continue
+            length = len(txt)
+            catalog.total_length += length
+            group_key = b.groupId if b.groupId is not None else 0
+            catalog.group_lengths[group_key] = catalog.group_lengths.get(group_key, 0) + length
+
+            entry = CatalogEntry(bid, "", txt[:max_snippet_chars], length, b.groupId,
+                                 is_header=b.blockType == "header" or (b.tag or "").startswith("pdf_h"))
+            if is_pdf:
+                entry.prefix = _pdf_prefix(b)
             else:
-                prefix = "[PARAGRAPH]"
-            
-            # Добавляем метаданные к префиксу
-            meta_parts = []
-            if section_number:
-                meta_parts.append(f"§{section_number}")
-            if style and style != "normal":
-                meta_parts.append(style)
-            if font_size:
-                meta_parts.append(f"font:{font_size:.1f}")
-            
-            if meta_parts:
-                prefix += " " + " ".join(meta_parts)
-            prefix += " "
-            
-            snippet = txt[:max_snippet_chars]
-            # Добавляем информацию о длине блока (в символах) для контекста
-            block_len = block_lengths.get(bid, 0)
-            if block_len > 0 and total_length > 0:
-                block_prop = (block_len / total_length) * 100
-                # Добавляем информацию о пропорции только для больших блоков (>1% текста)
-                if block_prop > 1.0:
-                    prefix += f" size:{block_prop:.1f}%"
-            lines.append(f"[b{bid}] {prefix}{snippet}")
-        else:
-            # Для веб-страниц используем метаданные структуры
-            block_type = b.blockType or "paragraph"
-            level = b.level
-            parent_tag = b.parentTag
-            section_level = b.sectionLevel
-            visual_weight = b.visualWeight
-            group_id = b.groupId
-            
-            # Группируем блоки по группам
-            if group_id is not None and group_id != current_group:
+                group_id = b.groupId
+                # Группируем блоки по группам
+                if group_id is not None and group_id != current_group:
+                    current_group = group_id
+                    # Если это заголовок группы, добавляем его отдельно
+                    if b.blockType == "header" and b.level:
+                        prefix = f"[HEADER L{b.level}]"
+                        if b.sectionLevel:
+                            prefix += f" section:{b.sectionLevel}"
+                        if b.visualWeight:
+                            prefix += f" weight:{b.visualWeight:.1f}"
+                        entry.prefix = prefix + " "
+                        entry.plain = True
+                if not entry.plain:
+                    entry.prefix = _web_prefix(b)
+            catalog.entries[bid] = entry
+        return catalog
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, block_id: int) -> bool:
+        return block_id in self.entries
+
+    def __str__(self) -> str:
+        return self.render()
+
+    @property
+    def group_proportions(self) -> Dict[int, float]:
+        """Доля каждой группы в тексте документа (в процентах)"""
+        if self._group_proportions is None:
+            self._group_proportions = {}
+            if self.total_length > 0:
+                for group_id, length in self.group_lengths.items():
+                    self._group_proportions[group_id] = (length / self.total_length) * 100
+        return self._group_proportions
+
+    def group_proportion(self, block_id: int) -> float:
+        group_id = self.entries[block_id].group_id
+        return self.group_proportions.get(group_id if group_id is not None else 0, 0)
+
+    def length(self, block_id: int) -> int:
+        return self.entries[block_id].length
+
+    def header_lines(self) -> List[str]:
+        """Служебные строки с пропорциями групп (начало каталога)"""
+        if len(self.group_proportions) <= 1:
+            return []
+        sorted_groups = sorted(self.group_proportions.items(), key=lambda x: x[1], reverse=True)
+        proportion_info = [f"Group {group_id}: {prop:.1f}%" for group_id, prop in sorted_groups[:5]]  # Топ-5 групп
+        return [
+            f"DOCUMENT STRUCTURE PROPORTIONS: {' | '.join(proportion_info)}",
+            "IMPORTANT: The number of leaves and detail level for each section should reflect these proportions.",
+            "",
+        ]
+
+    def line(self, block_id: int) -> str:
+        """Строка каталога для блока"""
+        line = self._lines.get(block_id)
+        if line is None:
+            e = self.entries[block_id]
+            prefix = e.prefix
+            if not e.plain:
+                # Пропорция группы для больших групп (>5% текста), только для веб-страниц
+                if not self.is_pdf:
+                    group_prop = self.group_proportion(block_id)
+                    if group_prop > 5.0:
+                        prefix += f" group_size:{group_prop:.1f}%"
+                # Длина блока для больших блоков (>1% текста)
+                if e.length > 0 and self.total_length > 0:
+                    block_prop = (e.length / self.total_length) * 100
+                    if block_prop > 1.0:
+                        prefix += f" size:{block_prop:.1f}%"
+            line = f"[b{block_id}] {prefix}{e.snippet}"
+            self._lines[block_id] = line
+        return line
+
+    def lines(self, block_ids: Iterable[int]) -> List[str]:
+        """Строки для блоков в заданном порядке (неизвестные id пропускаются)"""
+        return [self.line(bid) for bid in block_ids if bid in self.entries]
+
+    def render(self, block_ids: Optional[Iterable[int]] = None) -> str:
+        """Текст каталога в порядке документа: все блоки или только block_ids
+
+        Служебные строки и разделители групп сохраняются.
+        """
+        selected = None if block_ids is None else set(block_ids)
+        out = self.header_lines()
+        current_group = None
+        for bid, e in self.entries.items():
+            if selected is not None and bid not in selected:
+                continue
+            if not self.is_pdf and e.group_id is not None and e.group_id != current_group:
                 if current_group is not None:
-                    lines.append("")  # разделитель между группами
-                current_group = group_id
-                # Если это заголовок группы, добавляем его отдельно
-                if block_type == "header" and level:
-                    header_text = txt[:max_snippet_chars]
-                    prefix = f"[HEADER L{level}]"
-                    if section_level:
-                        prefix += f" section:{section_level}"
-                    if visual_weight:
-                        prefix += f" weight:{visual_weight:.1f}"
-                    lines.append(f"[b{bid}] {prefix} {header_text}")
-                    continue
-            
-            # Определяем префикс на основе типа блока
-            prefix = ""
-            if block_type == "header" and level:
-                prefix = f"[HEADER L{level}]"
-            elif block_type == "list":
-                prefix = "[LIST]"
-            elif block_type == "table":
-                prefix = "[TABLE]"
-                # Для таблиц добавляем информацию о структуре
-                if b.tableHeaders:
-                    prefix += f" cols:{len(b.tableHeaders)}"
-            elif block_type == "code":
-                prefix = "[CODE]"
-            elif block_type == "definition":
-                prefix = "[DEFINITION]"
-            else:
-                prefix = "[PARAGRAPH]"
-            
-            # Добавляем метаданные
-            meta_parts = []
-            if parent_tag and parent_tag not in ["body", "html", "div"]:
-                meta_parts.append(f"parent:{parent_tag}")
-            if section_level:
-                meta_parts.append(f"section:{section_level}")
-            if visual_weight and visual_weight > 16:  # только если заметно больше базового
-                meta_parts.append(f"weight:{visual_weight:.1f}")
-            
-            if meta_parts:
-                prefix += " " + " ".join(meta_parts)
-            prefix += " "
-            
-            snippet = txt[:max_snippet_chars]
-            # Добавляем информацию о длине блока и пропорции группы
-            block_len = block_lengths.get(bid, 0)
-            group_id = b.groupId if b.groupId is not None else 0
-            group_prop = group_proportions.get(group_id, 0)
-            
-            # Добавляем информацию о пропорции группы для больших групп (>5% текста)
-            if group_prop > 5.0:
-                prefix += f" group_size:{group_prop:.1f}%"
-            # Добавляем информацию о длине блока для больших блоков (>1% текста)
-            if block_len > 0 and total_length > 0:
-                block_prop = (block_len / total_length) * 100
-                if block_prop > 1.0:
-                    prefix += f" size:{block_prop:.1f}%"
-            lines.append(f"[b{bid}] {prefix}{snippet}")
-    
-    return "\n".join(lines)
+                    out.append("")  # разделитель между группами
+                current_group = e.group_id
+            out.append(self.line(bid))
+        return "\n".join(out)
 
 
 def embed_blocks(blocks: List[PopupBlock], emb: OpenAIEmbeddings) -> Tuple[np.ndarray, List[int]]:
@@ -217,8 +436,13 @@ def embed_blocks(blocks: List[PopupBlock], emb: OpenAIEmbeddings) -> Tuple[np.nd
     return np.array(vecs, dtype=np.float32), ids
 
 
-async def embed_blocks_async(blocks: List[PopupBlock], emb: OpenAIEmbeddings) -> Tuple[np.ndarray, List[int]]:
-    """Асинхронная версия создания эмбеддингов для блоков"""
+async def embed_blocks_async(blocks: List[PopupBlock], emb: OpenAIEmbeddings,
+                             known: Optional[Dict[int, np.ndarray]] = None) -> Tuple[np.ndarray, List[int]]:
+    """Асинхронная версия создания эмбеддингов для блоков
+
+    known — готовые векторы по хэшу содержимого (content_hash), например из
+    снимка прошлого запуска; в API уходят только остальные блоки.
+    """
     texts = []
     ids = []
     for b in blocks:
@@ -228,31 +452,166 @@ async def embed_blocks_async(blocks: List[PopupBlock], emb: OpenAIEmbeddings) ->
         if not t:
             continue
         ids.append(int(b.block))
-        texts.append(t[:4000])
-    vecs = await emb.aembed_documents(texts)
-    return np.array(vecs, dtype=np.float32), ids
+        texts.append(t)
+    if not known or not texts:
+        vecs = await emb.aembed_documents([t[:4000] for t in texts])
+        return np.array(vecs, dtype=np.float32), ids
+
+    found = [known.get(content_hash(t)) for t in texts]
+    missing = [i for i, v in enumerate(found) if v is None]
+    fresh = await emb.aembed_documents([texts[i][:4000] for i in missing]) if missing else []
+    for i, v in zip(missing, fresh):
+        found[i] = v
+    return np.array(found, dtype=np.float32), ids
+
+
+CHUNK_SEPARATORS = ("\n\n", "\n", " ")
+
+
+def _token_prefix_chars(text: str, max_tokens: int, enc) -> Tuple[int, int]:
+    """(число символов, число токенов) для максимального префикса text не длиннее max_tokens"""
+    if enc is None:
+        # tiktoken недоступен: ~4 символа на токен
+        n = min(len(text), max_tokens * 4)
+        return n, (n + 3) // 4
+    ids = enc.encode_ordinary(text)
+    if len(ids) <= max_tokens:
+        return len(text), len(ids)
+    # Неполный UTF-8 символ на границе отбрасываем
+    prefix = enc.decode_bytes(ids[:max_tokens]).decode("utf-8", errors="ignore")
+    return len(prefix), max_tokens
 
 
-def chunk_text(original_text: str) -> List[Document]:
-    """Разбивает текст на чанки"""
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=3000,
-        chunk_overlap=500,
-        add_start_index=True,
-        separators=["\n\n", "\n", " ", ""],
-    )
-    doc = Document(page_content=original_text)
-    chunks = splitter.split_documents([doc])
-
-    out: List[Document] = []
-    for i, ch in enumerate(chunks):
-        start = int(ch.metadata["start_index"])
-        end = start + len(ch.page_content)
-        out.append(Document(
-            page_content=ch.page_content,
+def _scan_chunk_spans(text: str, s: int, final: bool, chunk_tokens: int, overlap_tokens: int,
+                      enc) -> Iterator[Tuple[int, int, int]]:
+    """(start, end, next_s) чанков text, начиная с позиции s
+
+    final=False — text может быть дополнен: сканирование останавливается, как
+    только решение о границе зависит от еще не полученного текста, поэтому
+    спаны совпадают с разбиением целого документа.
+    """
+    n = len(text)
+    overlap_tokens = max(0, min(overlap_tokens, chunk_tokens // 2))
+    while s < n:
+        # Пропускаем пробелы в начале чанка
+        while s < n and text[s].isspace():
+            s += 1
+        if s >= n:
+            return
+
+        # Окно с запасом по символам; расширяем, если токенов не хватило
+        window = chunk_tokens * 6
+        while True:
+            if not final and s + window > n:
+                return
+            chars, tokens = _token_prefix_chars(text[s:s + window], chunk_tokens, enc)
+            if tokens >= chunk_tokens:
+                break
+            if s + window >= n:
+                if not final:
+                    return
+                break
+            window *= 2
+        end = s + chars
+        if not final and end >= n:
+            return
+
+        if end < n:
+            # Переносим границу на разделитель во второй половине чанка
+            lo = s + chars // 2
+            for sep in CHUNK_SEPARATORS:
+                pos = text.rfind(sep, lo, end)
+                if pos > s:
+                    end = pos
+                    break
+
+        e = end
+        while e > s and text[e - 1].isspace():
+            e -= 1
+        if end >= n:
+            if e > s:
+                yield s, e, n
+            return
+
+        # Перекрытие: последние overlap_tokens токенов (по средней длине токена в чанке)
+        chars_per_token = chars / max(1, tokens)
+        next_s = max(s + 1, end - int(overlap_tokens * chars_per_token))
+        if next_s < end:
+            # Начинаем перекрытие с начала слова
+            pos = text.find(" ", next_s, end)
+            next_s = pos + 1 if pos != -1 else next_s
+        next_s = max(s + 1, min(next_s, end))
+        if e > s:
+            yield s, e, next_s
+        s = next_s
+
+
+def iter_chunk_spans(text: str, chunk_tokens: int = 750, overlap_tokens: int = 125,
+                     model: Optional[str] = None) -> Iterator[Tuple[int, int]]:
+    """Генератор спанов (start, end) чанков в исходной строке, без копирования документа
+
+    Размер окна считается в токенах tiktoken; граница чанка переносится на
+    ближайший разделитель (абзац, строка, пробел) во второй половине окна.
+    Соседние чанки перекрываются примерно на overlap_tokens токенов.
+    """
+    enc = get_encoding(model)
+    for start, end, _ in _scan_chunk_spans(text, 0, True, chunk_tokens, overlap_tokens, enc):
+        yield start, end
+
+
+class StreamingChunker:
+    """Чанкинг текста, поступающего частями (например, страницами PDF)
+
+    feed() возвращает чанки, границы которых уже не зависят от продолжения;
+    в памяти держится только хвост текста после последней границы. Результат
+    совпадает с chunk_text от склеенного текста.
+    """
+
+    def __init__(self, chunk_tokens: int = 750, overlap_tokens: int = 125, model: Optional[str] = None):
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.enc = get_encoding(model)
+        self.chunks: List[Document] = []
+        self._buf = ""
+        self._base = 0  # смещение начала _buf в полном тексте
+
+    def _drain(self, final: bool) -> List[Document]:
+        out: List[Document] = []
+        s = 0
+        for start, end, s in _scan_chunk_spans(self._buf, 0, final, self.chunk_tokens, self.overlap_tokens, self.enc):
+            out.append(Document(
+                page_content=self._buf[start:end],
+                metadata={"chunk_id": f"c{len(self.chunks) + len(out)}",
+                          "start_index": self._base + start, "end_index": self._base + end}
+            ))
+        self._buf = self._buf[s:]
+        self._base += s
+        self.chunks.extend(out)
+        return out
+
+    def feed(self, text: str) -> List[Document]:
+        self._buf += text
+        return self._drain(final=False)
+
+    def finish(self) -> List[Document]:
+        """Дочанковывает хвост; возвращает все чанки"""
+        self._drain(final=True)
+        self._buf = ""
+        return self.chunks
+
+
+def iter_chunks(original_text: str, chunk_tokens: int = 750, overlap_tokens: int = 125) -> Iterator[Document]:
+    """Ленивая версия chunk_text"""
+    for i, (start, end) in enumerate(iter_chunk_spans(original_text, chunk_tokens, overlap_tokens)):
+        yield Document(
+            page_content=original_text[start:end],
             metadata={"chunk_id": f"c{i}", "start_index": start, "end_index": end}
-        ))
-    return out
+        )
+
+
+def chunk_text(original_text: str, chunk_tokens: int = 750, overlap_tokens: int = 125) -> List[Document]:
+    """Разбивает текст на чанки (~750 токенов с перекрытием ~125 токенов)"""
+    return list(iter_chunks(original_text, chunk_tokens, overlap_tokens))
 
 
 def embed_chunks(chunks: List[Document], emb: OpenAIEmbeddings) -> np.ndarray:
@@ -261,3 +620,19 @@ def embed_chunks(chunks: List[Document], emb: OpenAIEmbeddings) -> np.ndarray:
     vecs = emb.embed_documents(texts)
     return np.array(vecs, dtype=np.float32)
 
+
+async def embed_chunks_async(chunks: List[Document], emb: OpenAIEmbeddings,
+                             batch_size: int = 64, max_concurrency: int = 4) -> np.ndarray:
+    """Асинхронные эмбеддинги чанков: под-батчи отправляются параллельно"""
+    texts = [normalize_ws(c.page_content)[:4000] for c in chunks]
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def embed_batch(batch: List[str]):
+        async with semaphore:
+            return await emb.aembed_documents(batch)
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(*(embed_batch(b) for b in batches))
+    return np.array([v for vecs in results for v in vecs], dtype=np.float32)
@@ -0,0 +1,148 @@
+"""Асинхронные задачи генерации: ограниченная очередь + пул воркеров"""
+
+import os
+import time
+import uuid
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from backend.models import PopupPayload, MarkdownMindmapResponse
+
+logger = logging.getLogger(__name__)
+
+# runner(payload, on_event) -> ответ пайплайна
+JobRunner = Callable[[PopupPayload, Callable[[str, Dict[str, Any]], None]], Awaitable[MarkdownMindmapResponse]]
+
+
+class QueueFullError(Exception):
+    """Очередь задач заполнена"""
+
+
+@dataclass
+class Job:
+    id: str
+    payload: Optional[PopupPayload]
+    status: str = "queued"  # queued|running|done|failed
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    progress: Dict[str, Any] = field(default_factory=dict)
+    result: Optional[MarkdownMindmapResponse] = None
+    error: Optional[str] = None
+
+    def on_event(self, event: str, data: Dict[str, Any]) -> None:
+        """Обновляет прогресс по событиям пайплайна"""
+        if event == "topics":
+            self.progress["topics"] = {"done": True, "count": len(data.get("topics", []))}
+            self.progress["subtrees"] = {"done": 0, "total": len(data.get("topics", []))}
+        elif event == "subtree":
+            sub = self.progress.setdefault("subtrees", {"done": 0, "total": None})
+            sub["done"] += 1
+        elif event == "tree":
+            self.progress["tree"] = {"done": True}
+        elif event == "leaves":
+            self.progress["leaves"] = {"done": 0, "total": data.get("total")}
+        elif event == "leaf":
+            leaves = self.progress.setdefault("leaves", {"done": 0, "total": None})
+            leaves["done"] += 1
+
+    def to_dict(self, include_result: bool = True) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": self.progress,
+        }
+        if self.error:
+            out["error"] = self.error
+        if include_result and self.result is not None:
+            out["result"] = self.result.model_dump()
+        return out
+
+
+class JobManager:
+    """Очередь задач с пулом воркеров; результаты хранятся ttl_s секунд"""
+
+    def __init__(self, runner: JobRunner, workers: int = 2, queue_size: int = 100, ttl_s: float = 3600):
+        self.runner = runner
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.ttl_s = ttl_s
+        self.jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @classmethod
+    def from_env(cls, runner: JobRunner) -> "JobManager":
+        return cls(
+            runner,
+            workers=int(os.getenv("JOB_WORKERS", "2")),
+            queue_size=int(os.getenv("JOB_QUEUE_SIZE", "100")),
+            ttl_s=float(os.getenv("JOB_TTL_S", "3600")),
+        )
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _purge(self) -> None:
+        """Удаляет завершенные задачи старше TTL"""
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.ttl_s
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def submit(self, payload: PopupPayload) -> Job:
+        if self._queue is None:
+            raise RuntimeError("JobManager is not started")
+        self._purge()
+        job = Job(id=uuid.uuid4().hex, payload=payload)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError("job queue is full")
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._purge()
+        return self.jobs.get(job_id)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                job.result = await self.runner(job.payload, job.on_event)
+                job.status = "done" if job.result.ok else "failed"
+                if not job.result.ok:
+                    job.error = job.result.meta.get("error")
+            except asyncio.CancelledError:
+                job.status = "failed"
+                job.error = "cancelled"
+                raise
+            except Exception as e:
+                logger.error(f"[JOBS] Job {job.id} failed: {e}")
+                job.status = "failed"
+                job.error = f"Internal error: {str(e)}"
+            finally:
+                job.finished_at = time.time()
+                job.payload = None  # payload больше не нужен, освобождаем память
+                self._queue.task_done()
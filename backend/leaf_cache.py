@@ -0,0 +1,132 @@
+"""Семантический кэш текстов листьев: тот же набор блоков + близкий запрос -> готовый текст"""
+
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backend.canonical import content_hash
+from backend.metrics import LEAF_CACHE_REQUESTS
+
+_REF_RE = re.compile(r"(\s*)\[b(\d+)\]")
+_SLOT_RE = re.compile(r"\[b#(\d+)\]")
+
+LeafKey = Tuple[str, FrozenSet[int]]
+
+
+def ref_template(text: str, blocks: Sequence[Tuple[int, int]]) -> Tuple[FrozenSet[int], str]:
+    """Ссылки [bN] -> [b#i], где i — позиция хэша блока в отсортированном наборе
+
+    blocks — пары (номер блока, хэш содержимого). Возвращает (набор хэшей, шаблон);
+    ссылки на блоки вне blocks перевести некуда — они убираются.
+    """
+    order = sorted({h for _, h in blocks})
+    pos = {h: i for i, h in enumerate(order)}
+    slot_of = {bid: pos[h] for bid, h in blocks}
+    template = _REF_RE.sub(
+        lambda m: f"{m.group(1)}[b#{slot_of[int(m.group(2))]}]" if int(m.group(2)) in slot_of else "", text
+    )
+    return frozenset(order), template
+
+
+def fill_template(template: str, blocks: Sequence[Tuple[int, int]]) -> str:
+    """Обратно к ref_template: [b#i] -> [bN] для блоков текущего документа"""
+    order = sorted({h for _, h in blocks})
+    bid_of: Dict[int, int] = {}
+    for bid, h in blocks:
+        # Первый блок с данным содержимым получает ссылку
+        bid_of.setdefault(h, bid)
+    return _SLOT_RE.sub(lambda m: f"[b{bid_of[order[int(m.group(1))]]}]", template)
+
+
+class SemanticLeafCache:
+    """LRU кэш текстов листьев в памяти
+
+    Ключ — множество хэшей содержимого выбранных блоков (не их номеров: те же
+    абзацы на другой странице или в новой версии документа получают другие
+    bN). Внутри ключа хранится до per_key вариантов (вектор запроса, текст);
+    попадание — косинусная близость запроса не ниже threshold. Ссылки [bN]
+    хранятся как позиции в отсортированном списке хэшей и при выдаче
+    переводятся в номера блоков текущего документа.
+    """
+
+    def __init__(self, threshold: float = 0.92, max_items: int = 4096, per_key: int = 4):
+        self.threshold = threshold
+        self.max_items = max_items
+        self.per_key = max(1, per_key)
+        self._entries: "OrderedDict[LeafKey, List[Tuple[np.ndarray, str]]]" = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["SemanticLeafCache"]:
+        """LEAF_CACHE_MAX_ITEMS=0 отключает кэш"""
+        max_items = int(os.getenv("LEAF_CACHE_MAX_ITEMS", "4096"))
+        if max_items <= 0:
+            return None
+        return cls(
+            threshold=float(os.getenv("LEAF_CACHE_THRESHOLD", "0.92")),
+            max_items=max_items,
+            per_key=int(os.getenv("LEAF_CACHE_PER_KEY", "4")),
+        )
+
+    @staticmethod
+    def _hashed(blocks: Sequence[Tuple[int, str]]) -> List[Tuple[int, int]]:
+        return [(bid, content_hash(text)) for bid, text in blocks]
+
+    @staticmethod
+    def _unit(vec) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32).ravel()
+        n = float(np.linalg.norm(v))
+        return v / n if n > 0 else v
+
+    def lookup(self, namespace: str, blocks: Sequence[Tuple[int, str]], query_vec) -> Optional[str]:
+        """Текст листа со ссылками на блоки blocks или None"""
+        hashed = self._hashed(blocks)
+        key = (namespace, frozenset(h for _, h in hashed))
+        variants = self._entries.get(key)
+        text = None
+        if variants:
+            q = self._unit(query_vec)
+            sims = [float(v @ q) for v, _ in variants]
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                self._entries.move_to_end(key)
+                text = fill_template(variants[best][1], hashed)
+        self._record(text is not None)
+        return text
+
+    def store(self, namespace: str, blocks: Sequence[Tuple[int, str]], query_vec, text: str) -> None:
+        if self.max_items <= 0:
+            return
+        hashes, template = ref_template(text, self._hashed(blocks))
+        key = (namespace, hashes)
+        variants = self._entries.setdefault(key, [])
+        self._entries.move_to_end(key)
+        variants.append((self._unit(query_vec), template))
+        self._size += 1
+        if len(variants) > self.per_key:
+            variants.pop(0)
+            self._size -= 1
+        while self._size > self.max_items:
+            _, dropped = self._entries.popitem(last=False)
+            self._size -= len(dropped)
+
+    def _record(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        LEAF_CACHE_REQUESTS.labels("hit" if hit else "miss").inc()
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "items": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
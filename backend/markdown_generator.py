@@ -1,14 +1,19 @@
 """Генерация markdown для mind map"""
 
 import re
+import heapq
 import asyncio
 import numpy as np
 from dataclasses import dataclass
-from typing import Dict, List, Tuple, Optional
+from typing import Any, Callable, Dict, List, Tuple, Optional
 from urllib.parse import quote
 
 from langchain_openai import ChatOpenAI
 
+from backend.embeddings import BlockCatalog, BlockIndex
+from backend.leaf_cache import SemanticLeafCache
+from backend.page_snapshot import IncrementalRun
+from backend.tracing import stage
 from backend.prompts import (
     TREE_SYSTEM_PROMPT, 
     LEAF_SYSTEM_PROMPT, 
@@ -19,6 +24,10 @@ from backend.prompts import (
 )
 
 
+# Колбэк прогресса: (имя события, данные) — используется для стриминга (SSE)
+EventCallback = Callable[[str, Dict[str, Any]], None]
+
+
 @dataclass
 class Leaf:
     line_index: int           # индекс строки в markdown
@@ -66,41 +75,41 @@ async def generate_top_level_topics(llm: ChatOpenAI, title: str, catalog: str) -
     return topics, topic_importance
 
 
-async def filter_blocks_by_topic(
-    topic: str,
-    block_vecs: np.ndarray,
-    block_ids: List[int],
-    blocks: List,
-    catalog_lines: List[str],
+async def analyze_topics(
+    topics: List[str],
+    index: BlockIndex,
+    catalog: BlockCatalog,
     emb,
-    top_k: int = 15
-) -> str:
-    """Фильтрует блоки по релевантности теме через эмбеддинги"""
-    from backend.embeddings import cosine_top_k
-    from backend.canonical import normalize_ws
+    volume_k: int = 20,
+    filter_k: int = 15
+) -> Tuple[List[float], List[str], List[List[int]]]:
+    """Пакетный анализ тем: объемы и отфильтрованные каталоги для всех тем сразу
     
-    # Создаем эмбеддинг для темы (асинхронно)
-    topic_vec = np.array(await emb.aembed_query(topic), dtype=np.float32)
+    Один запрос эмбеддингов на все темы и одна матрица сходства темы×блоки
+    вместо двух aembed_query и двух поисков на каждую тему.
     
-    # Находим наиболее релевантные блоки
-    top_indices = cosine_top_k(topic_vec, block_vecs, k=top_k)
+    Returns:
+        Tuple[volumes, filtered_catalogs, filtered_block_ids]: объем каждой темы
+        в процентах, строки каталога, релевантные каждой теме, и номера этих
+        блоков (в порядке topics)
+    """
+    if not topics:
+        return [], [], []
     
-    # Создаем словарь block_id -> индекс в catalog_lines
-    block_id_to_catalog_line = {}
-    for line in catalog_lines:
-        match = re.search(r"\[b(\d+)\]", line)
-        if match:
-            bid = int(match.group(1))
-            block_id_to_catalog_line[bid] = line
+    topic_vecs = np.array(await emb.aembed_documents(topics), dtype=np.float32)
+    top = index.top_k(topic_vecs, k=max(volume_k, filter_k))
     
-    # Собираем релевантные строки каталога
-    relevant_lines = []
-    for idx in top_indices:
-        bid = block_ids[idx]
-        if bid in block_id_to_catalog_line:
-            relevant_lines.append(block_id_to_catalog_line[bid])
+    # Объем темы: суммарная длина top-volume_k блоков
+    if index.total_length > 0:
+        volume_top = top[:, :volume_k]
+        volumes = (index.lengths[volume_top].sum(axis=1) / index.total_length * 100).tolist()
+    else:
+        volumes = [0.0] * len(topics)
     
-    return "\n".join(relevant_lines)
+    filtered_ids = [[index.block_ids[idx] for idx in row] for row in top[:, :filter_k]]
+    filtered_catalogs = ["\n".join(catalog.lines(ids)) for ids in filtered_ids]
+    
+    return volumes, filtered_catalogs, filtered_ids
 
 
 def calculate_topic_quota(topic_volume_percent: float, detail_level: str = "medium") -> int:
@@ -127,39 +136,6 @@ def calculate_topic_quota(topic_volume_percent: float, detail_level: str = "medi
     return min(quota, 8)  # Максимум 8 подтем
 
 
-async def calculate_topic_volume(
-    topic: str,
-    block_vecs: np.ndarray,
-    block_ids: List[int],
-    blocks: List,
-    emb,
-    total_length: int
-) -> float:
-    """Вычисляет объем темы в процентах от общего документа"""
-    from backend.embeddings import cosine_top_k
-    from backend.canonical import normalize_ws
-    
-    if total_length == 0:
-        return 0.0
-    
-    # Создаем эмбеддинг для темы
-    topic_vec = np.array(await emb.aembed_query(topic), dtype=np.float32)
-    
-    # Находим релевантные блоки (берем больше для точности)
-    top_indices = cosine_top_k(topic_vec, block_vecs, k=min(20, len(block_ids)))
-    
-    # Суммируем длину релевантных блоков
-    topic_length = 0
-    for idx in top_indices:
-        bid = block_ids[idx]
-        block = next((b for b in blocks if b.block == bid), None)
-        if block:
-            txt = normalize_ws(block.text or "")
-            topic_length += len(txt)
-    
-    return (topic_length / total_length) * 100 if total_length > 0 else 0.0
-
-
 async def generate_subtree_for_topic(
     llm: ChatOpenAI,
     topic: str,
@@ -187,8 +163,8 @@ async def generate_subtree_for_topic(
     return response.content.strip()
 
 
-def generate_tree_markdown(llm: ChatOpenAI, title: str, catalog: str, is_pdf: bool = False) -> str:
-    """Генерирует markdown дерево из каталога блоков (старый метод - для обратной совместимости)"""
+def _tree_messages(title: str, catalog: str, is_pdf: bool) -> List[Dict[str, str]]:
+    """Промпт дерева целиком по каталогу блоков"""
     # Используем специальный промпт для PDF, если есть структурированные блоки
     system_prompt = TREE_SYSTEM_PROMPT
     if is_pdf and ("[HEADER" in catalog or "[LIST]" in catalog):
@@ -200,106 +176,149 @@ def generate_tree_markdown(llm: ChatOpenAI, title: str, catalog: str, is_pdf: bo
         system_prompt = WEB_TREE_SYSTEM_PROMPT
     
     user = f"Title: {title}\n\nBlocks:\n{catalog}\n"
-    md = llm.invoke([
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user},
-    ]).content
+    ]
+
+
+def generate_tree_markdown(llm: ChatOpenAI, title: str, catalog: str, is_pdf: bool = False) -> str:
+    """Генерирует markdown дерево из каталога блоков (старый метод - для обратной совместимости)"""
+    md = llm.invoke(_tree_messages(title, catalog, is_pdf)).content
+    return md.strip()
+
+
+async def generate_tree_markdown_async(llm: ChatOpenAI, title: str, catalog: str, is_pdf: bool = False) -> str:
+    """Асинхронная версия generate_tree_markdown"""
+    md = (await llm.ainvoke(_tree_messages(title, catalog, is_pdf))).content
     return md.strip()
 
 
 async def generate_tree_markdown_sequential(
     llm_tree: ChatOpenAI,
     title: str,
-    catalog: str,
-    block_vecs: np.ndarray,
-    block_ids: List[int],
-    blocks: List,
+    catalog: BlockCatalog,
+    index: BlockIndex,
     emb,
     is_pdf: bool = False,
-    detail_level: str = "medium"
+    detail_level: str = "medium",
+    max_concurrency: int = 4,
+    on_event: Optional[EventCallback] = None,
+    prompt_catalog: Optional[str] = None,
+    reuse: Optional[IncrementalRun] = None
 ) -> Tuple[str, Dict[str, float], Dict[str, int]]:
-    """Генерирует markdown дерево последовательно: сначала основные темы, потом подтемы для каждой
+    """Генерирует markdown дерево: сначала основные темы, потом подтемы для каждой
+    
+    Поддеревья тем генерируются параллельно (не более max_concurrency одновременно),
+    порядок тем в итоговом markdown сохраняется.
     
     Args:
         detail_level: "low", "medium", or "high" - уровень детализации
+        max_concurrency: максимальное число тем, обрабатываемых одновременно
+        on_event: колбэк прогресса, получает события "topics" и "subtree"
+        prompt_catalog: сжатый каталог для промптов по всему документу (темы и
+            fallback); полный catalog используется для подбора блоков тем
+        reuse: прошлый запуск той же страницы — темы и поддеревья с
+            неизменившимися блоками берутся оттуда
     """
-    from backend.canonical import normalize_ws
-    
-    # Вычисляем общую длину документа для расчета пропорций
-    total_length = 0
-    for b in blocks:
-        if b.block is not None:
-            txt = normalize_ws(b.text or "")
-            total_length += len(txt)
-    
+    prompt_catalog = prompt_catalog or catalog.render()
     # Шаг 1: Генерируем основные темы с оценкой важности
-    topics, topic_importance = await generate_top_level_topics(llm_tree, title, catalog)
+    with stage("topics"):
+        previous = reuse.previous_topics() if reuse is not None else None
+        if previous is not None:
+            topics, topic_importance = previous
+        else:
+            topics, topic_importance = await generate_top_level_topics(llm_tree, title, prompt_catalog)
+        if reuse is not None:
+            reuse.record_topics(topics, topic_importance)
     
     if not topics:
         # Fallback к старому методу, если не удалось выделить темы
-        tree_md = generate_tree_markdown(llm_tree, title, catalog, is_pdf)
+        with stage("tree_fallback"):
+            tree_md = await generate_tree_markdown_async(llm_tree, title, prompt_catalog, is_pdf)
         # Возвращаем пустые словари для fallback
         return tree_md, {}, {}
     
-    # Разбиваем каталог на строки для фильтрации
-    catalog_lines = catalog.splitlines()
-    
-    # Шаг 2: Вычисляем объемы тем и квоты на основе важности
-    topic_volumes = []
-    topic_quotas = []
-    for topic in topics:
-        volume = await calculate_topic_volume(
-            topic, block_vecs, block_ids, blocks, emb, total_length
+    if on_event:
+        # Скелет дерева уже можно показать пользователю
+        skeleton = "\n\n".join([f"# {title}"] + [f"## {t}" for t in topics])
+        on_event("topics", {
+            "topics": [{"title": t, "importance": topic_importance.get(t, 5)} for t in topics],
+            "markdown": skeleton,
+        })
+    
+    # Шаг 2: Объемы тем и релевантные блоки — одним пакетом для всех тем
+    with stage("topic_analysis"):
+        topic_volumes, filtered_catalogs, filtered_ids = await analyze_topics(
+            topics, index, catalog, emb,
+            volume_k=20, filter_k=15
         )
-        # Используем важность для корректировки квоты
-        importance = topic_importance.get(topic, 5)  # По умолчанию 5
-        # Комбинируем объем и важность: важность имеет больший вес
-        # Важность 10 → множитель 1.5, важность 1 → множитель 0.5
-        importance_multiplier = 0.5 + (importance / 10.0)  # От 0.6 до 1.5
-        base_quota = calculate_topic_quota(volume, detail_level)
-        # Применяем множитель важности
-        adjusted_quota = max(1, int(base_quota * importance_multiplier))
-        topic_volumes.append(volume)
-        topic_quotas.append(min(adjusted_quota, 10))  # Максимум 10 подтем
-    
-    # Шаг 3: Для каждой темы генерируем поддерево
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    
+    async def process_topic(i: int, topic: str, volume: float, filtered_catalog: str,
+                            block_ids: List[int]) -> Tuple[float, Optional[str]]:
+        async with semaphore:
+            # Квота подтем на основе объема и важности
+            # Используем важность для корректировки квоты
+            importance = topic_importance.get(topic, 5)  # По умолчанию 5
+            # Комбинируем объем и важность: важность имеет больший вес
+            # Важность 10 → множитель 1.5, важность 1 → множитель 0.5
+            importance_multiplier = 0.5 + (importance / 10.0)  # От 0.6 до 1.5
+            base_quota = calculate_topic_quota(volume, detail_level)
+            # Применяем множитель важности
+            quota = min(max(1, int(base_quota * importance_multiplier)), 10)  # Максимум 10 подтем
+            
+            # Шаг 3: Генерируем поддерево по релевантным блокам с учетом квоты
+            subtree = reuse.subtree(topic, block_ids, quota) if reuse is not None else None
+            if subtree is None and filtered_catalog:
+                subtree = await generate_subtree_for_topic(
+                    llm_tree,
+                    topic,
+                    filtered_catalog,
+                    volume,
+                    quota,
+                    detail_level,
+                    is_pdf
+                )
+            if reuse is not None:
+                reuse.record_subtree(topic, block_ids, quota, subtree)
+            if subtree is not None and on_event:
+                on_event("subtree", {"index": i, "topic": topic, "markdown": subtree})
+            return volume, subtree
+    
+    with stage("subtrees"):
+        results = await asyncio.gather(
+            *(process_topic(i, t, v, fc, ids)
+              for i, (t, v, fc, ids) in enumerate(zip(topics, topic_volumes, filtered_catalogs, filtered_ids))),
+            return_exceptions=True
+        )
+    
+    # Собираем markdown в исходном порядке тем
     result_lines = [f"# {title}", ""]
+    topic_volumes_dict = {}
+    topic_importance_dict = {}
     
-    for i, topic in enumerate(topics):
+    for topic, volume_estimate, result in zip(topics, topic_volumes, results):
+        if isinstance(result, Exception):
+            # Ошибка в одной теме не должна ломать остальные
+            print(f"[MM] Error generating subtree for topic '{topic}': {result}")
+            volume, subtree = volume_estimate, None
+        else:
+            volume, subtree = result
+        
         # Добавляем основную тему
         result_lines.append(f"## {topic}")
-        
-        # Фильтруем блоки по теме (асинхронно)
-        filtered_catalog = await filter_blocks_by_topic(
-            topic, block_vecs, block_ids, blocks, catalog_lines, emb, top_k=15
-        )
-        
-        if filtered_catalog:
-            # Генерируем поддерево для темы с учетом квоты
-            subtree = await generate_subtree_for_topic(
-                llm_tree, 
-                topic, 
-                filtered_catalog, 
-                topic_volumes[i],
-                topic_quotas[i],
-                detail_level,
-                is_pdf
-            )
-            
-            # Добавляем поддерево (уже содержит ### и -)
-            if subtree:
-                result_lines.append("")
-                result_lines.append(subtree)
-                result_lines.append("")
-        else:
+        # Добавляем поддерево (уже содержит ### и -)
+        if subtree:
+            result_lines.append("")
+            result_lines.append(subtree)
+            result_lines.append("")
+        elif subtree is None:
             # Если нет релевантных блоков, добавляем пустую строку
             result_lines.append("")
-    
-    # Создаем словарь объемов и важности тем для использования при отборе листьев
-    topic_volumes_dict = {}
-    topic_importance_dict = {}
-    for i, topic in enumerate(topics):
-        topic_volumes_dict[topic] = topic_volumes[i]
+        
+        # Объемы и важность тем для использования при отборе листьев
+        topic_volumes_dict[topic] = volume
         topic_importance_dict[topic] = topic_importance.get(topic, 5)
     
     return "\n".join(result_lines), topic_volumes_dict, topic_importance_dict
@@ -321,49 +340,6 @@ def ensure_block_refs(text: str, chosen_ids: List[int]) -> str:
     return (text_wo + " " + refs).strip()
 
 
-def extract_leaves(md: str) -> List[Leaf]:
-    """Извлекает листья из markdown"""
-    lines = md.splitlines()
-    ctx: List[str] = []
-    leaves: List[Leaf] = []
-
-    for i, line in enumerate(lines):
-        s = line.strip()
-        if not s:
-            continue
-
-        h = re.match(r"^(#{1,6})\s+(.*)$", s)
-        if h:
-            level = len(h.group(1))
-            title = h.group(2).strip()
-            if level == 1:
-                ctx = []
-            elif level == 2:
-                ctx = [title]
-            else:
-                # level>=3
-                if len(ctx) >= 1:
-                    ctx = [ctx[0], title]
-                else:
-                    ctx = [title]
-            continue
-
-        m = re.match(r"^(\-|\*)\s+(.*)$", s)
-        if not m:
-            m = re.match(r"^\d+\.\s+(.*)$", s)
-            if m:
-                bullet = m.group(1).strip()
-            else:
-                bullet = None
-        else:
-            bullet = m.group(2).strip()
-
-        if bullet:
-            leaves.append(Leaf(line_index=i, bullet_text=bullet, context_path=ctx.copy()))
-
-    return leaves
-
-
 def calculate_leaf_importance(
     leaf: Leaf,
     topic_volumes: Dict[str, float],
@@ -507,57 +483,54 @@ def select_most_important_leaves(
                 branches.add(leaf.context_path[0])
         return leaves, branches
     
-    # Группируем листья по веткам
-    leaves_by_branch: Dict[str, List[Leaf]] = {}
-    for leaf in leaves:
-        if leaf.context_path:
-            main_topic = leaf.context_path[0]
-            if main_topic not in leaves_by_branch:
-                leaves_by_branch[main_topic] = []
-            leaves_by_branch[main_topic].append(leaf)
-        else:
-            # Листья без контекста идут в отдельную группу
-            if "root" not in leaves_by_branch:
-                leaves_by_branch["root"] = []
-            leaves_by_branch["root"].append(leaf)
+    # Группируем листья по веткам (позиции в leaves)
+    positions_by_branch: Dict[str, List[int]] = {}
+    for pos, leaf in enumerate(leaves):
+        # Листья без контекста идут в отдельную группу
+        branch = leaf.context_path[0] if leaf.context_path else "root"
+        positions_by_branch.setdefault(branch, []).append(pos)
     
     # Подсчитываем количество листьев в каждой ветке
     total_leaves_in_branch: Dict[str, int] = {
-        branch: len(branch_leaves) for branch, branch_leaves in leaves_by_branch.items()
+        branch: len(positions) for branch, positions in positions_by_branch.items()
     }
     
+    # Важность каждого листа вычисляется один раз
+    scores = [
+        calculate_leaf_importance(leaf, topic_volumes, topic_importance, total_leaves_in_branch)
+        for leaf in leaves
+    ]
+    # Max-heap на ветку: (-важность, позиция) — при равной важности раньше идет более ранний лист
+    heaps: Dict[str, List[Tuple[float, int]]] = {}
+    for branch, positions in positions_by_branch.items():
+        heap = [(-scores[pos], pos) for pos in positions]
+        heapq.heapify(heap)
+        heaps[branch] = heap
+    
     # Вычисляем общий объем и важность всех веток
-    total_volume = sum(topic_volumes.get(branch, 0.0) for branch in leaves_by_branch.keys())
-    total_importance = sum(topic_importance.get(branch, 5) for branch in leaves_by_branch.keys())
+    total_volume = sum(topic_volumes.get(branch, 0.0) for branch in heaps.keys())
+    total_importance = sum(topic_importance.get(branch, 5) for branch in heaps.keys())
     
     if total_volume == 0:
         # Если объемы не определены, используем равномерное распределение
-        total_volume = len(leaves_by_branch) * 100.0 / len(leaves_by_branch) if leaves_by_branch else 100.0
+        total_volume = len(heaps) * 100.0 / len(heaps) if heaps else 100.0
     
     if total_importance == 0:
-        total_importance = len(leaves_by_branch) * 5.0  # Средняя важность
+        total_importance = len(heaps) * 5.0  # Средняя важность
     
     # Шаг 1: Гарантируем минимум 1 лист в каждой ветке
-    selected_leaves = []
+    selected: List[int] = []
     processed_branches = set()
     branch_selected_count: Dict[str, int] = {}  # Сколько листьев уже выбрано из каждой ветки
     remaining_quota = max_leaves
     
-    for branch, branch_leaves in leaves_by_branch.items():
+    for branch, heap in heaps.items():
         if remaining_quota <= 0:
             break
         
-        # Вычисляем важность листьев в этой ветке
-        branch_leaves_with_importance = [
-            (leaf, calculate_leaf_importance(leaf, topic_volumes, topic_importance, total_leaves_in_branch))
-            for leaf in branch_leaves
-        ]
-        branch_leaves_with_importance.sort(key=lambda x: x[1], reverse=True)
-        
         # Берем самый важный лист из ветки
-        if branch_leaves_with_importance:
-            best_leaf = branch_leaves_with_importance[0][0]
-            selected_leaves.append(best_leaf)
+        if heap:
+            selected.append(heapq.heappop(heap)[1])
             processed_branches.add(branch)
             branch_selected_count[branch] = 1
             remaining_quota -= 1
@@ -586,16 +559,11 @@ def select_most_important_leaves(
             )
             branch_quotas[branch] = quota
         
-        # Заполняем квоты для каждой ветки итеративно
-        # Продолжаем до тех пор, пока есть квоты и незаполненные ветки
-        iteration = 0
-        max_iterations = remaining_quota * 2  # Защита от бесконечного цикла
-        
-        while remaining_quota > 0 and iteration < max_iterations:
-            iteration += 1
+        # Заполняем квоты по кругу: за проход не более одного листа из каждой ветки
+        while remaining_quota > 0:
             added_any = False
             
-            for branch, branch_leaves in leaves_by_branch.items():
+            for branch, heap in heaps.items():
                 if branch not in processed_branches or remaining_quota <= 0:
                     continue
                 
@@ -606,23 +574,10 @@ def select_most_important_leaves(
                 if current_count >= target_quota or current_count >= 10:
                     continue
                 
-                # Вычисляем важность оставшихся листьев в этой ветке
-                remaining_branch_leaves = [
-                    leaf for leaf in branch_leaves 
-                    if leaf not in selected_leaves
-                ]
-                
-                if remaining_branch_leaves:
-                    branch_leaves_with_importance = [
-                        (leaf, calculate_leaf_importance(leaf, topic_volumes, topic_importance, total_leaves_in_branch))
-                        for leaf in remaining_branch_leaves
-                    ]
-                    branch_leaves_with_importance.sort(key=lambda x: x[1], reverse=True)
-                    
-                    # Берем самый важный лист из этой ветки
-                    best_leaf = branch_leaves_with_importance[0][0]
-                    selected_leaves.append(best_leaf)
-                    branch_selected_count[branch] = branch_selected_count.get(branch, 0) + 1
+                # Берем самый важный из оставшихся листьев этой ветки
+                if heap:
+                    selected.append(heapq.heappop(heap)[1])
+                    branch_selected_count[branch] = current_count + 1
                     remaining_quota -= 1
                     added_any = True
             
@@ -632,36 +587,18 @@ def select_most_important_leaves(
     
     # Шаг 3: Если еще остались квоты, заполняем по важности (но с учетом ограничений)
     if remaining_quota > 0:
-        remaining_leaves = [
-            leaf for leaf in leaves 
-            if leaf not in selected_leaves
+        # Оставшиеся листья: не превышаем максимум на ветку
+        candidates = [
+            item
+            for branch, heap in heaps.items()
+            for item in heap
+            if not leaves[item[1]].context_path or branch_selected_count.get(branch, 0) < 10
         ]
-        
-        # Фильтруем листья: не превышаем максимум на ветку
-        filtered_remaining = []
-        for leaf in remaining_leaves:
-            if leaf.context_path:
-                branch = leaf.context_path[0]
-                current_count = branch_selected_count.get(branch, 0)
-                if current_count < 10:  # Максимум 10 листьев на ветку
-                    filtered_remaining.append(leaf)
-            else:
-                filtered_remaining.append(leaf)
-        
-        if filtered_remaining:
-            leaves_with_importance = [
-                (leaf, calculate_leaf_importance(leaf, topic_volumes, topic_importance, total_leaves_in_branch))
-                for leaf in filtered_remaining
-            ]
-            leaves_with_importance.sort(key=lambda x: x[1], reverse=True)
-            
-            # Берем топ-N самых важных из оставшихся
-            additional_leaves = [
-                leaf for leaf, _ in leaves_with_importance[:remaining_quota]
-            ]
-            selected_leaves.extend(additional_leaves)
+        # Берем топ-N самых важных из оставшихся
+        selected.extend(pos for _, pos in heapq.nsmallest(remaining_quota, candidates))
     
     # Сортируем по line_index для сохранения порядка в markdown
+    selected_leaves = [leaves[pos] for pos in selected]
     selected_leaves.sort(key=lambda l: l.line_index)
     
     return selected_leaves, processed_branches
@@ -739,220 +676,28 @@ def linkify_block_refs(md_line: str, url: str, block_to_xpath: Dict[int, str], i
     return re.sub(r"\[b(\d+)\]", repl, md_line)
 
 
-def apply_leaf_expansions(md: str, expansions: Dict[int, str]) -> str:
-    """Применяет расширения листьев к markdown"""
-    lines = md.splitlines()
-    for idx, new_bullet_text in expansions.items():
-        # заменяем строку "- old" на "- new"
-        if idx < len(lines):
-            lines[idx] = "- " + new_bullet_text
-    return "\n".join(lines)
-
-
-def apply_leaf_expansions_with_remapping(
-    cleaned_md: str, 
-    original_md: str, 
-    expansions: Dict[int, str]
-) -> str:
-    """Применяет расширения листьев с пересчетом индексов после удаления строк
-    
-    Упрощенный подход: просто заменяем листья в cleaned_md на расширенные версии,
-    используя порядок появления листьев.
-    
-    Args:
-        cleaned_md: markdown после удаления необработанных листьев
-        original_md: исходный markdown
-        expansions: словарь индекс_в_исходном -> новый_текст
-    
-    Returns:
-        Markdown с примененными расширениями
-    """
-    cleaned_lines = cleaned_md.splitlines()
-    result_lines = []
-    # Сортируем расширения по индексам для правильного порядка
-    expansion_list = sorted(expansions.items(), key=lambda x: x[0])
-    expansion_idx = 0
-    
-    for line in cleaned_lines:
-        s = line.strip()
-        is_leaf = bool(re.match(r"^(\-|\*)\s+", s)) or bool(re.match(r"^\d+\.\s+", s))
-        
-        if is_leaf and expansion_idx < len(expansion_list):
-            # Заменяем лист на расширенную версию
-            _, new_text = expansion_list[expansion_idx]
-            result_lines.append("- " + new_text)
-            expansion_idx += 1
-        else:
-            # Не лист - оставляем как есть
-            result_lines.append(line)
-    
-    return "\n".join(result_lines)
-
-
-def remove_unprocessed_leaves(md: str, processed_leaf_indices: set) -> str:
-    """Удаляет необработанные листья из markdown
-    
-    Args:
-        md: исходный markdown
-        processed_leaf_indices: множество индексов строк обработанных листьев
-    
-    Returns:
-        Markdown без необработанных листьев
-    """
-    lines = md.splitlines()
-    result_lines = []
-    removed_count = 0
-    
-    for i, line in enumerate(lines):
-        s = line.strip()
-        
-        # Проверяем, является ли строка листом (начинается с "- " или "* ")
-        is_leaf = bool(re.match(r"^(\-|\*)\s+", s)) or bool(re.match(r"^\d+\.\s+", s))
-        
-        if is_leaf:
-            # Если лист обработан, оставляем его
-            if i in processed_leaf_indices:
-                result_lines.append(line)
-            else:
-                # Не обработан - удаляем
-                removed_count += 1
-        else:
-            # Не лист - всегда оставляем (заголовки, пустые строки и т.д.)
-            result_lines.append(line)
-    
-    if removed_count > 0:
-        print(f"[MM] Removed {removed_count} unprocessed leaves")
-    
-    return "\n".join(result_lines)
-
-
-def remove_empty_subsections(md: str) -> str:
-    """Удаляет пустые подразделы (узлы верхнего уровня без листьев)
-    
-    Проходит по markdown и удаляет подразделы (###, #### и т.д.), 
-    которые не содержат обработанных листьев.
-    
-    Args:
-        md: markdown после удаления необработанных листьев
-    
-    Returns:
-        Markdown без пустых подразделов
-    """
-    lines = md.splitlines()
-    if not lines:
-        return md
-    
-    result_lines = []
-    i = 0
-    removed_count = 0
-    
-    while i < len(lines):
-        line = lines[i]
-        s = line.strip()
-        
-        # Проверяем, является ли строка заголовком подраздела (###, ####, #####, ######)
-        subsection_match = re.match(r"^(#{3,6})\s+(.+)$", s)
-        
-        if subsection_match:
-            # Найден подраздел - проверяем, есть ли после него листья
-            subsection_level = len(subsection_match.group(1))
-            subsection_title = subsection_match.group(2)
-            
-            # Ищем листья до следующего заголовка того же или более высокого уровня
-            j = i + 1
-            has_leaves = False
-            
-            while j < len(lines):
-                next_line = lines[j]
-                next_stripped = next_line.strip()
-                
-                # Если пустая строка, пропускаем
-                if not next_stripped:
-                    j += 1
-                    continue
-                
-                # Проверяем, является ли это листом
-                is_leaf = bool(re.match(r"^(\-|\*)\s+", next_stripped)) or bool(re.match(r"^\d+\.\s+", next_stripped))
-                if is_leaf:
-                    has_leaves = True
-                    break
-                
-                # Проверяем, не встретили ли мы заголовок того же или более высокого уровня
-                header_match = re.match(r"^(#{1,6})\s+", next_stripped)
-                if header_match:
-                    header_level = len(header_match.group(1))
-                    # Если уровень заголовка <= уровня подраздела, останавливаемся
-                    if header_level <= subsection_level:
-                        break
-                
-                j += 1
-            
-            # Если в подразделе есть листья, оставляем его и все содержимое
-            if has_leaves:
-                # Добавляем заголовок подраздела
-                result_lines.append(line)
-                # Добавляем содержимое до следующего заголовка того же уровня
-                i += 1
-                while i < len(lines):
-                    current_line = lines[i]
-                    current_stripped = current_line.strip()
-                    
-                    # Проверяем, не встретили ли мы заголовок того же или более высокого уровня
-                    header_match = re.match(r"^(#{1,6})\s+", current_stripped)
-                    if header_match:
-                        header_level = len(header_match.group(1))
-                        if header_level <= subsection_level:
-                            # Вернулись к заголовку того же или более высокого уровня
-                            break
-                    
-                    result_lines.append(current_line)
-                    i += 1
-                continue
-            else:
-                # Подраздел пустой - пропускаем его и все содержимое до следующего заголовка
-                removed_count += 1
-                i += 1
-                while i < len(lines):
-                    current_line = lines[i]
-                    current_stripped = current_line.strip()
-                    
-                    # Проверяем, не встретили ли мы заголовок того же или более высокого уровня
-                    header_match = re.match(r"^(#{1,6})\s+", current_stripped)
-                    if header_match:
-                        header_level = len(header_match.group(1))
-                        if header_level <= subsection_level:
-                            # Вернулись к заголовку того же или более высокого уровня
-                            break
-                    
-                    i += 1
-                continue
-        else:
-            # Не подраздел - добавляем как есть
-            result_lines.append(line)
-            i += 1
-    
-    if removed_count > 0:
-        print(f"[MM] Removed {removed_count} empty subsections")
-    
-    return "\n".join(result_lines)
-
-
 async def generate_leaves_parallel(
     llm_leaf: ChatOpenAI,
     leaves: List[Leaf],
-    block_vecs: np.ndarray,
-    block_ids: List[int],
-    blocks: List,
+    index: BlockIndex,
     emb,
     is_pdf: bool,
     page_url: str,
     block_to_xpath: Dict[int, str],
-    max_leaves: Optional[int] = None
+    max_leaves: Optional[int] = None,
+    on_event: Optional[EventCallback] = None,
+    leaf_cache: Optional[SemanticLeafCache] = None,
+    reuse: Optional[IncrementalRun] = None
 ) -> Dict[int, str]:
-    """Параллельно генерирует текст для всех листьев с батчингом эмбеддингов"""
-    from backend.embeddings import cosine_top_k
-    from backend.canonical import normalize_ws
+    """Параллельно генерирует текст для всех листьев с батчингом эмбеддингов
     
+    on_event (если задан) получает событие "leaf" по мере готовности каждого листа.
+    leaf_cache (если задан) отдает готовый текст, когда выбраны те же по
+    содержимому блоки, а запрос листа близок к уже обработанному.
+    reuse (если задан) отдает текст того же листа из прошлого запуска страницы,
+    если его блоки-источники не изменились.
+    """
+    namespace = str(getattr(llm_leaf, "model", "") or "")
     # Ограничиваем количество листьев для обработки
     if max_leaves and len(leaves) > max_leaves:
         # Приоритизируем: листья из верхних уровней иерархии
@@ -970,27 +715,31 @@ async def generate_leaves_parallel(
     query_vecs = await emb.aembed_documents(queries)
     query_vecs_np = np.array(query_vecs, dtype=np.float32)
     
-    # Находим топ блоки для всех запросов параллельно
-    all_top_indices = []
-    for qv in query_vecs_np:
-        top_idx = cosine_top_k(qv, block_vecs, k=3)
-        all_top_indices.append(top_idx)
+    # Находим топ блоки для всех запросов одним матричным произведением
+    all_top_indices = index.top_k(query_vecs_np, k=3) if leaves else []
     
-    async def process_leaf(leaf: Leaf, query_vec: np.ndarray, top_idx: List[int]) -> Optional[Tuple[int, str]]:
+    async def process_leaf(leaf: Leaf, query_vec: np.ndarray, top_idx: np.ndarray) -> Optional[Tuple[int, str]]:
         try:
             chosen = []
             for i in top_idx:
-                bid = block_ids[i]
-                # Find block text
-                btxt = next((normalize_ws(b.text or "") for b in blocks if b.block == bid), "")
+                bid = index.block_ids[i]
+                btxt = index.texts[i]
                 if btxt:
                     chosen.append((bid, btxt[:1200]))
             
             if not chosen:
                 return None
 
-            # Генерация текста листа
-            leaf_line = await generate_leaf_text_async(llm_leaf, leaf.bullet_text, leaf.context_path, chosen)
+            # Генерация текста листа (или готовый текст из семантического кэша)
+            leaf_line = reuse.leaf(leaf.context_path, leaf.bullet_text, chosen) if reuse is not None else None
+            if leaf_line is None and leaf_cache is not None:
+                leaf_line = leaf_cache.lookup(namespace, chosen, query_vec)
+            if leaf_line is None:
+                leaf_line = await generate_leaf_text_async(llm_leaf, leaf.bullet_text, leaf.context_path, chosen)
+                if leaf_cache is not None:
+                    leaf_cache.store(namespace, chosen, query_vec, leaf_line)
+            if reuse is not None:
+                reuse.record_leaf(leaf.context_path, leaf.bullet_text, chosen, leaf_line)
             chosen_ids = [bid for bid, _ in chosen]
             
             # Обработка ссылок на блоки в зависимости от типа страницы
@@ -1002,6 +751,13 @@ async def generate_leaves_parallel(
                 leaf_line = ensure_block_refs(leaf_line, chosen_ids)
                 leaf_line = linkify_block_refs(leaf_line, page_url, block_to_xpath, is_pdf=False)
             
+            if on_event:
+                on_event("leaf", {
+                    "line_index": leaf.line_index,
+                    "context_path": leaf.context_path,
+                    "bullet": leaf.bullet_text,
+                    "markdown": leaf_line,
+                })
             return leaf.line_index, leaf_line
         except Exception as e:
             print(f"Error processing leaf {leaf.line_index}: {e}")
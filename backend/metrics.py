@@ -0,0 +1,80 @@
+"""Prometheus метрики приложения"""
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Планировщик вызовов OpenAI (lane: chat|embedding)
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    "openai_scheduler_queue_depth",
+    "Calls waiting for rate-limit budget or a concurrency slot",
+    ["lane"],
+)
+SCHEDULER_IN_FLIGHT = Gauge(
+    "openai_scheduler_in_flight",
+    "Calls currently running against the API",
+    ["lane"],
+)
+SCHEDULER_CONCURRENCY_LIMIT = Gauge(
+    "openai_scheduler_concurrency_limit",
+    "Current adaptive (AIMD) concurrency limit",
+    ["lane"],
+)
+SCHEDULER_RATE_LIMITED = Counter(
+    "openai_scheduler_rate_limited_total",
+    "Responses with HTTP 429 from the API",
+    ["lane"],
+)
+
+# Вызовы API (lane: chat|embedding; stage — стадия пайплайна, из которой сделан вызов)
+OPENAI_CALL_LATENCY = Histogram(
+    "openai_call_seconds",
+    "Latency of a single OpenAI API call (one attempt)",
+    ["lane", "stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+OPENAI_CALLS = Counter(
+    "openai_calls_total",
+    "OpenAI API call attempts by outcome (ok|rate_limited|error)",
+    ["lane", "stage", "outcome"],
+)
+
+# Кэш ответов LLM (stage — стадия пайплайна, result: hit|miss)
+COMPLETION_CACHE_REQUESTS = Counter(
+    "llm_completion_cache_requests_total",
+    "Completion cache lookups by result (hit|miss)",
+    ["stage", "result"],
+)
+LEAF_CACHE_REQUESTS = Counter(
+    "leaf_semantic_cache_requests_total",
+    "Semantic leaf cache lookups by result (hit|miss)",
+    ["result"],
+)
+
+# Пайплайн и запросы
+STAGE_LATENCY = Histogram(
+    "mindmap_stage_seconds",
+    "Wall time of a pipeline stage",
+    ["pipeline", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "mindmap_requests_in_flight",
+    "Requests currently being processed",
+    ["endpoint"],
+)
+PAYLOAD_BLOCKS = Histogram(
+    "mindmap_payload_blocks",
+    "Number of page blocks in a request payload",
+    ["endpoint"],
+    buckets=(10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000),
+)
+PAYLOAD_BYTES = Histogram(
+    "mindmap_payload_bytes",
+    "Request body size in bytes",
+    ["endpoint"],
+    buckets=(1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8),
+)
+
+
+def render_metrics() -> bytes:
+    """Метрики в текстовом формате Prometheus"""
+    return generate_latest()
@@ -10,9 +10,9 @@ from backend.models import MindMap, MindNode, Evidence
 from backend.canonical import Canonical, find_anchor, normalize_ws, locator_to_str
 
 
-def build_mindmap(llm: ChatOpenAI, title: str, cluster_topics: Dict[int, str],
-                  chunks: List[Document], assignments: np.ndarray) -> MindMap:
-    """Строит mind map из кластеров"""
+def build_mindmap_prompt(title: str, cluster_topics: Dict[int, str],
+                         chunks: List[Document], assignments: np.ndarray) -> str:
+    """Строит промпт для генерации mind map из кластеров"""
     cluster_blocks = []
     for cid, topic in sorted(cluster_topics.items()):
         idxs = np.where(assignments == cid)[0][:10]
@@ -35,9 +35,21 @@ def build_mindmap(llm: ChatOpenAI, title: str, cluster_topics: Dict[int, str],
         "5) CRITICAL LANGUAGE REQUIREMENT: Write EVERYTHING in ENGLISH ONLY. All node titles, structure, and content must be in English. Translate all content from source language to English. This is mandatory.\n"
     )
 
-    return llm.with_structured_output(MindMap).invoke(
-        f"Title: {title}\n\n{instruction}\n\nClusters:\n\n" + "\n\n".join(cluster_blocks)
-    )
+    return f"Title: {title}\n\n{instruction}\n\nClusters:\n\n" + "\n\n".join(cluster_blocks)
+
+
+def build_mindmap(llm: ChatOpenAI, title: str, cluster_topics: Dict[int, str],
+                  chunks: List[Document], assignments: np.ndarray) -> MindMap:
+    """Строит mind map из кластеров"""
+    prompt = build_mindmap_prompt(title, cluster_topics, chunks, assignments)
+    return llm.with_structured_output(MindMap).invoke(prompt)
+
+
+async def build_mindmap_async(llm: ChatOpenAI, title: str, cluster_topics: Dict[int, str],
+                              chunks: List[Document], assignments: np.ndarray) -> MindMap:
+    """Асинхронная версия построения mind map из кластеров"""
+    prompt = build_mindmap_prompt(title, cluster_topics, chunks, assignments)
+    return await llm.with_structured_output(MindMap).ainvoke(prompt)
 
 
 def quote_from_span(original_text: str, s: int, e: int, max_words: int = 40) -> str:
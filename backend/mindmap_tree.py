@@ -0,0 +1,157 @@
+"""Дерево mind map: markdown от LLM разбирается один раз, постобработка идет по дереву"""
+
+import re
+from typing import Dict, Iterator, List, Optional, Set
+
+from backend.markdown_generator import Leaf
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+_BULLET_RE = re.compile(r"^(?:\-|\*)\s+(.*)$")
+_NUMBERED_RE = re.compile(r"^\d+\.\s+(.*)$")
+
+HEADING = "heading"
+LEAF = "leaf"
+TEXT = "text"  # пустые и прочие строки — выводятся как есть
+
+
+class MindmapNode:
+    """Узел дерева: заголовок (с детьми), лист или строка текста"""
+
+    __slots__ = ("kind", "level", "line", "line_index", "text", "context_path", "children", "expansion")
+
+    def __init__(self, kind: str, line: str, line_index: int = -1, level: int = 0, text: str = "",
+                 context_path: Optional[List[str]] = None):
+        self.kind = kind
+        self.level = level
+        self.line = line              # исходная строка markdown
+        self.line_index = line_index  # индекс строки в исходном markdown
+        self.text = text              # заголовок или текст листа
+        self.context_path = context_path
+        self.children: Optional[List["MindmapNode"]] = [] if kind == HEADING else None
+        self.expansion: Optional[str] = None
+
+
+class MindmapTree:
+    """Разобранный markdown mind map
+
+    Заголовки вкладываются по уровню (#..######), списки (-, *, 1.) — листья.
+    Удаление листьев, пустых подразделов и подстановка расширений — операции
+    над деревом; render() собирает markdown один раз.
+    """
+
+    __slots__ = ("root", "_leaves")
+
+    def __init__(self, root: MindmapNode, leaves: List[MindmapNode]):
+        self.root = root
+        self._leaves = leaves
+
+    @classmethod
+    def parse(cls, md: str) -> "MindmapTree":
+        root = MindmapNode(HEADING, "", level=0)
+        stack = [root]
+        leaves: List[MindmapNode] = []
+        # Контекст листа: ["## тема", "последний ###+"]
+        ctx: List[str] = []
+
+        for i, line in enumerate(md.splitlines()):
+            s = line.strip()
+            h = _HEADING_RE.match(s) if s else None
+            if h:
+                level = len(h.group(1))
+                title = h.group(2).strip()
+                if level == 1:
+                    ctx = []
+                elif level == 2:
+                    ctx = [title]
+                else:
+                    ctx = [ctx[0], title] if ctx else [title]
+                while stack[-1].level >= level:
+                    stack.pop()
+                node = MindmapNode(HEADING, line, i, level=level, text=title)
+                stack[-1].children.append(node)
+                stack.append(node)
+                continue
+
+            m = (_BULLET_RE.match(s) or _NUMBERED_RE.match(s)) if s else None
+            bullet = m.group(1).strip() if m else ""
+            if bullet:
+                node = MindmapNode(LEAF, line, i, text=bullet, context_path=ctx.copy())
+                leaves.append(node)
+            else:
+                node = MindmapNode(TEXT, line, i)
+            stack[-1].children.append(node)
+
+        return cls(root, leaves)
+
+    def leaves(self) -> List[Leaf]:
+        """Листья в порядке документа (line_index — строка исходного markdown)"""
+        return [Leaf(line_index=n.line_index, bullet_text=n.text, context_path=n.context_path.copy())
+                for n in self._leaves]
+
+    def prune_leaves(self, keep: Set[int]) -> int:
+        """Удаляет листья, чьих line_index нет в keep"""
+        removed = 0
+
+        def prune(node: MindmapNode) -> None:
+            nonlocal removed
+            kept = []
+            for c in node.children:
+                if c.kind == LEAF and c.line_index not in keep:
+                    removed += 1
+                    continue
+                if c.kind == HEADING:
+                    prune(c)
+                kept.append(c)
+            node.children = kept
+
+        prune(self.root)
+        self._leaves = [n for n in self._leaves if n.line_index in keep]
+        if removed > 0:
+            print(f"[MM] Removed {removed} unprocessed leaves")
+        return removed
+
+    def remove_empty_sections(self, min_level: int = 3) -> int:
+        """Удаляет подразделы (уровень >= min_level) без листьев вместе с содержимым"""
+        removed = 0
+
+        def sweep(node: MindmapNode) -> bool:
+            """Чистит поддерево; возвращает, есть ли в нем листья"""
+            nonlocal removed
+            kept = []
+            has_leaves = False
+            for c in node.children:
+                if c.kind == HEADING:
+                    child_has_leaves = sweep(c)
+                    if not child_has_leaves and c.level >= min_level:
+                        removed += 1
+                        continue
+                    has_leaves = has_leaves or child_has_leaves
+                elif c.kind == LEAF:
+                    has_leaves = True
+                kept.append(c)
+            node.children = kept
+            return has_leaves
+
+        sweep(self.root)
+        if removed > 0:
+            print(f"[MM] Removed {removed} empty subsections")
+        return removed
+
+    def apply_expansions(self, expansions: Dict[int, str]) -> None:
+        """Подставляет расширенный текст листьев по line_index исходного markdown"""
+        for n in self._leaves:
+            text = expansions.get(n.line_index)
+            if text is not None:
+                n.expansion = text
+
+    def _iter_lines(self, node: MindmapNode) -> Iterator[str]:
+        for c in node.children:
+            if c.kind == LEAF and c.expansion is not None:
+                yield "- " + c.expansion
+            else:
+                yield c.line
+            if c.kind == HEADING:
+                yield from self._iter_lines(c)
+
+    def render(self) -> str:
+        return "\n".join(self._iter_lines(self.root))
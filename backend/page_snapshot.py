@@ -0,0 +1,213 @@
+"""Снимки прошлых запусков по URL для инкрементальной перегенерации страницы"""
+
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backend.canonical import content_hash, normalize_ws
+from backend.embeddings import BlockIndex
+from backend.leaf_cache import fill_template, ref_template
+from backend.models import PopupBlock
+
+# (context_path, текст пункта) — идентичность листа между запусками
+LeafKey = Tuple[Tuple[str, ...], str]
+
+
+def block_hashes(blocks: Iterable[PopupBlock]) -> Dict[int, int]:
+    """Номер блока -> хэш содержимого (номера позиционные, хэши — стабильные)"""
+    out: Dict[int, int] = {}
+    for b in blocks:
+        if b.block is None:
+            continue
+        t = normalize_ws(b.text or "")
+        if t:
+            out[int(b.block)] = content_hash(t)
+    return out
+
+
+@dataclass
+class PageSnapshot:
+    """Результаты прошлого запуска, привязанные к хэшам содержимого блоков"""
+    url: str
+    namespace: str
+    hashes: np.ndarray                 # uint64, хэш блока каждой строки vectors
+    vectors: np.ndarray                # нормализованные эмбеддинги блоков (матрица BlockIndex)
+    lengths: Dict[int, int]            # хэш -> длина текста блока
+    scales: Optional[np.ndarray] = None  # масштабы строк для int8 матрицы
+    topics: List[str] = field(default_factory=list)
+    importance: Dict[str, int] = field(default_factory=dict)
+    # тема -> (хэши блоков темы, квота подтем, поддерево)
+    subtrees: Dict[str, Tuple[FrozenSet[int], int, Optional[str]]] = field(default_factory=dict)
+    # лист -> (хэши блоков-источников, текст со ссылками-шаблонами)
+    leaves: Dict[LeafKey, Tuple[FrozenSet[int], str]] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.time)
+
+    def vectors_by_hash(self) -> Dict[int, np.ndarray]:
+        if self.scales is None:
+            return {int(h): v for h, v in zip(self.hashes, self.vectors)}
+        return {int(h): v.astype(np.float32) * s for h, v, s in zip(self.hashes, self.vectors, self.scales)}
+
+
+class SnapshotStore:
+    """LRU снимков по (URL, namespace) с TTL; объем ограничен суммарным числом блоков
+
+    namespace — все, что кроме блоков влияет на результат (модели, заголовок,
+    уровень детализации, настройки дедупликации и т.п.): запросы с разными
+    параметрами к одному URL не переиспользуют темы друг друга.
+    """
+
+    def __init__(self, max_blocks: int = 20000, ttl_s: float = 86400, max_topic_change: float = 0.2):
+        self.max_blocks = max_blocks
+        self.ttl_s = ttl_s
+        self.max_topic_change = max_topic_change
+        self._entries: "OrderedDict[Tuple[str, str], PageSnapshot]" = OrderedDict()
+        self._blocks = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["SnapshotStore"]:
+        """SNAPSHOT_MAX_BLOCKS=0 отключает инкрементальный режим"""
+        max_blocks = int(os.getenv("SNAPSHOT_MAX_BLOCKS", "20000"))
+        if max_blocks <= 0:
+            return None
+        return cls(
+            max_blocks=max_blocks,
+            ttl_s=float(os.getenv("SNAPSHOT_TTL_S", "86400")),
+            max_topic_change=float(os.getenv("SNAPSHOT_MAX_TOPIC_CHANGE", "0.2")),
+        )
+
+    def get(self, url: str, namespace: str) -> Optional[PageSnapshot]:
+        key = (url, namespace)
+        snap = self._entries.get(key)
+        if snap is None:
+            return None
+        if time.time() - snap.created_at > self.ttl_s:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return snap
+
+    def put(self, snap: PageSnapshot) -> None:
+        if len(snap.hashes) > self.max_blocks:
+            return
+        key = (snap.url, snap.namespace)
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = snap
+        self._blocks += len(snap.hashes)
+        while self._blocks > self.max_blocks:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        snap = self._entries.pop(key)
+        self._blocks -= len(snap.hashes)
+
+    def begin(self, url: str, namespace: str, hash_of: Dict[int, int], blocks: Sequence[PopupBlock]) -> "IncrementalRun":
+        return IncrementalRun(self.get(url, namespace), hash_of, blocks, self.max_topic_change)
+
+    def stats(self) -> Dict[str, int]:
+        return {"pages": len(self._entries), "blocks": self._blocks}
+
+
+class IncrementalRun:
+    """Один запуск пайплайна поверх снимка прошлого запуска той же страницы
+
+    Темы переиспользуются, если изменилось не больше max_topic_change текста;
+    поддерево темы — если совпал набор ее блоков и квота; текст листа — если
+    совпали пункт, путь и набор блоков-источников. Все, что посчитано заново,
+    записывается и попадает в следующий снимок.
+    """
+
+    def __init__(self, prev: Optional[PageSnapshot], hash_of: Dict[int, int],
+                 blocks: Sequence[PopupBlock], max_topic_change: float = 0.2):
+        self.prev = prev
+        self.hash_of = hash_of
+        self.max_topic_change = max_topic_change
+        self.lengths: Dict[int, int] = {}
+        for b in blocks:
+            h = hash_of.get(int(b.block)) if b.block is not None else None
+            if h is not None:
+                self.lengths[h] = len(normalize_ws(b.text or ""))
+        self.topics: List[str] = []
+        self.importance: Dict[str, int] = {}
+        self.subtrees: Dict[str, Tuple[FrozenSet[int], int, Optional[str]]] = {}
+        self.leaves: Dict[LeafKey, Tuple[FrozenSet[int], str]] = {}
+        self.reused = {"topics": 0, "subtrees": 0, "leaves": 0}
+
+        self.changed_share = 1.0
+        if prev is not None:
+            # Доля текста, которого нет в одной из версий
+            old, new = prev.lengths, self.lengths
+            changed = sum(n for h, n in new.items() if h not in old) + sum(n for h, n in old.items() if h not in new)
+            total = max(sum(old.values()), sum(new.values()), 1)
+            self.changed_share = changed / total
+
+    def known_vectors(self) -> Optional[Dict[int, np.ndarray]]:
+        return self.prev.vectors_by_hash() if self.prev is not None else None
+
+    def _hashes(self, block_ids: Iterable[int]) -> FrozenSet[int]:
+        return frozenset(self.hash_of[bid] for bid in block_ids if bid in self.hash_of)
+
+    def previous_topics(self) -> Optional[Tuple[List[str], Dict[str, int]]]:
+        prev = self.prev
+        if prev is None or not prev.topics or self.changed_share > self.max_topic_change:
+            return None
+        self.reused["topics"] = len(prev.topics)
+        return list(prev.topics), dict(prev.importance)
+
+    def record_topics(self, topics: List[str], importance: Dict[str, int]) -> None:
+        self.topics = list(topics)
+        self.importance = dict(importance)
+
+    def subtree(self, topic: str, block_ids: Sequence[int], quota: int) -> Optional[str]:
+        """Поддерево прошлого запуска, если у темы те же блоки и квота"""
+        old = self.prev.subtrees.get(topic) if self.prev is not None else None
+        if old is None or old[2] is None or old[1] != quota or old[0] != self._hashes(block_ids):
+            return None
+        self.reused["subtrees"] += 1
+        return old[2]
+
+    def record_subtree(self, topic: str, block_ids: Sequence[int], quota: int, subtree: Optional[str]) -> None:
+        self.subtrees[topic] = (self._hashes(block_ids), quota, subtree)
+
+    def _blocks(self, chosen: Sequence[Tuple[int, str]]) -> List[Tuple[int, int]]:
+        return [(bid, self.hash_of[bid]) for bid, _ in chosen if bid in self.hash_of]
+
+    def leaf(self, context_path: Sequence[str], bullet: str, chosen: Sequence[Tuple[int, str]]) -> Optional[str]:
+        """Текст листа прошлого запуска, если совпали блоки-источники"""
+        old = self.prev.leaves.get((tuple(context_path), bullet)) if self.prev is not None else None
+        blocks = self._blocks(chosen)
+        if old is None or old[0] != frozenset(h for _, h in blocks):
+            return None
+        self.reused["leaves"] += 1
+        return fill_template(old[1], blocks)
+
+    def record_leaf(self, context_path: Sequence[str], bullet: str,
+                    chosen: Sequence[Tuple[int, str]], text: str) -> None:
+        self.leaves[(tuple(context_path), bullet)] = ref_template(text, self._blocks(chosen))
+
+    def snapshot(self, url: str, namespace: str, index: BlockIndex) -> PageSnapshot:
+        return PageSnapshot(
+            url=url,
+            namespace=namespace,
+            # Строки матрицы индекса могут быть переставлены (IVF)
+            hashes=np.fromiter((self.hash_of[index.block_ids[p]] for p in index.storage_positions),
+                               dtype=np.uint64, count=len(index.block_ids)),
+            vectors=index.matrix,
+            scales=index.scales,
+            lengths=self.lengths,
+            topics=self.topics,
+            importance=self.importance,
+            subtrees=self.subtrees,
+            leaves=self.leaves,
+        )
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "previous": self.prev is not None,
+            "changed_share": round(self.changed_share, 4) if self.prev is not None else None,
+            **{f"reused_{k}": v for k, v in self.reused.items()},
+        }
@@ -0,0 +1,155 @@
+"""Кэш готовых результатов /mindmap_markdown (TTL + stale-while-revalidate)"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+import xxhash
+
+from backend.models import PopupPayload
+
+logger = logging.getLogger(__name__)
+
+
+def payload_digest(payload: PopupPayload) -> str:
+    """Канонический дайджест payload: URL, заголовок и содержимое блоков"""
+    h = xxhash.xxh3_128()
+    head = {
+        "input_type": payload.input_type,
+        "url": payload.page.url if payload.page else None,
+        "title": payload.title,
+    }
+    h.update(json.dumps(head, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    for b in payload.blocks or []:
+        h.update(b"\x1e")
+        h.update(json.dumps(b.model_dump(exclude_none=True), sort_keys=True,
+                            ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    return h.hexdigest()
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    created_at: float
+
+
+class ResultCache:
+    """In-process LRU кэш результатов с TTL и режимом stale-while-revalidate
+
+    Свежая запись (моложе ttl_s) отдается сразу. Устаревшая, но моложе
+    stale_s — тоже отдается сразу, а в фоне запускается пересчет.
+    Одновременные промахи по одному ключу ждут одно и то же вычисление.
+    """
+
+    def __init__(self, ttl_s: float = 600, stale_s: float = 86400, max_items: int = 256):
+        self.ttl_s = ttl_s
+        self.stale_s = max(stale_s, ttl_s)
+        self.max_items = max_items
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._background: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> "ResultCache":
+        return cls(
+            ttl_s=float(os.getenv("RESULT_CACHE_TTL_S", "600")),
+            stale_s=float(os.getenv("RESULT_CACHE_STALE_S", "86400")),
+            max_items=int(os.getenv("RESULT_CACHE_MAX_ITEMS", "256")),
+        )
+
+    def lookup(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry.created_at > self.stale_s:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def store(self, key: str, value: Any) -> None:
+        self._entries[key] = CacheEntry(value=value, created_at=time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+    async def _compute(self, key: str, compute: Callable[[], Awaitable[Any]],
+                       should_store: Callable[[Any], bool]) -> Any:
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await compute()
+            if should_store(value):
+                self.store(key, value)
+            fut.set_result(value)
+            return value
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # помечаем как полученное, если никто больше не ждет
+            raise
+        finally:
+            del self._inflight[key]
+
+    def _revalidate(self, key: str, compute: Callable[[], Awaitable[Any]],
+                    should_store: Callable[[Any], bool]) -> bool:
+        if key in self._inflight:
+            return False
+
+        async def run():
+            try:
+                await self._compute(key, compute, should_store)
+            except Exception as e:
+                logger.error(f"[CACHE] Background refresh failed: {e}")
+
+        task = asyncio.create_task(run())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return True
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        should_store: Callable[[Any], bool] = lambda value: True,
+        revalidate: Optional[Callable[[], Awaitable[Any]]] = None,
+    ) -> Tuple[Any, Dict[str, Any]]:
+        """Возвращает (значение, информация о кэше для meta)
+
+        revalidate — вычисление для фонового обновления устаревшей записи
+        (по умолчанию compute); оно идет уже после ответа вызывающему, поэтому
+        не должно писать в его колбэки прогресса.
+        """
+        entry = self.lookup(key)
+        if entry is not None:
+            age = time.time() - entry.created_at
+            if age <= self.ttl_s:
+                self.hits += 1
+                return entry.value, {"hit": True, "stale": False, "age_s": round(age, 3)}
+            self.stale_hits += 1
+            revalidating = self._revalidate(key, revalidate or compute, should_store) or key in self._inflight
+            return entry.value, {"hit": True, "stale": True, "age_s": round(age, 3),
+                                 "revalidating": revalidating}
+
+        self.misses += 1
+        value = await self._compute(key, compute, should_store)
+        return value, {"hit": False, "age_s": 0.0}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "items": len(self._entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+        }
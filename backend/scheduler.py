@@ -0,0 +1,338 @@
+"""Глобальный планировщик вызовов OpenAI: token buckets (RPM/TPM) + AIMD конкурентность"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, List, Optional
+
+import openai
+
+from backend.metrics import (
+    OPENAI_CALL_LATENCY,
+    OPENAI_CALLS,
+    SCHEDULER_CONCURRENCY_LIMIT,
+    SCHEDULER_IN_FLIGHT,
+    SCHEDULER_QUEUE_DEPTH,
+    SCHEDULER_RATE_LIMITED,
+)
+from backend.tokens import count_tokens_batch, estimate_prompt_tokens
+from backend.tracing import current_stage
+
+logger = logging.getLogger(__name__)
+
+# Временные ошибки, которые имеет смысл повторить (без снижения конкурентности)
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+
+class TokenBucket:
+    """Token bucket с резервированием: запрос списывает токены сразу
+    (баланс может уйти в минус) и ждет, пока долг не восстановится"""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Списывает amount и возвращает, сколько секунд нужно подождать"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount: float) -> None:
+        """Возвращает (или доплачивает при amount < 0) разницу оценки и факта"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimitScheduler:
+    """Планировщик одного направления (lane) вызовов API
+
+    Каждый вызов резервирует запрос и оценку токенов в RPM/TPM buckets, затем
+    ждет слот конкурентности. Лимит конкурентности растет аддитивно после
+    успешных вызовов и уменьшается вдвое на 429 (AIMD).
+    """
+
+    def __init__(self, lane: str, rpm: float, tpm: float, max_concurrency: int = 64,
+                 min_concurrency: int = 1, initial_concurrency: Optional[int] = None,
+                 max_retries: int = 4):
+        self.lane = lane
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.limit = float(initial_concurrency or self.max_concurrency)
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.queued = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._last_decrease = 0.0
+        SCHEDULER_CONCURRENCY_LIMIT.labels(lane).set(self.limit)
+
+    @classmethod
+    def from_env(cls, lane: str, rpm: float, tpm: float) -> "RateLimitScheduler":
+        prefix = f"OPENAI_{lane.upper()}"
+        return cls(
+            lane,
+            rpm=float(os.getenv(f"{prefix}_RPM", rpm)),
+            tpm=float(os.getenv(f"{prefix}_TPM", tpm)),
+            max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", "64")),
+            max_retries=int(os.getenv("OPENAI_SCHEDULER_MAX_RETRIES", "4")),
+        )
+
+    # --- Конкурентность (AIMD) ---
+
+    async def _acquire_slot(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await fut  # слот передается нам в _release_slot
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._release_slot()
+                else:
+                    self._waiters.remove(fut)
+                raise
+        SCHEDULER_IN_FLIGHT.labels(self.lane).set(self.in_flight)
+
+    def _release_slot(self) -> None:
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < int(self.limit):
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(None)
+        SCHEDULER_IN_FLIGHT.labels(self.lane).set(self.in_flight)
+
+    def _on_success(self) -> None:
+        # Аддитивный рост: примерно +1 за "окно" из limit успешных вызовов
+        self.limit = min(float(self.max_concurrency), self.limit + 1.0 / max(self.limit, 1.0))
+        SCHEDULER_CONCURRENCY_LIMIT.labels(self.lane).set(self.limit)
+
+    def _on_rate_limited(self) -> None:
+        SCHEDULER_RATE_LIMITED.labels(self.lane).inc()
+        now = time.monotonic()
+        # Серия 429 от одного всплеска уменьшает лимит один раз
+        if now - self._last_decrease > 1.0:
+            self.limit = max(float(self.min_concurrency), self.limit / 2)
+            self._last_decrease = now
+            SCHEDULER_CONCURRENCY_LIMIT.labels(self.lane).set(self.limit)
+            logger.warning(f"[SCHED] {self.lane}: rate limited, concurrency -> {int(self.limit)}")
+
+    # --- Вызовы ---
+
+    def _reserve(self, tokens: int, requests: int) -> float:
+        return max(self.requests.reserve(requests), self.tokens.reserve(tokens))
+
+    @staticmethod
+    def _backoff(attempt: int, error: Exception) -> float:
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after", ""))
+            except (TypeError, ValueError):
+                retry_after = None
+        base = retry_after if retry_after is not None else min(30.0, 0.5 * (2 ** attempt))
+        return base + random.uniform(0, 0.25 * base)
+
+    def _set_queued(self, delta: int) -> None:
+        self.queued += delta
+        SCHEDULER_QUEUE_DEPTH.labels(self.lane).set(self.queued)
+
+    async def run(self, call: Callable[[], Awaitable[Any]], tokens: int, requests: int = 1,
+                  actual_tokens: Optional[Callable[[Any], Optional[int]]] = None) -> Any:
+        """Выполняет асинхронный вызов API через планировщик"""
+        attempt = 0
+        while True:
+            self._set_queued(1)
+            try:
+                wait = self._reserve(tokens, requests)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self._acquire_slot()
+            finally:
+                self._set_queued(-1)
+            start = time.perf_counter()
+            try:
+                result = await call()
+            except openai.RateLimitError as e:
+                self._on_rate_limited()
+                self._observe(start, "rate_limited")
+                error = e
+            except Exception as e:
+                self._observe(start, "error")
+                if not isinstance(e, TRANSIENT_ERRORS):
+                    raise
+                error = e
+            else:
+                self._observe(start, "ok")
+                self._on_success()
+                self._settle(tokens, result, actual_tokens)
+                return result
+            finally:
+                self._release_slot()
+
+            if attempt >= self.max_retries:
+                raise error
+            await asyncio.sleep(self._backoff(attempt, error))
+            attempt += 1
+
+    def run_sync(self, call: Callable[[], Any], tokens: int, requests: int = 1,
+                 actual_tokens: Optional[Callable[[Any], Optional[int]]] = None) -> Any:
+        """Синхронный вариант (для кода в threadpool): только RPM/TPM, без слотов AIMD"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            # time.sleep ниже остановил бы все запросы воркера
+            raise RuntimeError(f"{self.lane}: blocking API call on the event loop thread, use the async variant")
+        attempt = 0
+        while True:
+            wait = self._reserve(tokens, requests)
+            if wait > 0:
+                time.sleep(wait)
+            start = time.perf_counter()
+            try:
+                result = call()
+            except openai.RateLimitError as e:
+                self._on_rate_limited()
+                self._observe(start, "rate_limited")
+                error = e
+            except Exception as e:
+                self._observe(start, "error")
+                if not isinstance(e, TRANSIENT_ERRORS):
+                    raise
+                error = e
+            else:
+                self._observe(start, "ok")
+                self._settle(tokens, result, actual_tokens)
+                return result
+
+            if attempt >= self.max_retries:
+                raise error
+            time.sleep(self._backoff(attempt, error))
+            attempt += 1
+
+    def _observe(self, start: float, outcome: str) -> None:
+        stage = current_stage()
+        OPENAI_CALL_LATENCY.labels(self.lane, stage).observe(time.perf_counter() - start)
+        OPENAI_CALLS.labels(self.lane, stage, outcome).inc()
+
+    def _settle(self, estimated: int, result: Any,
+                actual_tokens: Optional[Callable[[Any], Optional[int]]]) -> None:
+        """Корректирует TPM bucket по фактическому расходу токенов"""
+        if actual_tokens is None:
+            return
+        actual = actual_tokens(result)
+        if actual is not None:
+            self.tokens.refund(estimated - actual)
+
+    def stats(self) -> dict:
+        return {
+            "lane": self.lane,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "concurrency_limit": int(self.limit),
+        }
+
+
+def _usage_tokens(result: Any) -> Optional[int]:
+    usage = getattr(result, "usage_metadata", None)
+    if usage:
+        return usage.get("total_tokens")
+    return None
+
+
+class ScheduledChatModel:
+    """Обертка над ChatOpenAI (или structured output runnable): все вызовы идут через планировщик"""
+
+    def __init__(self, llm, scheduler: RateLimitScheduler, model: Optional[str] = None,
+                 completion_tokens: Optional[int] = None):
+        self.llm = llm
+        self.scheduler = scheduler
+        self.model = model or getattr(llm, "model_name", None)
+        # Оценка ответа: max_tokens модели или типичный размер
+        self.completion_tokens = completion_tokens or getattr(llm, "max_tokens", None) or 512
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def _estimate(self, input: Any) -> int:
+        return estimate_prompt_tokens(input, self.model) + self.completion_tokens
+
+    async def ainvoke(self, input: Any, *args, **kwargs) -> Any:
+        return await self.scheduler.run(
+            lambda: self.llm.ainvoke(input, *args, **kwargs),
+            tokens=self._estimate(input),
+            actual_tokens=_usage_tokens,
+        )
+
+    def invoke(self, input: Any, *args, **kwargs) -> Any:
+        return self.scheduler.run_sync(
+            lambda: self.llm.invoke(input, *args, **kwargs),
+            tokens=self._estimate(input),
+            actual_tokens=_usage_tokens,
+        )
+
+    def with_structured_output(self, schema, **kwargs) -> "ScheduledChatModel":
+        return ScheduledChatModel(
+            self.llm.with_structured_output(schema, **kwargs),
+            self.scheduler,
+            model=self.model,
+            completion_tokens=self.completion_tokens,
+        )
+
+
+class ScheduledEmbeddings:
+    """Обертка над OpenAIEmbeddings: все вызовы идут через планировщик"""
+
+    def __init__(self, emb, scheduler: RateLimitScheduler):
+        self.emb = emb
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.emb, name)
+
+    def _cost(self, texts: List[str]):
+        model = getattr(self.emb, "model", None)
+        tokens = sum(count_tokens_batch(texts, model))
+        # OpenAIEmbeddings сам режет большие списки на запросы по chunk_size текстов
+        chunk_size = getattr(self.emb, "chunk_size", None) or 1000
+        requests = max(1, -(-len(texts) // chunk_size))
+        return tokens, requests
+
+    async def aembed_documents(self, texts: List[str], *args, **kwargs):
+        tokens, requests = self._cost(texts)
+        return await self.scheduler.run(
+            lambda: self.emb.aembed_documents(texts, *args, **kwargs), tokens=tokens, requests=requests
+        )
+
+    def embed_documents(self, texts: List[str], *args, **kwargs):
+        tokens, requests = self._cost(texts)
+        return self.scheduler.run_sync(
+            lambda: self.emb.embed_documents(texts, *args, **kwargs), tokens=tokens, requests=requests
+        )
+
+    async def aembed_query(self, text: str, *args, **kwargs):
+        return (await self.aembed_documents([text], *args, **kwargs))[0]
+
+    def embed_query(self, text: str, *args, **kwargs):
+        return self.embed_documents([text], *args, **kwargs)[0]
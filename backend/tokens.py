@@ -0,0 +1,54 @@
+"""Подсчет токенов через tiktoken"""
+
+import logging
+from functools import lru_cache
+from typing import Any, List, Optional
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model: Optional[str] = None) -> Optional[tiktoken.Encoding]:
+    """Кодировка для модели (None, если словарь tiktoken недоступен)"""
+    try:
+        if model:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                pass
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        # Нет доступа к словарю (офлайн) — считаем приблизительно
+        logger.warning(f"[TOKENS] tiktoken encoding unavailable, using estimate: {e}")
+        return None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Количество токенов в тексте"""
+    enc = get_encoding(model)
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode_ordinary(text))
+
+
+def count_tokens_batch(texts: List[str], model: Optional[str] = None) -> List[int]:
+    """Количество токенов для списка текстов"""
+    enc = get_encoding(model)
+    if enc is None:
+        return [(len(t) + 3) // 4 for t in texts]
+    return [len(ids) for ids in enc.encode_ordinary_batch(texts)]
+
+
+def estimate_prompt_tokens(messages: Any, model: Optional[str] = None) -> int:
+    """Оценка токенов промпта: строка или список сообщений {"role", "content"}"""
+    if isinstance(messages, str):
+        return count_tokens(messages, model)
+    total = 3  # служебные токены ответа
+    for m in messages or []:
+        content = m.get("content", "") if isinstance(m, dict) else getattr(m, "content", "")
+        total += 4 + count_tokens(content if isinstance(content, str) else str(content), model)
+    return total
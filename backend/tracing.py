@@ -0,0 +1,62 @@
+"""Легковесные спаны стадий пайплайна: Prometheus гистограммы + тайминги для meta"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from backend.metrics import STAGE_LATENCY
+
+
+class PipelineTrace:
+    """Тайминги стадий одного запуска пайплайна (секунды, суммируются по повторам)"""
+
+    def __init__(self, pipeline: str):
+        self.pipeline = pipeline
+        self.stages: Dict[str, float] = {}
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def to_dict(self) -> Dict[str, float]:
+        out = {name: round(s, 4) for name, s in self.stages.items()}
+        out["total"] = round(time.perf_counter() - self.started, 4)
+        return out
+
+
+# Текущий запуск и стадия; копируются в задачи asyncio и asyncio.to_thread
+_trace: ContextVar[Optional[PipelineTrace]] = ContextVar("pipeline_trace", default=None)
+_stage: ContextVar[str] = ContextVar("pipeline_stage", default="none")
+
+
+def current_stage() -> str:
+    return _stage.get()
+
+
+@contextmanager
+def trace_pipeline(pipeline: str) -> Iterator[PipelineTrace]:
+    """Начинает трассировку пайплайна; общее время пишется в стадию "total\""""
+    trace = PipelineTrace(pipeline)
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+        STAGE_LATENCY.labels(pipeline, "total").observe(time.perf_counter() - trace.started)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Спан стадии: можно оборачивать и синхронный код, и await"""
+    trace = _trace.get()
+    token = _stage.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _stage.reset(token)
+        STAGE_LATENCY.labels(trace.pipeline if trace else "none", name).observe(elapsed)
+        if trace is not None:
+            trace.add(name, elapsed)
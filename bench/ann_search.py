@@ -0,0 +1,71 @@
+"""Бенчмарк IVF поиска BlockIndex: recall@k и время запроса против точного поиска
+
+Векторы и запросы те же, что в bench/vector_recall.py.
+
+Запуск из корня репозитория:
+    python -m bench.ann_search --blocks 50000 --nprobe 4,8,16,32
+"""
+
+import json
+import time
+import argparse
+from typing import Any, Dict, List
+
+from backend.embeddings import BlockIndex
+from bench.vector_recall import recall, synthetic_queries, synthetic_vectors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--blocks", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--precision", default="float32")
+    parser.add_argument("--nlist", type=int, default=0, help="0 — около sqrt(blocks)")
+    parser.add_argument("--nprobe", default="4,8,16,32")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--clusters", type=int, default=64)
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.blocks, args.dim, args.clusters)
+    queries = synthetic_queries(vectors, args.queries, args.clusters)
+    index = BlockIndex(vectors, list(range(args.blocks)), [""] * args.blocks,
+                       precision=args.precision, ann_min_blocks=1, nlist=args.nlist)
+
+    t0 = time.perf_counter()
+    exact = index.top_k(queries, args.k, exact=True)
+    exact_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    ann = index.build_ann()
+    build_s = time.perf_counter() - t0
+
+    runs: List[Dict[str, Any]] = []
+    for nprobe in [int(p) for p in args.nprobe.split(",") if p]:
+        index.nprobe = nprobe
+        t0 = time.perf_counter()
+        approx = index.top_k(queries, args.k)
+        query_s = time.perf_counter() - t0
+        runs.append({
+            "nprobe": nprobe,
+            "recall_at_k": round(recall(exact, approx), 4),
+            "query_ms_per_query": round(query_s * 1000 / args.queries, 4),
+            "speedup": round(exact_s / query_s, 2) if query_s else None,
+        })
+
+    print(json.dumps({
+        "bench": "ann_search",
+        "blocks": args.blocks,
+        "dim": args.dim,
+        "precision": args.precision,
+        "nlist": ann.nlist,
+        "queries": args.queries,
+        "k": args.k,
+        "build_ms": round(build_s * 1000, 2),
+        "exact_ms_per_query": round(exact_s * 1000 / args.queries, 4),
+        "runs": runs,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Детерминированные заглушки ChatOpenAI / OpenAIEmbeddings для офлайн-бенчмарков
+
+Отвечают правильно оформленными темами, поддеревьями, листьями и structured
+output (ClusterLabels, MindMap), с настраиваемой задержкой на вызов.
+"""
+
+import re
+import asyncio
+import time
+from collections import Counter
+from typing import Any, List, Optional
+
+import numpy as np
+import xxhash
+from langchain_core.messages import AIMessage
+
+from backend.models import ClusterLabels, MindMap
+from backend.prompts import LEAF_SYSTEM_PROMPT, TOP_LEVEL_TOPICS_PROMPT
+
+_BLOCK_REF_RE = re.compile(r"\[b(\d+)\]")
+_CLUSTER_RE = re.compile(r"^CLUSTER (\d+) SAMPLES:", re.M)
+_SPAN_RE = re.compile(r"span=(\d+):(\d+)")
+
+
+def _text_of(messages: Any) -> List[str]:
+    """(system, user) из строки или списка сообщений"""
+    if isinstance(messages, str):
+        return ["", messages]
+    contents = [m.get("content", "") if isinstance(m, dict) else getattr(m, "content", "") for m in messages]
+    return [contents[0] if len(contents) > 1 else "", contents[-1] if contents else ""]
+
+
+class FakeChatModel:
+    """Заглушка ChatOpenAI: ответ выбирается по промпту, задержка latency_s на вызов"""
+
+    def __init__(self, model: str = "fake-chat", latency_s: float = 0.0, topics: int = 6,
+                 subsections: int = 3, leaves_per_subsection: int = 3, calls: Optional[Counter] = None):
+        self.model_name = model
+        self.model = model
+        self.max_tokens = None
+        self.latency_s = latency_s
+        self.topics = topics
+        self.subsections = subsections
+        self.leaves_per_subsection = leaves_per_subsection
+        self.calls = calls if calls is not None else Counter()
+
+    def _reply(self, messages: Any) -> str:
+        system, user = _text_of(messages)
+        refs = _BLOCK_REF_RE.findall(user)
+        if system == TOP_LEVEL_TOPICS_PROMPT:
+            self.calls["llm_topics"] += 1
+            return "\n".join(f"## Topic {i + 1} [importance:{10 - i % 7}]" for i in range(self.topics))
+        if system == LEAF_SYSTEM_PROMPT:
+            self.calls["llm_leaf"] += 1
+            leaf = next((l[len("Leaf topic:"):].strip() for l in user.splitlines()
+                         if l.startswith("Leaf topic:")), "leaf")
+            cited = "".join(f"[b{r}]" for r in refs[:2])
+            return f"Summary of {leaf[:60]} based on the selected sources. {cited}"
+        if user.startswith("Blocks for topic"):
+            self.calls["llm_subtree"] += 1
+            return self._subtree(refs)
+        # Fallback: дерево целиком (generate_tree_markdown)
+        self.calls["llm_tree"] += 1
+        parts = ["# Document"]
+        for t in range(self.topics):
+            parts.append(f"## Topic {t + 1}")
+            parts.append(self._subtree(refs[t::self.topics]))
+        return "\n".join(parts)
+
+    def _subtree(self, refs: List[str]) -> str:
+        lines = []
+        n = 0
+        for s in range(self.subsections):
+            lines.append(f"### Subsection {s + 1}")
+            for _ in range(self.leaves_per_subsection):
+                ref = f" block {refs[n % len(refs)]}" if refs else ""
+                lines.append(f"- Leaf {n + 1} about{ref}")
+                n += 1
+        return "\n".join(lines)
+
+    def _message(self, messages: Any) -> AIMessage:
+        content = self._reply(messages)
+        prompt_chars = sum(len(t) for t in _text_of(messages))
+        usage = {"input_tokens": prompt_chars // 4, "output_tokens": len(content) // 4,
+                 "total_tokens": (prompt_chars + len(content)) // 4}
+        return AIMessage(content=content, usage_metadata=usage)
+
+    async def ainvoke(self, messages: Any, *args, **kwargs) -> AIMessage:
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        return self._message(messages)
+
+    def invoke(self, messages: Any, *args, **kwargs) -> AIMessage:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        return self._message(messages)
+
+    def with_structured_output(self, schema, **kwargs) -> "FakeStructuredModel":
+        return FakeStructuredModel(schema, self)
+
+
+class FakeStructuredModel:
+    """Заглушка with_structured_output для ClusterLabels и MindMap"""
+
+    def __init__(self, schema, chat: FakeChatModel):
+        self.schema = schema
+        self.chat = chat
+
+    def _reply(self, prompt: Any) -> Any:
+        _, text = _text_of(prompt)
+        if self.schema is ClusterLabels:
+            self.chat.calls["llm_cluster_labels"] += 1
+            ids = [int(x) for x in _CLUSTER_RE.findall(text)]
+            return ClusterLabels(labels=[{"cluster_id": i, "topic": f"Cluster topic {i}"} for i in ids])
+        if self.schema is MindMap:
+            self.chat.calls["llm_mindmap"] += 1
+            spans = [{"start": int(a), "end": int(b)} for a, b in _SPAN_RE.findall(text)]
+            nodes = [
+                {"title": f"Node {i + 1}", "evidence_spans": spans[i * 2:i * 2 + 2],
+                 "children": [{"title": f"Detail {i + 1}.1", "evidence_spans": spans[i * 2:i * 2 + 1]}]}
+                for i in range(max(1, min(8, len(spans) // 2)))
+            ]
+            return MindMap(title="Document", nodes=nodes)
+        raise TypeError(f"unsupported schema: {self.schema}")
+
+    async def ainvoke(self, prompt: Any, *args, **kwargs) -> Any:
+        if self.chat.latency_s:
+            await asyncio.sleep(self.chat.latency_s)
+        return self._reply(prompt)
+
+    def invoke(self, prompt: Any, *args, **kwargs) -> Any:
+        if self.chat.latency_s:
+            time.sleep(self.chat.latency_s)
+        return self._reply(prompt)
+
+
+class FakeEmbeddings:
+    """Заглушка OpenAIEmbeddings: вектор — детерминированный шум от xxhash текста
+
+    Задержка latency_s на каждый запрос из chunk_size текстов (как батчи SDK).
+    """
+
+    def __init__(self, model: str = "fake-embedding", dimensions: int = 256, latency_s: float = 0.0,
+                 chunk_size: int = 1000, calls: Optional[Counter] = None):
+        self.model = model
+        self.dimensions = dimensions
+        self.latency_s = latency_s
+        self.chunk_size = chunk_size
+        self.calls = calls if calls is not None else Counter()
+
+    def _vectors(self, texts: List[str]) -> List[List[float]]:
+        requests = max(1, -(-len(texts) // self.chunk_size))
+        self.calls["emb_requests"] += requests
+        self.calls["emb_texts"] += len(texts)
+        out = []
+        for t in texts:
+            rng = np.random.default_rng(xxhash.xxh64_intdigest(t))
+            out.append(rng.standard_normal(self.dimensions, dtype=np.float32).tolist())
+        return out
+
+    async def aembed_documents(self, texts: List[str], *args, **kwargs) -> List[List[float]]:
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s * max(1, -(-len(texts) // self.chunk_size)))
+        return self._vectors(texts)
+
+    def embed_documents(self, texts: List[str], *args, **kwargs) -> List[List[float]]:
+        if self.latency_s:
+            time.sleep(self.latency_s * max(1, -(-len(texts) // self.chunk_size)))
+        return self._vectors(texts)
+
+    async def aembed_query(self, text: str, *args, **kwargs) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def embed_query(self, text: str, *args, **kwargs) -> List[float]:
+        return self.embed_documents([text])[0]
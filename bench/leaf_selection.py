@@ -0,0 +1,61 @@
+"""Бенчмарк отбора листьев (select_most_important_leaves)
+
+Запуск из корня репозитория:
+    python -m bench.leaf_selection --leaves 10000 --topics 12 --max-leaves 30
+"""
+
+import argparse
+import json
+import random
+import time
+from typing import Dict, List, Tuple
+
+from backend.markdown_generator import Leaf, select_most_important_leaves
+
+
+def synthetic_leaves(n: int, topics: int, seed: int = 0) -> Tuple[List[Leaf], Dict[str, float], Dict[str, int]]:
+    """Листья дерева с topics ветками ## и подразделами ### (как MindmapTree.leaves)"""
+    rnd = random.Random(seed)
+    names = [f"Topic {i}" for i in range(topics)]
+    leaves = []
+    line = 0
+    for i in range(n):
+        topic = names[min(topics - 1, i * topics // n)]
+        line += rnd.randint(1, 3)
+        ctx = [topic] if rnd.random() < 0.2 else [topic, f"Sub {i // 7}"]
+        leaves.append(Leaf(line_index=line, bullet_text=f"leaf {i}", context_path=ctx))
+    volumes = {t: rnd.uniform(1, 30) for t in names}
+    importance = {t: rnd.randint(1, 10) for t in names}
+    return leaves, volumes, importance
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--leaves", type=int, default=10000)
+    parser.add_argument("--topics", type=int, default=12)
+    parser.add_argument("--max-leaves", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    leaves, volumes, importance = synthetic_leaves(args.leaves, args.topics)
+    timings = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        selected, branches = select_most_important_leaves(leaves, args.max_leaves, volumes, importance)
+        timings.append(time.perf_counter() - t0)
+    timings.sort()
+
+    print(json.dumps({
+        "bench": "leaf_selection",
+        "leaves": args.leaves,
+        "topics": args.topics,
+        "max_leaves": args.max_leaves,
+        "selected": len(selected),
+        "branches": len(branches),
+        "min_ms": round(timings[0] * 1000, 3),
+        "median_ms": round(timings[len(timings) // 2] * 1000, 3),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
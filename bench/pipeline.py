@@ -0,0 +1,283 @@
+"""Офлайн бенчмарк пайплайнов /mindmap_markdown и /mindmap (без OpenAI и сети)
+
+Эндпоинты вызываются в процессе с детерминированными заглушками LLM и
+эмбеддингов (bench/fakes.py), подставленными в app.state.clients поверх
+настоящих планировщиков и кэша эмбеддингов. По каждому прогону в JSON
+пишутся время (wall/CPU), пиковая память (tracemalloc) и число вызовов
+по стадиям.
+
+Запуск из корня репозитория:
+    python -m bench.pipeline --sizes 50,500,5000 --output bench.json
+    python -m bench.pipeline --pipelines markdown --inputs pdf_blocks --sizes 50000 --no-memory
+"""
+
+import os
+
+# Без кэшей эмбеддингов, ответов LLM, листьев и снимков страниц: каждый прогон считает все заново
+os.environ["EMB_CACHE_DIR"] = ""
+os.environ["LLM_CACHE_PATH"] = ""
+os.environ["LEAF_CACHE_MAX_ITEMS"] = "0"
+os.environ["SNAPSHOT_MAX_BLOCKS"] = "0"
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import app
+from backend.clients import AppClients
+from backend.embedding_cache import CachedEmbeddings, EmbeddingCache
+from backend.scheduler import RateLimitScheduler, ScheduledChatModel, ScheduledEmbeddings
+from bench.fakes import FakeChatModel, FakeEmbeddings
+from bench.synthetic import blocks_payload, file_payload, page_blocks, pdf_blocks, pdf_bytes
+
+# Стадии /mindmap: функция в модуле app -> стадия, которая заканчивается ее возвратом
+MINDMAP_STAGES = {
+    "canonical_from_page_blocks": "canonicalize",
+    "canonical_from_pdf_bytes": "extract_pdf",
+    "chunk_text": "chunk",
+    "embed_chunks_async": "embed",
+    "cluster_chunks_async": "cluster",
+    "label_clusters_async": "label",
+    "build_mindmap_async": "build",
+    "attach_evidence": "evidence",
+}
+
+INPUTS = {
+    "markdown": ("page", "pdf_blocks"),
+    "mindmap": ("page", "pdf_file"),
+}
+
+
+class StageRecorder:
+    """Замеры между отметками: wall/CPU время, пик памяти и вызовы заглушек"""
+
+    def __init__(self, calls: Counter, trace_memory: bool):
+        self.calls = calls
+        self.trace_memory = trace_memory
+        self.stages: List[Dict[str, Any]] = []
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self._last = (self.started, self.started_cpu, Counter(calls))
+        if trace_memory:
+            tracemalloc.reset_peak()
+
+    def mark(self, name: str) -> None:
+        now, cpu = time.perf_counter(), time.process_time()
+        last_wall, last_cpu, last_calls = self._last
+        stage: Dict[str, Any] = {
+            "name": name,
+            "wall_s": round(now - last_wall, 6),
+            "cpu_s": round(cpu - last_cpu, 6),
+            "calls": dict(Counter(self.calls) - last_calls),
+        }
+        if self.trace_memory:
+            stage["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 3)
+            tracemalloc.reset_peak()
+        self.stages.append(stage)
+        self._last = (now, cpu, Counter(self.calls))
+
+    def summary(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "wall_s": round(time.perf_counter() - self.started, 6),
+            "cpu_s": round(time.process_time() - self.started_cpu, 6),
+            "calls": dict(self.calls),
+        }
+        if self.trace_memory:
+            out["peak_mb"] = max((s["peak_mb"] for s in self.stages), default=0.0)
+        out["stages"] = self.stages
+        return out
+
+
+def make_clients(calls: Counter, llm_latency_s: float, emb_latency_s: float, dimensions: int) -> AppClients:
+    """Клиенты приложения на заглушках; планировщики без лимитов RPM/TPM"""
+    chat_scheduler = RateLimitScheduler("chat", rpm=0, tpm=0)
+    embedding_scheduler = RateLimitScheduler("embedding", rpm=0, tpm=0)
+
+    def chat() -> ScheduledChatModel:
+        return ScheduledChatModel(FakeChatModel(latency_s=llm_latency_s, calls=calls), chat_scheduler)
+
+    emb = FakeEmbeddings(dimensions=dimensions, latency_s=emb_latency_s, calls=calls)
+    return AppClients(
+        llm_tree=chat(),
+        llm_leaf=chat(),
+        llm_cluster=chat(),
+        emb=CachedEmbeddings(ScheduledEmbeddings(emb, embedding_scheduler), EmbeddingCache(memory_items=0)),
+        chat_scheduler=chat_scheduler,
+        embedding_scheduler=embedding_scheduler,
+    )
+
+
+@contextmanager
+def mark_after(rec: StageRecorder, stages: Dict[str, str]):
+    """Временно оборачивает функции модуля app: по возврату ставится отметка стадии"""
+    originals = {}
+    for attr, stage in stages.items():
+        fn = getattr(app, attr)
+        originals[attr] = fn
+        if asyncio.iscoroutinefunction(fn):
+            async def wrapper(*args, _fn=fn, _stage=stage, **kwargs):
+                result = await _fn(*args, **kwargs)
+                rec.mark(_stage)
+                return result
+        else:
+            def wrapper(*args, _fn=fn, _stage=stage, **kwargs):
+                result = _fn(*args, **kwargs)
+                rec.mark(_stage)
+                return result
+        setattr(app, attr, wrapper)
+    try:
+        yield
+    finally:
+        for attr, fn in originals.items():
+            setattr(app, attr, fn)
+
+
+async def run_markdown(payload, rec: StageRecorder) -> Dict[str, Any]:
+    """/mindmap_markdown без кэша ответов; стадии — по событиям прогресса"""
+    leaves = {"total": None, "done": 0}
+
+    def on_event(event: str, data: Dict[str, Any]) -> None:
+        if event == "topics":
+            rec.mark("embed_catalog_topics")
+        elif event == "tree":
+            rec.mark("subtrees")
+        elif event == "leaves":
+            leaves["total"] = data.get("total")
+            rec.mark("leaf_selection")
+        elif event == "leaf":
+            leaves["done"] += 1
+            if leaves["done"] == leaves["total"]:
+                rec.mark("leaf_texts")
+
+    resp = await app.build_markdown_mindmap(payload, on_event)
+    rec.mark("postprocess")
+    meta = resp.meta
+    return {
+        "ok": resp.ok,
+        "error": meta.get("error"),
+        "result": {
+            "markdown_chars": len(resp.markdown),
+            "leaves_total": meta.get("leaves_total"),
+            "leaves_expanded": meta.get("leaves_expanded"),
+            "catalog_ratio": (meta.get("catalog") or {}).get("ratio"),
+        },
+    }
+
+
+async def run_mindmap(payload, rec: StageRecorder) -> Dict[str, Any]:
+    """/mindmap; стадии — по возврату функций пайплайна"""
+    with mark_after(rec, MINDMAP_STAGES):
+        resp = await app.mindmap(payload)
+    rec.mark("response")
+    meta = resp.get("meta", {})
+    return {
+        "ok": resp.get("ok"),
+        "error": resp.get("error"),
+        "result": {
+            "chunks": meta.get("chunks_count"),
+            "clusters": meta.get("clusters_k"),
+        },
+    }
+
+
+def build_payload(pipeline: str, kind: str, size: int):
+    if kind == "page":
+        return blocks_payload(page_blocks(size), url=f"https://bench.local/page-{size}")
+    if kind == "pdf_blocks":
+        return blocks_payload(pdf_blocks(size), url=f"https://bench.local/doc-{size}.pdf")
+    if kind == "pdf_file":
+        # Одна строка текста PDF на "блок"
+        return file_payload(f"bench-{size}.pdf", pdf_bytes(size))
+    raise ValueError(f"unknown input kind: {kind}")
+
+
+async def run_one(pipeline: str, kind: str, size: int, args) -> Dict[str, Any]:
+    payload = build_payload(pipeline, kind, size)
+    calls: Counter = Counter()
+    app.app.state.clients = make_clients(
+        calls, args.llm_latency_ms / 1000, args.emb_latency_ms / 1000, args.dimensions
+    )
+    rec = StageRecorder(calls, trace_memory=not args.no_memory)
+    runner = run_markdown if pipeline == "markdown" else run_mindmap
+    outcome = await runner(payload, rec)
+    return {"pipeline": pipeline, "input": kind, "size": size, **outcome, **rec.summary()}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pipelines", default="markdown,mindmap", help="markdown,mindmap")
+    parser.add_argument("--inputs", default="page,pdf_blocks,pdf_file", help="page,pdf_blocks,pdf_file")
+    parser.add_argument("--sizes", default="50,500,5000", help="число блоков (для pdf_file — строк), до 50000")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--emb-latency-ms", type=float, default=0.0)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--no-memory", action="store_true", help="без tracemalloc (меньше накладных расходов)")
+    parser.add_argument("--output", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    pipelines = [p for p in args.pipelines.split(",") if p]
+    kinds = [k for k in args.inputs.split(",") if k]
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+
+    if not args.no_memory:
+        tracemalloc.start()
+
+    runs = []
+    # print() пайплайна уходит в stderr, stdout остается под JSON
+    with redirect_stdout(sys.stderr):
+        for pipeline in pipelines:
+            for kind in kinds:
+                if kind not in INPUTS.get(pipeline, ()):
+                    continue
+                for size in sizes:
+                    result = asyncio.run(run_one(pipeline, kind, size, args))
+                    print(f"[BENCH] {pipeline}/{kind}/{size}: ok={result['ok']} wall={result['wall_s']:.3f}s "
+                          f"cpu={result['cpu_s']:.3f}s")
+                    runs.append(result)
+
+    report = {
+        "bench": "pipeline",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "llm_latency_ms": args.llm_latency_ms,
+            "emb_latency_ms": args.emb_latency_ms,
+            "dimensions": args.dimensions,
+            "trace_memory": not args.no_memory,
+        },
+        "runs": runs,
+        # ru_maxrss — в КБ на Linux
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Синтетические входные данные для бенчмарков: страницы из блоков, PDF блоки, PDF файлы"""
+
+import base64
+import random
+from typing import List
+
+from backend.models import PopupBlock, PopupPayload
+
+_WORDS = (
+    "model data system process result analysis value method network layer training "
+    "memory cache request latency throughput index vector query token budget cluster "
+    "section document summary structure graph node leaf branch score weight signal "
+    "input output stage pipeline batch stream parser format schema metric error"
+).split()
+
+
+def _sentence(rnd: random.Random, words: int) -> str:
+    return " ".join(rnd.choice(_WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _paragraph(rnd: random.Random, min_words: int = 20, max_words: int = 120) -> str:
+    n = rnd.randint(min_words, max_words)
+    out = []
+    while n > 0:
+        k = min(n, rnd.randint(6, 18))
+        out.append(_sentence(rnd, k))
+        n -= k
+    return " ".join(out)
+
+
+def page_blocks(n: int, seed: int = 0) -> List[PopupBlock]:
+    """Блоки веб-страницы: группы "заголовок + контент" по 4-12 блоков"""
+    rnd = random.Random(seed)
+    blocks: List[PopupBlock] = []
+    group = -1
+    left = 0
+    for i in range(n):
+        if left == 0:
+            group += 1
+            left = rnd.randint(4, 12)
+            level = 2 if group % 4 == 0 else 3
+            blocks.append(PopupBlock(
+                block=i, xpath=f"/html/body/article/section[{group + 1}]/h{level}", tag=f"h{level}",
+                text=_sentence(rnd, rnd.randint(2, 6)), blockType="header", level=level,
+                parentTag="section", sectionLevel=1, visualWeight=22.0 if level == 2 else 18.0, groupId=group,
+            ))
+            left -= 1
+            continue
+        kind = rnd.choices(["paragraph", "list", "table", "code"], weights=[80, 12, 5, 3])[0]
+        extra = {}
+        if kind == "table":
+            extra = {"tableHeaders": ["Name", "Value", "Note"],
+                     "tableRows": [[_sentence(rnd, 2), str(rnd.randint(1, 99)), _sentence(rnd, 3)] for _ in range(3)]}
+        blocks.append(PopupBlock(
+            block=i, xpath=f"/html/body/article/section[{group + 1}]/p[{i}]",
+            tag={"paragraph": "p", "list": "ul", "table": "table", "code": "pre"}[kind],
+            text=_paragraph(rnd), blockType=kind, parentTag="section", sectionLevel=1,
+            visualWeight=16.0, groupId=group, **extra,
+        ))
+        left -= 1
+    return blocks
+
+
+def pdf_blocks(n: int, seed: int = 0, blocks_per_page: int = 12) -> List[PopupBlock]:
+    """Блоки PDF (как их извлекает расширение): pdf_h*/pdf_paragraph/pdf_list с метаданными шрифта"""
+    rnd = random.Random(seed)
+    blocks: List[PopupBlock] = []
+    section = [0, 0]
+    for i in range(n):
+        page = i // blocks_per_page + 1
+        r = rnd.random()
+        if i == 0 or r < 0.08:
+            major = i == 0 or r < 0.02
+            if major:
+                section = [section[0] + 1, 0]
+            else:
+                section[1] += 1
+            number = f"{section[0]}" if major else f"{section[0]}.{section[1]}"
+            tag = "pdf_h1" if major else "pdf_h2"
+            blocks.append(PopupBlock(
+                block=i, xpath=f"//pdf/page[{page}]/block[{i}]", tag=tag, page=page,
+                text=f"{number} {_sentence(rnd, rnd.randint(2, 6))}", blockType="header",
+                level=1 if major else 2, fontSize=18.0 if major else 14.0, style="bold",
+                sectionNumber=number, fontName="Helvetica-Bold",
+            ))
+            continue
+        is_list = r < 0.2
+        blocks.append(PopupBlock(
+            block=i, xpath=f"//pdf/page[{page}]/block[{i}]", tag="pdf_list" if is_list else "pdf_paragraph",
+            page=page, text=_paragraph(rnd, 10, 40) if is_list else _paragraph(rnd),
+            blockType="list" if is_list else "paragraph", fontSize=11.0, style="normal", fontName="Helvetica",
+        ))
+    return blocks
+
+
+def blocks_payload(blocks: List[PopupBlock], url: str, title: str = "Benchmark document") -> PopupPayload:
+    return PopupPayload(
+        schema_version="1", created_at="2024-01-01T00:00:00Z", client={"kind": "bench"},
+        input_type="page_blocks", title=title, page={"url": url, "title": title}, blocks=blocks,
+    )
+
+
+def pdf_bytes(lines: int, seed: int = 0, lines_per_page: int = 45) -> bytes:
+    """Минимальный валидный PDF (Helvetica, текстовые строки) без внешних библиотек"""
+    rnd = random.Random(seed)
+    pages = [
+        [_sentence(rnd, rnd.randint(6, 12)) for _ in range(min(lines_per_page, lines - start))]
+        for start in range(0, max(1, lines), lines_per_page)
+    ]
+
+    objs: List[bytes] = []
+
+    def add(obj: bytes) -> int:
+        objs.append(obj)
+        return len(objs)
+
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pages_id = add(b"")  # заполняется после страниц
+    kids = []
+    for page_lines in pages:
+        body = "BT /F1 11 Tf 14 TL 50 780 Td " + " ".join(f"({line}) '" for line in page_lines) + " ET"
+        content = body.encode("latin-1")
+        cid = add(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        kids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (pages_id, font, cid)
+        ))
+    objs[pages_id - 1] = (
+        b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % k for k in kids) + b"] /Count %d >>" % len(kids)
+    )
+    root = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    out += b"".join(b"%010d 00000 n \n" % off for off in offsets)
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, root, xref)
+    return bytes(out)
+
+
+def file_payload(name: str, data: bytes) -> PopupPayload:
+    return PopupPayload(
+        schema_version="1", created_at="2024-01-01T00:00:00Z", client={"kind": "bench"},
+        input_type="file", title=name,
+        file={"name": name, "mime": "application/pdf", "size_bytes": len(data),
+              "encoding": "base64", "content_base64": base64.b64encode(data).decode("ascii")},
+    )
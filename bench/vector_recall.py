@@ -0,0 +1,97 @@
+"""Бенчмарк сжатых векторов BlockIndex: recall@k и память против точного float32
+
+Векторы синтетические, но похожие на эмбеддинги: кластеры тем и убывающая
+по координатам энергия (как у Matryoshka моделей text-embedding-3), поэтому
+усечение размерности ведет себя правдоподобно. Запросы — зашумленные
+векторы блоков (как запросы листьев) и центры кластеров (как темы).
+
+Запуск из корня репозитория:
+    python -m bench.vector_recall --blocks 30000 --dims 1536,512,256 --precisions float32,float16,int8
+"""
+
+import json
+import time
+import argparse
+from typing import Any, Dict, List
+
+import numpy as np
+
+from backend.embeddings import BlockIndex
+
+
+def synthetic_vectors(n: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    decay = (np.arange(dim, dtype=np.float32) + 1) ** -0.5
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32) * decay
+    labels = rng.integers(0, clusters, size=n)
+    out = centers[labels] + 0.6 * rng.standard_normal((n, dim), dtype=np.float32) * decay
+    return out.astype(np.float32)
+
+
+def synthetic_queries(vectors: np.ndarray, n: int, clusters: int, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    dim = vectors.shape[1]
+    decay = (np.arange(dim, dtype=np.float32) + 1) ** -0.5
+    picks = vectors[rng.integers(0, len(vectors), size=n)]
+    noise = 0.4 * rng.standard_normal((n, dim), dtype=np.float32) * decay
+    return (picks + noise).astype(np.float32)
+
+
+def recall(exact: np.ndarray, approx: np.ndarray) -> float:
+    k = exact.shape[1]
+    return float(np.mean([len(set(a) & set(b)) / k for a, b in zip(exact, approx)]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--blocks", type=int, default=30000)
+    parser.add_argument("--dim", type=int, default=1536, help="полная размерность модели")
+    parser.add_argument("--dims", default="1536,512,256", help="усеченные размерности (Matryoshka)")
+    parser.add_argument("--precisions", default="float32,float16,int8")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--clusters", type=int, default=64)
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.blocks, args.dim, args.clusters)
+    queries = synthetic_queries(vectors, args.queries, args.clusters)
+    ids = list(range(args.blocks))
+    texts = [""] * args.blocks
+
+    baseline = BlockIndex(vectors.copy(), ids, texts)
+    exact = baseline.top_k(queries, args.k)
+
+    runs: List[Dict[str, Any]] = []
+    for dim in [int(d) for d in args.dims.split(",") if d]:
+        # Усечение + нормализация — то же, что делает API с параметром dimensions
+        sub, q = vectors[:, :dim], queries[:, :dim]
+        for precision in [p for p in args.precisions.split(",") if p]:
+            t0 = time.perf_counter()
+            index = BlockIndex(sub.copy(), ids, texts, precision=precision)
+            build_s = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            approx = index.top_k(q, args.k)
+            query_s = time.perf_counter() - t0
+            runs.append({
+                "dim": dim,
+                "precision": precision,
+                "recall_at_k": round(recall(exact, approx), 4),
+                "matrix_mb": round(index.nbytes / 2**20, 2),
+                "bytes_per_block": round(index.nbytes / args.blocks, 1),
+                "build_ms": round(build_s * 1000, 2),
+                "query_ms_per_query": round(query_s * 1000 / args.queries, 4),
+            })
+
+    print(json.dumps({
+        "bench": "vector_recall",
+        "blocks": args.blocks,
+        "full_dim": args.dim,
+        "queries": args.queries,
+        "k": args.k,
+        "baseline_mb": round(baseline.nbytes / 2**20, 2),
+        "runs": runs,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()